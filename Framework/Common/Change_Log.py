@@ -265,6 +265,23 @@ Change Log:
    - Removed warning for duplicate xac file paths (common in dlcs).
    - Removed warnings on classless macros (common in dlcs).
    - Check_Extension will only check xml files.
+ * 1.25
+   - Performance overhaul of file loading, patching, and output.
+   - Catalog dat files are memory mapped, and parsed catalog indexes,
+     md5 verified entries, loose file lists, and extension patched xml
+     are cached on disk between runs.
+   - Added settings "path_to_cache_folder", "use_disk_caches",
+     "always_verify_cat_hashes", "memory_map_dat_files",
+     "num_load_workers", "num_write_workers", "keep_vanilla_xml",
+     "max_loaded_file_mb", and "verify_diff_fraction".
+   - Added "readonly" option to Load_File and Load_Files.
+   - Cat_Unpack uses a thread pool (new "num_workers" arg), and skips
+     files unchanged since a prior unpack.
+   - Generate_Diffs diffs files in parallel (new "num_workers" arg),
+     skips identical files, and matches trees much faster.
+   - Check_All_Extensions can check extensions in parallel (new
+     "num_workers" arg), and can return structured results (new
+     "return_results" arg, also on Check_Extension).
 '''
 # Note: changes moved here for organization, and to make them easier to
 # break out during documentation generation.
@@ -0,0 +1,92 @@
+'''
+Support for small persistent caches kept on disk between runs, eg.
+parsed catalog indexes.
+Cached data is pickled alongside a key describing the source it was
+derived from (typically a path, size and modification time); loading
+with a different key is treated as a miss, so callers fall back to
+rebuilding the data from the source.
+'''
+import os
+import pickle
+from hashlib import md5
+
+from .Settings import Settings
+
+# Bump this when the layout of any cached data changes, to orphan
+# caches written by older versions.
+cache_version = 1
+
+
+def Get_Cache_Path(category, name):
+    '''
+    Returns the path for the cache file of the given category (a
+    subfolder of the cache folder) and name.
+    Names are hashed, so any string (eg. a full file path) may be used.
+    '''
+    file_name = md5(str(name).encode('utf-8')).hexdigest() + '.pickle'
+    return Settings.Get_Cache_Folder() / category / file_name
+
+
+def Get_File_Key(path):
+    '''
+    Returns a tuple identifying the current state of the file on the
+    given path, made from its resolved path, size and modification time.
+    Returns None if the file cannot be stat'd.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def Load(category, name, key):
+    '''
+    Returns the data cached for the given category and name, if it was
+    stored with a matching key, else None.
+    Caches are skipped entirely when Settings.use_disk_caches is False.
+    '''
+    if not Settings.use_disk_caches or key == None:
+        return None
+    try:
+        with open(Get_Cache_Path(category, name), 'rb') as file:
+            version, stored_key, data = pickle.load(file)
+    except Exception:
+        # Missing or unreadable (eg. truncated) caches are just misses.
+        return None
+    if version != cache_version or stored_key != key:
+        return None
+    return data
+
+
+def Store(category, name, key, data):
+    '''
+    Stores data to the cache for the given category and name, tagged
+    with the given key. Writes go through a temp file and rename, so
+    a crash never leaves a partial cache file behind.
+    Failures are ignored, since caches are optional.
+    '''
+    if not Settings.use_disk_caches or key == None:
+        return
+    try:
+        path = Get_Cache_Path(category, name)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        temp_path = path.with_name(path.name + '.tmp{}'.format(os.getpid()))
+        with open(temp_path, 'wb') as file:
+            pickle.dump((cache_version, key, data), file,
+                        protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except Exception:
+        pass
+    return
+
+
+def Remove(category, name):
+    '''
+    Removes any cache file for the given category and name.
+    '''
+    try:
+        Get_Cache_Path(category, name).unlink()
+    except OSError:
+        pass
+    return
@@ -7,6 +7,7 @@ in their own extension folder.
 import os
 from pathlib import Path
 import json
+import threading
 from ..Common.Settings import Settings
 from ..Common import Change_Log
 
@@ -22,16 +23,28 @@ class Plugin_Log_class:
       - Optional function which will be called by Print instead
         of doing the normal file write. The function should accept
         one argument, the message string.
+    * thread_local
+      - threading.local object. If a thread sets a logging_function
+        attribute on this, it will be used for Prints from that thread,
+        taking priority over the normal logging_function.
+      - For use by worker threads that collect messages to be printed
+        later in a set order.
     '''
     def __init__(self):
         self.log_file = None
         self.logging_function = None
+        self.thread_local = threading.local()
 
     def Print(self, line):
         '''
         Write a line to the summary file.
         '''
         line = str(line)
+        # Check for a thread specific logging function first.
+        thread_logging_function = getattr(self.thread_local, 'logging_function', None)
+        if thread_logging_function != None:
+            thread_logging_function(line)
+            return
         # If there is a logging_function attached, call it.
         if self.logging_function != None:
             self.logging_function(line)
@@ -0,0 +1,231 @@
+'''
+Support for fast wildcard lookups over large sets of names, such as
+virtual paths or macro names.
+
+Python's fnmatch.filter checks every name against the pattern, which
+adds up when there are ~100k virtual paths and many queries.
+Path_Index instead organizes names in a directory trie plus buckets
+keyed by file suffix (eg. '.xml'), and uses the literal prefix and
+suffix of a pattern to narrow the candidate names before doing the
+actual wildcard match.
+
+Results match those of fnmatch.filter, including its os dependent
+case handling, and are returned in the order names were added.
+'''
+import os
+import re
+import fnmatch
+from functools import lru_cache
+
+__all__ = ['Path_Index']
+
+# Characters that start a wildcard term in fnmatch patterns.
+_wildcard_chars = '*?['
+
+
+@lru_cache(maxsize = 512)
+def _Compile_Pattern(pattern):
+    '''
+    Returns a compiled regex match function for the given normalized
+    wildcard pattern. Results are cached.
+    '''
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _Normalize(name):
+    '''
+    Returns the name normalized the same way fnmatch.filter does it
+    (lowercased on windows), but keeping forward slashes so that
+    directories can be split out.
+    '''
+    return os.path.normcase(name).replace('\\', '/')
+
+
+def _Get_Suffix_Key(name):
+    '''
+    Returns the suffix bucket key for a normalized name: the part of
+    its final path component starting at the last '.', or None if
+    there is no '.'.
+    '''
+    base_name = name.rsplit('/', 1)[-1]
+    dot_index = base_name.rfind('.')
+    if dot_index == -1:
+        return None
+    return base_name[dot_index:]
+
+
+class _Trie_Node:
+    '''
+    Directory node of a Path_Index.
+
+    Attributes:
+    * children
+      - Dict of child _Trie_Nodes, keyed by directory name.
+    * names
+      - Set of normalized names of all files under this directory,
+        at any depth.
+    '''
+    __slots__ = ['children', 'names']
+    def __init__(self):
+        self.children = {}
+        self.names = set()
+
+
+class Path_Index:
+    '''
+    Index over a collection of names, supporting fast wildcard filtering.
+    Names are treated as '/' separated paths for the trie; names without
+    a '/' just sit at the root.
+
+    Attributes:
+    * name_dict
+      - Dict, keyed by normalized name, holding a tuple of
+        (order, original name), where order is an increasing integer
+        recording when the name was added.
+    * next_order
+      - Int, order value to give the next added name.
+    * root
+      - _Trie_Node for the top directory.
+    * suffix_buckets
+      - Dict, keyed by suffix (eg. '.xml'), holding sets of normalized
+        names with that suffix.
+    '''
+    def __init__(self, names = None):
+        self.Clear()
+        if names != None:
+            for name in names:
+                self.Add(name)
+        return
+
+
+    def Clear(self):
+        '''
+        Removes all names from the index.
+        '''
+        self.name_dict = {}
+        self.next_order = 0
+        self.root = _Trie_Node()
+        self.suffix_buckets = {}
+        return
+
+
+    def __len__(self):
+        return len(self.name_dict)
+
+
+    def __contains__(self, name):
+        return _Normalize(name) in self.name_dict
+
+
+    def Add(self, name):
+        '''
+        Adds a name to the index. If already present, the original
+        add order is kept (matching dict key behavior).
+        '''
+        norm_name = _Normalize(name)
+        if norm_name in self.name_dict:
+            return
+        self.name_dict[norm_name] = (self.next_order, name)
+        self.next_order += 1
+
+        # Record in every directory node along the path.
+        node = self.root
+        node.names.add(norm_name)
+        for dir_name in norm_name.split('/')[:-1]:
+            child = node.children.get(dir_name)
+            if child == None:
+                child = _Trie_Node()
+                node.children[dir_name] = child
+            node = child
+            node.names.add(norm_name)
+
+        suffix_key = _Get_Suffix_Key(norm_name)
+        if suffix_key != None:
+            if suffix_key not in self.suffix_buckets:
+                self.suffix_buckets[suffix_key] = set()
+            self.suffix_buckets[suffix_key].add(norm_name)
+        return
+
+
+    def Remove(self, name):
+        '''
+        Removes a name from the index, if present.
+        '''
+        norm_name = _Normalize(name)
+        if norm_name not in self.name_dict:
+            return
+        del self.name_dict[norm_name]
+
+        node = self.root
+        node.names.discard(norm_name)
+        for dir_name in norm_name.split('/')[:-1]:
+            child = node.children[dir_name]
+            child.names.discard(norm_name)
+            # Prune empty directories.
+            if not child.names:
+                del node.children[dir_name]
+                break
+            node = child
+
+        suffix_key = _Get_Suffix_Key(norm_name)
+        if suffix_key != None:
+            bucket = self.suffix_buckets[suffix_key]
+            bucket.discard(norm_name)
+            if not bucket:
+                del self.suffix_buckets[suffix_key]
+        return
+
+
+    def Filter(self, pattern):
+        '''
+        Returns a list of names matching the given wildcard pattern,
+        same as fnmatch.filter, in the order they were added.
+        '''
+        norm_pattern = _Normalize(pattern)
+
+        # Split off the literal prefix, up to the first wildcard.
+        wildcard_index = len(norm_pattern)
+        for char in _wildcard_chars:
+            index = norm_pattern.find(char)
+            if index != -1 and index < wildcard_index:
+                wildcard_index = index
+
+        # If there are no wildcards, this is a simple lookup.
+        if wildcard_index == len(norm_pattern):
+            if norm_pattern in self.name_dict:
+                return [self.name_dict[norm_pattern][1]]
+            return []
+        prefix = norm_pattern[ : wildcard_index]
+
+        # Prune by prefix: walk down the trie through the complete
+        # directories of the prefix.
+        node = self.root
+        for dir_name in prefix.split('/')[:-1]:
+            node = node.children.get(dir_name)
+            if node == None:
+                return []
+        candidate_sets = [node.names]
+
+        # Prune by suffix: the literal text after the last wildcard.
+        # Skip if there are any [] sets, to avoid parsing them.
+        if '[' not in norm_pattern:
+            suffix = norm_pattern[max(norm_pattern.rfind('*'),
+                                      norm_pattern.rfind('?')) + 1 : ]
+            suffix_key = _Get_Suffix_Key(suffix)
+            if suffix_key != None:
+                candidate_sets.append(self.suffix_buckets.get(suffix_key, set()))
+
+        # Loop over the smallest set, checking membership in the others.
+        candidate_sets.sort(key = len)
+        smallest = candidate_sets[0]
+        others = candidate_sets[1:]
+
+        match = _Compile_Pattern(norm_pattern)
+        matches = [self.name_dict[name] for name in smallest
+                   if name.startswith(prefix)
+                   and all(name in x for x in others)
+                   and match(name)]
+
+        # Return in add order.
+        matches.sort()
+        return [name for _, name in matches]
@@ -1,6 +1,7 @@
 
 from .Settings import Settings
 from .Print import Print
+from . import XPath_Cache
 
 # Record a list of all plugins defined.
 # This is filled in by the decorator at startup.
@@ -145,6 +146,14 @@ def _Plugin_Wrapper(
                         func.__name__
                         ))
 
+                # When profiling, report how well the compiled xpath
+                # cache is doing (cumulative over the run).
+                if Settings.profile:
+                    stats = XPath_Cache.Get_XPath_Cache_Stats()
+                    Print('XPath cache: {} hits, {} misses, {}/{} entries'.format(
+                        stats['hits'], stats['misses'],
+                        stats['size'], stats['max_size']))
+
                 # If the function is supposed to return anything, return it
                 #  here, though currently this is expected to always be None.
                 return results
@@ -1,3 +1,5 @@
+import threading
+
 
 # Note: there are other tricks that can be pulled to redirect prints
 # to the gui, but this is straightforward and somewhat more dynamic.
@@ -11,9 +13,14 @@ class Print_class:
       - Optional function which will be called by Print instead of
         sending to the console. The function should accept
         one argument, the message string.
+    * thread_local
+      - threading.local object. If a thread sets a logging_function
+        attribute on this, it will be used for Prints from that thread,
+        taking priority over the normal logging_function.
     '''
     def __init__(self):
         self.logging_function = None
+        self.thread_local = threading.local()
 
     def __call__(self, line = ''):
         '''
@@ -21,6 +28,11 @@ class Print_class:
         '''
         # Like normal print, convert input to a string if needed.
         line = str(line)
+        # Check for a thread specific logging function first.
+        thread_logging_function = getattr(self.thread_local, 'logging_function', None)
+        if thread_logging_function != None:
+            thread_logging_function(line)
+            return
         # If there is a logging_function attached, call it.
         if self.logging_function != None:
             self.logging_function(line)
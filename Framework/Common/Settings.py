@@ -60,6 +60,12 @@ class Settings_class:
       - Not needed in general use.
       - All files from the source folder will be copied into the extension.
       - Defaults to None
+    * path_to_cache_folder
+      - Optional path to a folder where data cached between runs is kept,
+        eg. parsed catalog indexes.
+      - Safe to delete; contents will be regenerated as needed.
+      - Defaults to None, using a "cache" folder in the customizer
+        home directory.
     * allow_path_error
       - Bool, if True and the x4 or user folder path looks wrong, the
         customizer will still attempt to run (with a warning).
@@ -91,6 +97,40 @@ class Settings_class:
         to verify their md5 hash, no exception will be thrown.
       - Defaults to False; consider setting True if needing to
         unpack incorrectly assembled catalogs.
+    * always_verify_cat_hashes
+      - Bool, if True then every file read from a cat/dat is checked
+        against its md5 hash.
+      - If False, files that passed the check on a prior run are trusted
+        while their cat/dat files are unchanged (tracked in the cache
+        folder when use_disk_caches is enabled).
+      - Defaults to False
+    * memory_map_dat_files
+      - Bool, if True then catalog dat files are memory mapped on first
+        access and kept open, with file contents served as slices of the
+        map instead of reopening the dat on every read.
+      - Maps are released when the file system is reset.
+      - Defaults to True; set False if running into address space limits
+        or file locking problems.
+    * num_load_workers
+      - Int, number of threads used to read and patch files when
+        loading groups of files (eg. all aiscripts).
+      - Files are registered and log messages printed in the same order
+        regardless of worker count.
+      - Defaults to 0, using one thread per cpu core; set to 1 to
+        load files one at a time.
+    * keep_vanilla_xml
+      - Bool, if True then the pre-patching (vanilla) xml of files
+        modified by extensions is kept in memory.
+      - If False, only the patched xml is kept, and the vanilla version
+        is read again from the source files when requested (eg. by
+        the gui file viewer).
+      - Defaults to False, to reduce memory use.
+    * max_loaded_file_mb
+      - Int, rough memory budget in megabytes for loaded game files.
+      - When exceeded, the least recently used files that are unmodified
+        (and not pinned) are released, to be loaded again if requested.
+      - Mainly of use for long gui sessions.
+      - Defaults to 0, no limit.
     * ignore_output_extension
       - Bool, if True, the target extension being generated will have
         its prior content ignored (this run works on the original files,
@@ -163,6 +203,20 @@ class Settings_class:
       - Only attempts to use // for the xpath prefix currently.
       - May result in measurably longer x4 loading times if used often
         in large files.
+    * verify_diff_fraction
+      - Float, fraction of generated xml diff patches to verify by
+        applying them to the original xml and checking the result.
+      - Files are picked by a hash of their path, so the same files are
+        verified on each run.
+      - Lower values speed up output writing for trusted batch runs.
+      - Defaults to 1, verifying all patches.
+    * num_write_workers
+      - Int, number of worker processes used to generate modified xml
+        file contents (diff patches) when writing output.
+      - Output is identical regardless of worker count.
+      - Defaults to 0, using one worker per cpu core where worker
+        processes are forked (eg. linux), else generating everything
+        in the main process, the same as setting this to 1.
     * root_file_tag
       - String, extra tag added to names of modified files in the root folder
         and not placed in an extension, eg. X4.exe, to avoid overwriting the 
@@ -222,6 +276,12 @@ class Settings_class:
         during processing.
       - Intended for development use, to enable breakpoints during calls.
       - Defaults to False
+    * use_disk_caches
+      - Bool, if True then some data derived from game files, eg. parsed
+        catalog indexes and extension patched xml, is saved to the cache
+        folder and reused on later runs while the source files are
+        unchanged.
+      - Defaults to True
     * use_scipy_for_scaling_equations
       - Bool, if True then scipy will be used to optimize scaling
         equations, for smoother curves between the boundaries.
@@ -381,17 +441,25 @@ class Settings_class:
         defaults['output_to_user_extensions'] = False
         defaults['path_to_output_folder'] = None        
         defaults['path_to_source_folder'] = None
+        defaults['path_to_cache_folder'] = None
         defaults['prefer_single_files'] = False
         defaults['ignore_extensions'] = False
         defaults['extension_whitelist'] = ''
         defaults['extension_blacklist'] = ''
         defaults['allow_cat_md5_errors'] = False
+        defaults['always_verify_cat_hashes'] = False
+        defaults['memory_map_dat_files'] = True
+        defaults['num_load_workers'] = 0
+        defaults['keep_vanilla_xml'] = False
+        defaults['max_loaded_file_mb'] = 0
         defaults['ignore_output_extension'] = True
         defaults['X4_exe_name'] = 'X4.exe'
+        defaults['num_write_workers'] = 0
         defaults['root_file_tag'] = '.mod'
         defaults['make_maximal_diffs'] = False
         defaults['forced_xpath_attributes'] = ''
         defaults['shorten_xpaths'] = False
+        defaults['verify_diff_fraction'] = 1
         defaults['plugin_log_file_name'] = 'plugin_log.txt'
         defaults['live_editor_log_file_name'] = 'live_editor_log.json'        
         defaults['customizer_log_file_name'] = 'customizer_log.json'        
@@ -399,6 +467,7 @@ class Settings_class:
         defaults['disable_cleanup_and_writeback'] = False
         defaults['log_source_paths'] = False
         defaults['skip_all_plugins'] = False
+        defaults['use_disk_caches'] = True
         defaults['use_scipy_for_scaling_equations'] = True
         defaults['show_scaling_plots'] = False
         defaults['developer'] = False
@@ -662,6 +731,21 @@ class Settings_class:
         'Returns the path to the Source folder.'
         return self.path_to_source_folder
     
+    # Note: this doesn't require the x4/user paths to be valid, so that
+    # standalone utilities (eg. Cat_Unpack) can make use of caches.
+    def Get_Cache_Folder(self):
+        '''
+        Returns the path to the cache folder.
+        Creates it if it does not exist.
+        '''
+        if self.path_to_cache_folder:
+            path = Path(self.path_to_cache_folder).resolve()
+        else:
+            path = home_path / 'cache'
+        if not path.exists():
+            path.mkdir(parents = True)
+        return path
+    
     @_Verify_Init
     def Get_Plugin_Log_Path(self):
         'Returns the path to the plugin log file.'
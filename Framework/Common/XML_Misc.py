@@ -5,6 +5,7 @@ to lxml.
 '''
 #import xml.etree.ElementTree as ET
 #from xml.dom import minidom
+from .XPath_Cache import XPath
 
 
 def Find_All_Matches(base_node, match_node):
@@ -35,7 +36,7 @@ def Find_All_Matches(base_node, match_node):
         xpath += '[{}]'.format(child.tag)
 
     # Get the initial matches.
-    found_nodes = base_node.xpath(xpath)
+    found_nodes = XPath(base_node, xpath)
 
     # Filter out those without the right number of children.
     found_nodes = [x for x in found_nodes 
@@ -0,0 +1,70 @@
+'''
+Cache of compiled lxml xpath expressions.
+
+Calling node.xpath() compiles the expression from scratch each time,
+which adds up when the same xpaths are used repeatedly, eg. by live
+editor items reading each file version, or by diff patches applied
+to many files. XPath() here instead compiles each expression once into
+an etree.XPath object, keeping the most recently used ones.
+
+Results match node.xpath(); invalid expressions raise lxml XPathError
+exceptions with the same messages (though possibly of a different
+subclass, eg. XPathSyntaxError instead of XPathEvalError).
+'''
+from functools import lru_cache
+from lxml import etree as ET
+
+__all__ = ['XPath', 'Get_XPath', 'Get_XPath_Cache_Stats']
+
+# Max number of compiled expressions to keep.
+# Note: intuitive guess; live editor objects use a few hundred
+# distinct xpaths.
+max_cache_size = 2048
+
+
+@lru_cache(maxsize = max_cache_size)
+def _Compile(xpath, namespace_items):
+    '''
+    Returns a compiled etree.XPath for the given expression and
+    namespace items (tuple of (prefix, uri) pairs, or None).
+    Results are cached.
+    '''
+    namespaces = dict(namespace_items) if namespace_items else None
+    return ET.XPath(xpath, namespaces = namespaces)
+
+
+def Get_XPath(xpath, namespaces = None):
+    '''
+    Returns a compiled etree.XPath object for the given expression,
+    reusing a cached one when available.
+
+    * xpath
+      - String, the xpath expression.
+    * namespaces
+      - Dict, optional, namespace prefix to uri mapping.
+    '''
+    namespace_items = tuple(sorted(namespaces.items())) if namespaces else None
+    return _Compile(xpath, namespace_items)
+
+
+def XPath(node, xpath, namespaces = None):
+    '''
+    Returns the result of evaluating the given xpath on the node (an
+    Element or ElementTree), same as node.xpath(xpath), using a cached
+    compiled expression.
+    '''
+    return Get_XPath(xpath, namespaces)(node)
+
+
+def Get_XPath_Cache_Stats():
+    '''
+    Returns a dict with the cache 'hits', 'misses', current 'size',
+    and 'max_size'.
+    '''
+    info = _Compile.cache_info()
+    return {
+        'hits'     : info.hits,
+        'misses'   : info.misses,
+        'size'     : info.currsize,
+        'max_size' : info.maxsize,
+        }
@@ -20,3 +20,6 @@ from .Plugin_Manager import Plugin_Was_Run_Before
 from .Home_Path import home_path
 
 from . import XML_Misc
+from . import Disk_Cache
+from . import XPath_Cache
+from .Path_Index import Path_Index
@@ -32,9 +32,14 @@ Note on case:
 '''
 from pathlib import Path
 import hashlib
+import mmap
+import atexit
+import weakref
+import threading
 from collections import namedtuple
 
 from ..Common import Cat_Hash_Exception, Settings, Print
+from ..Common import Disk_Cache
 
 # Use a named tuple to track cat entries.
 # Values are integers unless suffixed otherwise.
@@ -43,6 +48,22 @@ Cat_Entry = namedtuple(
     ['cat_path','num_bytes', 'start_byte', 'timestamp', 'hash_str'])
 
 
+# Cat_Readers with verified hashes not yet saved to the disk cache.
+# Weak, so that dropped readers don't linger; any still alive at exit
+# get saved then.
+_readers_with_unsaved_hashes = weakref.WeakSet()
+_verified_entries_lock = threading.Lock()
+# Lock for opening dat maps, in case of reads from multiple threads.
+_dat_open_lock = threading.Lock()
+
+@atexit.register
+def _Store_All_Verified_Hashes():
+    'Saves verified hashes of all Cat_Readers with unsaved changes.'
+    for cat_reader in list(_readers_with_unsaved_hashes):
+        cat_reader.Store_Verified_Hashes()
+    return
+
+
 def Get_Hash_String(binary):
     '''
     Returns a 128-bit md5 hash as a hex string for the given binary.
@@ -78,15 +99,66 @@ class Cat_Reader:
       - Dict of Cat_Entry objects holding the parsed file information,
         keyed by the virtual path (lower case).
       - A Cat_Entry itself will have an original case path.
+    * use_mmap
+      - Bool, if True then the dat file is memory mapped on the first
+        read and kept open until Close is called, and Read returns
+        memoryview slices of the map instead of bytes.
+      - Defaults to Settings.memory_map_dat_files.
+    * dat_file
+      - File object for the open dat, when memory mapped, else None.
+    * dat_mmap
+      - mmap object for the dat, when memory mapped, else None.
+    * dat_view
+      - memoryview over dat_mmap, used to hand out zero-copy slices.
+    * verified_entries
+      - Set of (start_byte, num_bytes) tuples for entries that have
+        passed the md5 check, persisted in the disk cache keyed by the
+        cat and dat sizes and modification times.
+      - Reads of these entries skip the md5 check, unless
+        Settings.always_verify_cat_hashes is set.
+      - None until the first Read.
+    * verified_entries_key
+      - The cat and dat file key at the time verified_entries was
+        loaded, which it gets stored under; None until then.
+
+    Parameters:
+    * use_index_cache
+      - Bool, if True then the parsed cat_entries are saved to the disk
+        cache, and reused on later runs while the cat file's path, size
+        and modification time are unchanged.
+      - Defaults to Settings.use_disk_caches.
     '''
-    def __init__(self, cat_path = None):
+    def __init__(self, cat_path = None, use_mmap = None, use_index_cache = None):
         self.cat_path = cat_path
         self.dat_path = cat_path.with_suffix('.dat')
         self.cat_entries = {}
+        self.use_mmap = (use_mmap if use_mmap != None 
+                         else Settings.memory_map_dat_files)
+        self.dat_file = None
+        self.dat_mmap = None
+        self.dat_view = None
+        self.verified_entries = None
+        self.verified_entries_key = None
 
         # Read the cat. Error if not found.
         if not self.cat_path.exists():
-            raise AssertionError('Error: failed to find cat file at {}'.format(path))
+            raise AssertionError('Error: failed to find cat file at {}'.format(self.cat_path))
+
+        # Try to reuse the index parsed on a prior run, falling back
+        # on parsing the cat text (and saving the result for next time).
+        if use_index_cache == None:
+            use_index_cache = Settings.use_disk_caches
+        if not use_index_cache or not self._Load_Index_Cache():
+            self._Parse_Cat()
+            if use_index_cache:
+                self._Store_Index_Cache()
+        return
+
+
+    def _Parse_Cat(self):
+        '''
+        Parses the cat file text, filling in cat_entries.
+        '''
         # This can just do a raw text read.
         with open(self.cat_path, 'r') as file:
             text = file.read()
@@ -114,7 +186,44 @@ class Cat_Reader:
 
             # Advance the offset for the next packed file.
             dat_start_offset += num_bytes
-            
+        return
+
+
+    def _Get_Index_Cache_Key(self):
+        '''
+        Returns the key identifying the current cat file contents, for
+        use with the index cache.
+        '''
+        return Disk_Cache.Get_File_Key(self.cat_path.resolve())
+
+
+    def _Load_Index_Cache(self):
+        '''
+        Fills in cat_entries from the on-disk index cache, if it was
+        stored for the current state of the cat file.
+        Returns True on success, False if the cache was missing or stale.
+        '''
+        entry_tuples = Disk_Cache.Load(
+            'cat_indexes', self.cat_path.resolve(), self._Get_Index_Cache_Key())
+        if entry_tuples == None:
+            return False
+        # Entries are stored in cat order as plain tuples; rebuild the
+        # dict, which gives the same result as the original parse
+        # (including for any repeated paths).
+        self.cat_entries = {x[0].lower() : Cat_Entry._make(x) 
+                            for x in entry_tuples}
+        return True
+
+
+    def _Store_Index_Cache(self):
+        '''
+        Saves cat_entries to the on-disk index cache.
+        '''
+        # Store plain tuples, to avoid tying the pickle to this module
+        # path (which can differ in the compiled version).
+        Disk_Cache.Store(
+            'cat_indexes', self.cat_path.resolve(), self._Get_Index_Cache_Key(),
+            [tuple(x) for x in self.cat_entries.values()])
         return
 
 
@@ -147,6 +256,10 @@ class Cat_Reader:
         * allow_md5_error
           - Bool, if True then the md5 check will be suppressed and
             errors allowed. May still print a warning message.
+
+        Returns bytes, or a read-only memoryview when use_mmap is set.
+        Callers that keep the data around should copy it, since held
+        views prevent the map from closing.
         '''
         # Ensure lower case path.
         virtual_path = virtual_path.lower()
@@ -158,38 +271,196 @@ class Cat_Reader:
                     virtual_path, self.cat_path))
             return None
 
-        # For now, open the dat file on every call and close it
-        #  afterwards.  Could also consider leaving this open
-        #  across calls, if many reads are expected, for a speedup.
-        with open(self.dat_path, 'rb') as file:
-            # Move to the file start location.
-            file.seek(self.cat_entries[virtual_path].start_byte)
-            # Grab the byte range.
-            binary = file.read(self.cat_entries[virtual_path].num_bytes)
+        cat_entry = self.cat_entries[virtual_path]
+        binary = self.Read_Entry_Binary(cat_entry)
+        self.Verify_Entry_Binary(cat_entry, binary, 
+                                 allow_md5_error = allow_md5_error)
+        return binary
+
+
+    def Read_Entry_Binary(self, cat_entry, dat_file = None):
+        '''
+        Returns the raw binary of the given Cat_Entry from the dat file,
+        without any hash verification.
+
+        * cat_entry
+          - Cat_Entry from this reader.
+        * dat_file
+          - Optional open binary file handle for the dat, used instead
+            of opening the dat when not memory mapping.
+          - Useful when reading many entries in dat order, as the seeks
+            will then just skip forward.
+        '''
+        if self.use_mmap:
+            # Slice out of the mapped dat; this doesn't copy the data,
+            # and hashlib and lxml both accept the memoryview directly.
+            start = cat_entry.start_byte
+            binary = self._Get_Dat_View()[start : start + cat_entry.num_bytes]
+        elif dat_file != None:
+            dat_file.seek(cat_entry.start_byte)
+            binary = dat_file.read(cat_entry.num_bytes)
+        else:
+            # Open the dat file on this call and close it afterwards.
+            with open(self.dat_path, 'rb') as file:
+                # Move to the file start location.
+                file.seek(cat_entry.start_byte)
+                # Grab the byte range.
+                binary = file.read(cat_entry.num_bytes)
+        return binary
+
 
+    def Verify_Entry_Binary(self, cat_entry, binary, allow_md5_error = False):
+        '''
+        Checks the binary read for a Cat_Entry against its md5 hash,
+        raising a Cat_Hash_Exception on mismatch unless errors are allowed.
+        Safe to call from multiple threads.
+
+        * cat_entry
+          - Cat_Entry from this reader.
+        * binary
+          - Bytes or memoryview read for the entry.
+        * allow_md5_error
+          - Bool, if True then the md5 check will be suppressed and
+            errors allowed. May still print a warning message.
+        '''
+        # Entries that passed verification on a prior run (or earlier in
+        # this one) can skip the hash, unless full verification is forced.
+        verified_entries = None
+        if Settings.use_disk_caches and not Settings.always_verify_cat_hashes:
+            verified_entries = self._Get_Verified_Entries()
+            entry_key = (cat_entry.start_byte, cat_entry.num_bytes)
+            if entry_key in verified_entries:
+                return
 
         # Verify the hash.
         binary_hash_str = Get_Hash_String(binary)
-        cat_hash_str = self.cat_entries[virtual_path].hash_str
+        cat_hash_str = cat_entry.hash_str
 
         # Note: egosoft cats are buggy and can have a 0 for the hash
         # of empty files, so also check that, but keep the normal
         # check incase proper empty file hashes show up sometimes.
-        if (cat_hash_str == binary_hash_str):
-            # Hash match.
-            pass
-        elif not binary and cat_hash_str == '00000000000000000000000000000000':
-            # Alt hash match for empty file.
-            pass
+        if (cat_hash_str == binary_hash_str
+        # Alt hash match for empty file.
+        or not binary and cat_hash_str == '00000000000000000000000000000000'):
+            # Hash match; remember it.
+            if verified_entries != None:
+                verified_entries.add(entry_key)
+                _readers_with_unsaved_hashes.add(self)
         else:
             # Handle the error message.
             message = 'File {} in cat {} failed the md5 hash check'.format(
-                    virtual_path, self.cat_path)
+                    cat_entry.cat_path, self.cat_path)
             # Prevent the exception based on Settings or the input arg.
             if not Settings.allow_cat_md5_errors and not allow_md5_error:
                 raise Cat_Hash_Exception(message)
             elif Settings.verbose:
                 Print(message)
+        return
 
-        return binary
 
+    def _Get_Verified_Cache_Key(self):
+        '''
+        Returns the key identifying the current cat and dat contents,
+        for use with the verified hash store.
+        '''
+        return (Disk_Cache.Get_File_Key(self.cat_path.resolve()),
+                Disk_Cache.Get_File_Key(self.dat_path.resolve()))
+
+
+    def _Get_Verified_Entries(self):
+        '''
+        Returns the set of (start_byte, num_bytes) entries known to have
+        passed hash verification, loading it from the disk cache on
+        the first call.
+        '''
+        # Lock in case worker threads are verifying in parallel, so that
+        # none of them end up adding to a set that gets replaced.
+        with _verified_entries_lock:
+            if self.verified_entries == None:
+                # Note the key now, so that entries get stored against
+                # the file contents they were verified with.
+                key = self._Get_Verified_Cache_Key()
+                verified_entries = Disk_Cache.Load(
+                    'cat_verified_hashes', self.cat_path.resolve(), key)
+                if verified_entries == None:
+                    verified_entries = set()
+                self.verified_entries_key = key
+                self.verified_entries = verified_entries
+        return self.verified_entries
+
+
+    def Store_Verified_Hashes(self):
+        '''
+        Saves any newly verified entries to the disk cache.
+        Called automatically on Close and at interpreter exit.
+        Entries are dropped if the cat or dat changed since they were
+        loaded, since they may have been verified against the old
+        contents.
+        '''
+        if self in _readers_with_unsaved_hashes:
+            _readers_with_unsaved_hashes.discard(self)
+            if self._Get_Verified_Cache_Key() == self.verified_entries_key:
+                Disk_Cache.Store(
+                    'cat_verified_hashes', self.cat_path.resolve(),
+                    self.verified_entries_key,
+                    set(self.verified_entries))
+        return
+
+
+    def _Get_Dat_View(self):
+        '''
+        Returns a memoryview over the memory mapped dat file, opening
+        and mapping the dat if needed.
+        '''
+        # Lock in case multiple threads are reading at once, so the
+        # dat only gets opened once; recheck after getting the lock.
+        if self.dat_view == None:
+            with _dat_open_lock:
+                if self.dat_view == None:
+                    self._Open_Dat_View()
+        return self.dat_view
+
+
+    def _Open_Dat_View(self):
+        '''
+        Opens the dat file and fills in dat_view, memory mapping the
+        dat if it isn't empty.
+        '''
+        self.dat_file = open(self.dat_path, 'rb')
+        # Empty dats cannot be mapped; any entries they have will
+        # be empty, so an empty view serves them fine.
+        if self.dat_path.stat().st_size == 0:
+            self.dat_view = memoryview(b'')
+        else:
+            self.dat_mmap = mmap.mmap(
+                self.dat_file.fileno(), 0, access = mmap.ACCESS_READ)
+            self.dat_view = memoryview(self.dat_mmap)
+        return
+
+
+    def Close(self):
+        '''
+        Releases any memory mapped dat file and its handle.
+        The next Read will reopen the dat, picking up any changes made
+        to it in the meantime, so this also serves as a refresh.
+        '''
+        self.Store_Verified_Hashes()
+        # Reload verified entries on the next read, in case the dat
+        # was changed while closed.
+        self.verified_entries = None
+        self.verified_entries_key = None
+        if self.dat_view != None:
+            self.dat_view.release()
+        if self.dat_mmap != None:
+            try:
+                self.dat_mmap.close()
+            except BufferError:
+                # Some returned slices are still alive elsewhere; the map
+                # will be closed by python once they are collected.
+                pass
+        if self.dat_file != None:
+            self.dat_file.close()
+        self.dat_file = None
+        self.dat_mmap = None
+        self.dat_view = None
+        return
@@ -13,13 +13,14 @@ Note on newlines:
     about the extension not loading.)
     X Tools does not add newlines between text files.
 '''
+import os
 import gzip
 import time
 import hashlib
+from contextlib import ExitStack
 from pathlib import Path
 from .File_Types import Game_File, Signature_File, Machine_Code_File
-from .File_Types import Generate_Signatures
-from .Cat_Reader import Get_Hash_String
+from .File_Types import Generate_Signatures, Gen_Binaries
 from ..Common import Print
 
 
@@ -57,10 +58,11 @@ class Cat_Writer:
         self.game_files.append(game_file)
 
 
-    def Write(self, generate_sigs = False, separate_sigs = False):
+    def Write(self, generate_sigs = False, separate_sigs = False, num_workers = None):
         '''
         Write the contents to a cat/dat file pair.
         Any existing files will be overwritten.
+        Files are written in virtual_path order.
 
         * generate_sigs
           - Bool, if True then dummy signature files will be created.
@@ -68,82 +70,141 @@ class Cat_Writer:
           - Bool, if True then any signatures will be moved to a second
             cat/dat pair suffixed with .sig. This may result in an
             empty dat.
+        * num_workers
+          - Int, optional, number of processes used to generate file
+            binaries; see File_Types.Gen_Binaries.
         '''
         # Handle signature generation first.
         game_files = self.game_files
         if generate_sigs:
             game_files += Generate_Signatures(self.game_files)
 
+        # Sort the files, so output doesn't depend on the order they
+        # were added in.
+        game_files = sorted(game_files, key = lambda x: x.virtual_path)
 
-        # Requires up to two passes, if separating sigs.
+        # Pick the cat/dat pair paths to write, keyed by mode.
+        # When separating sigs, they go to a second pair with a .sig
+        # appended to the names.
         if separate_sigs:
-            modes = ['std','sig']
+            mode_paths = {
+                'std' : (self.cat_path, self.dat_path),
+                'sig' : (self.cat_path.parent / (self.cat_path.name + '.sig'),
+                         self.dat_path.parent / (self.dat_path.name + '.sig')),
+                }
         else:
-            modes = ['all']
-
-        for mode in modes:
-
-            # Cat contents will be kept as a list of strings.
-            # Dat contents will be running binary.
-            cat_lines = []
-            dat_binary = bytearray()
-
-            # Get the current time since epoch, as an integer, then
-            #  swap to a string (normal base 10).
-            timestamp = str(int(time.time()))
-
-            # Collect info from the files.
-            # Note: this may generate nothing if no game files were added,
-            #  eg. when making dummy catalogs.
-            for game_file in self.game_files:
-
-                # If just wanting standard or sig files, filter the
-                # others out.
-                if mode == 'std' and isinstance(game_file, Signature_File):
-                    continue
-                if mode == 'sig' and not isinstance(game_file, Signature_File):
-                    continue
-
-                # Get the binary data; any text should be utf-8.
-                this_binary = game_file.Get_Binary(for_cat = True)
-                x = bytes(this_binary)
-
-                # Append to the existing dat binary.
-                dat_binary += this_binary
-
-                # Get the hash.
-                hash_str = Get_Hash_String(this_binary)
-
-                # Add the cat entry line.
-                cat_lines.append( ' '.join([
-                    game_file.virtual_path,
-                    str(len(this_binary)),
-                    timestamp,
-                    hash_str,
-                    ]))
-
-
-            # The cat needs to end in a newline.
-            cat_lines.append('')
-
-            # Convert the cat to utf-8 binary.
-            # Note: x4 cats appear to use unix newlines, which this bytes()
-            # method will match.
-            cat_str = '\n'.join(cat_lines)
-            cat_binary = bytes(cat_str, encoding = 'utf-8')
-        
-            # Append a .sig to the names for signature files.
-            if mode == 'sig':
-                cat_path = self.cat_path.parent / (self.cat_path.name + '.sig')
-                dat_path = self.dat_path.parent / (self.dat_path.name + '.sig')
-            else:
-                cat_path = self.cat_path
-                dat_path = self.dat_path
-
-            # Write the data out.
-            with open(cat_path, 'wb') as file:
-                file.write(cat_binary)
-            with open(dat_path, 'wb') as file:
-                file.write(dat_binary)
+            mode_paths = {'all' : (self.cat_path, self.dat_path)}
+
+        # Write to temp files, swapped in at the end, so that an
+        # error partway through doesn't leave a broken catalog.
+        temp_paths = [path.with_name(path.name + '.tmp')
+                      for paths in mode_paths.values() for path in paths]
+
+        # Get the current time since epoch, as an integer, then
+        #  swap to a string (normal base 10).
+        timestamp = str(int(time.time()))
+
+        try:
+            # Cat lines and dat contents are streamed to their files
+            # as each game file is processed, so that only a few files'
+            # binaries need to be held at a time.
+            # Note: x4 cats appear to use unix newlines, so open in
+            # binary mode and write utf-8 lines with \n.
+            with ExitStack() as stack:
+                mode_files = {}
+                for mode, paths in mode_paths.items():
+                    mode_files[mode] = [
+                        stack.enter_context(open(path.with_name(path.name + '.tmp'), 'wb'))
+                        for path in paths]
+
+                # Collect info from the files, generating their binaries
+                # (possibly in parallel) in order.
+                # Note: this may generate nothing if no game files
+                #  were added, eg. when making dummy catalogs.
+                for game_file, this_binary in zip(game_files, Gen_Binaries(
+                        game_files, for_cat = True, num_workers = num_workers)):
+
+                    # Pick which cat/dat this goes to.
+                    if not separate_sigs:
+                        mode = 'all'
+                    elif isinstance(game_file, Signature_File):
+                        mode = 'sig'
+                    else:
+                        mode = 'std'
+                    cat_file, dat_file = mode_files[mode]
+
+                    # Write it to the dat, hashing along the way.
+                    hash_str = _Write_And_Hash(dat_file, this_binary)
+
+                    # Add the cat entry line.
+                    # The cat needs to end in a newline, so every
+                    # line gets one.
+                    cat_line = ' '.join([
+                        game_file.virtual_path,
+                        str(len(this_binary)),
+                        timestamp,
+                        hash_str,
+                        ]) + '\n'
+                    cat_file.write(bytes(cat_line, encoding = 'utf-8'))
+
+            # Swap in the finished files; see _Replace_Pair for how
+            # the pair is kept in step.
+            for cat_path, dat_path in mode_paths.values():
+                _Replace_Pair(cat_path, dat_path)
+
+        finally:
+            # Clean out any temp files left over from an error.
+            for path in temp_paths:
+                if path.exists():
+                    path.unlink()
 
         return
+
+
+def _Replace_Pair(cat_path, dat_path):
+    '''
+    Swaps the finished .tmp cat and dat files in over the given paths.
+    If the cat cannot be replaced after the dat was, the prior dat is
+    put back (or the new one removed, if there was none), so that an
+    old cat is not left pointing into a new dat with wrong offsets.
+
+    Note: two files cannot be swapped atomically. Between the moves
+    below there is a brief window where the old cat has no dat (moved
+    to .bak), and then where the new dat sits beside the old cat. If
+    the process is killed in that window, the pair can be left missing
+    its dat or mismatched, with the prior dat kept as .bak.
+    '''
+    dat_temp = dat_path.with_name(dat_path.name + '.tmp')
+    cat_temp = cat_path.with_name(cat_path.name + '.tmp')
+    dat_backup = dat_path.with_name(dat_path.name + '.bak')
+
+    # Move the prior dat aside, to restore on failure.
+    had_dat = dat_path.exists()
+    if had_dat:
+        os.replace(dat_path, dat_backup)
+    try:
+        os.replace(dat_temp, dat_path)
+        os.replace(cat_temp, cat_path)
+    except Exception:
+        if had_dat:
+            os.replace(dat_backup, dat_path)
+        elif dat_path.exists():
+            dat_path.unlink()
+        raise
+    if had_dat:
+        dat_backup.unlink()
+    return
+
+
+def _Write_And_Hash(file, binary, chunk_size = 1 << 20):
+    '''
+    Writes the binary to an open file in chunks, while computing its md5.
+    Returns the hash as a hex string, matching Get_Hash_String.
+    '''
+    hash = hashlib.md5()
+    view = memoryview(binary)
+    for offset in range(0, len(view), chunk_size):
+        chunk = view[offset : offset + chunk_size]
+        hash.update(chunk)
+        file.write(chunk)
+    return hash.hexdigest()
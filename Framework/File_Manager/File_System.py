@@ -2,22 +2,26 @@
     
 from pathlib import Path
 import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from lxml import etree as ET
 from functools import wraps
 import fnmatch
 from time import time
+from concurrent.futures import ThreadPoolExecutor
+import os
 import re
+import weakref
 
 from .Source_Reader import Source_Reader_class
 from .Cat_Writer import Cat_Writer
 from .File_Types import Misc_File, XML_File, Signature_File, Machine_Code_File
-from .File_Types import Generate_Signatures
+from .File_Types import Generate_Signatures, Gen_Binaries
 from ..Common import Settings
 from ..Common import File_Missing_Exception
 from ..Common import Customizer_Log_class
 from ..Common import Change_Log, Plugin_Log, Print
 from ..Common import home_path
+from ..Common import Path_Index
 
 
 class File_System_class:
@@ -52,12 +56,34 @@ class File_System_class:
       - Similar to asset_class_dict, except set up to satisfy the
         way x4 files can reference each other by "name" attribute
         without clarifying tag or "class".
+    * game_file_index
+      - Path_Index of the game_file_dict keys, for pattern lookups.
     * _patterns_loaded
       - Set of strings, virtual path name patterns that have been
         loaded and, when macros, added to class_macro_dict.
+    * file_use_order
+      - OrderedDict, keyed by virtual path of loaded files, holding their
+        memory estimates, ordered from least to most recently requested.
+      - Used for evicting files when over Settings.max_loaded_file_mb.
+    * loaded_memory_estimate
+      - Int, sum of memory estimates of files in file_use_order.
+    * evicted_files
+      - WeakValueDictionary of evicted Game_Files, keyed by virtual path.
+      - If an evicted file is still referenced elsewhere, it is put back
+        on its next request instead of being reloaded, so that there
+        is only ever one copy in use.
+    * evicted_assets
+      - Dict, keyed by virtual path of evicted asset files, holding
+        tuples of (root tag, asset_class_name_dict), so that asset
+        lookups can reload them.
+    * eviction_stats
+      - Dict of counters for tuning the memory budget:
+        'evictions', 'reloads' (evicted files read again), and
+        'restores' (evicted files put back while still referenced).
     '''
     def __init__(self):
         self.game_file_dict = {}
+        self.game_file_index = Path_Index()
         self.old_log = Customizer_Log_class()
         self.init_complete = False
         self.source_reader = Source_Reader_class()
@@ -66,7 +92,13 @@ class File_System_class:
         self.asset_class_dict = defaultdict(lambda: defaultdict(list))
         self.asset_name_dict = {}
         self._patterns_loaded = set()
-
+        self.file_use_order = OrderedDict()
+        self.loaded_memory_estimate = 0
+        self.evicted_files = weakref.WeakValueDictionary()
+        self.evicted_assets = {}
+        self._evicted_paths = set()
+        self._eviction_holds = 0
+        self.eviction_stats = {'evictions' : 0, 'reloads' : 0, 'restores' : 0}
         return
     
 
@@ -116,10 +148,19 @@ class File_System_class:
         returning to non-initialized state, etc.
         This will also reset the Live_Editor, since it is out of date.
         '''
+        # Release any open dat files (eg. memory maps) held by the
+        # old source reader before dropping it.
+        self.source_reader.Close()
         self.game_file_dict.clear()
+        self.game_file_index.Clear()
         self.asset_class_dict.clear()
         self.asset_name_dict.clear()
         self._patterns_loaded.clear()
+        self.file_use_order.clear()
+        self.loaded_memory_estimate = 0
+        self.evicted_files.clear()
+        self.evicted_assets.clear()
+        self._evicted_paths.clear()
         # Pending a reset option for these, just recreate the objects.
         self.old_log = Customizer_Log_class()
         self.source_reader = Source_Reader_class()
@@ -151,7 +192,17 @@ class File_System_class:
         Record a new a Game_File object, keyed by its virtual path.
         Returns the game_file, for convenience.
         '''
-        self.game_file_dict[game_file.virtual_path] = game_file
+        virtual_path = game_file.virtual_path
+        self.game_file_dict[virtual_path] = game_file
+        self.game_file_index.Add(virtual_path)
+
+        # Track for the memory budget.
+        if virtual_path in self.file_use_order:
+            self.loaded_memory_estimate -= self.file_use_order.pop(virtual_path)
+        memory_estimate = game_file.Get_Memory_Estimate()
+        self.file_use_order[virtual_path] = memory_estimate
+        self.loaded_memory_estimate += memory_estimate
+        self.evicted_assets.pop(virtual_path, None)
         
         # Check if the game_file is an xml file with a supported
         # asset tag, and updates the asset_class_dict if so.
@@ -174,30 +225,129 @@ class File_System_class:
         Note: this does not clear out any existing references to
         the file object that may have been recorded elsewhere.
         '''
+        # Forget any evicted copy as well.
+        self.evicted_files.pop(virtual_path, None)
+        self.evicted_assets.pop(virtual_path, None)
+        self._evicted_paths.discard(virtual_path)
+
         if virtual_path not in self.game_file_dict:
             return
+        self._Unregister_File(virtual_path)
+        return
 
+
+    def _Unregister_File(self, virtual_path):
+        '''
+        Removes a loaded file from the game_file_dict and other lookups.
+        Returns the removed game_file.
+        '''
         # Look up the game file.
-        game_file = self.Load_File(virtual_path)
+        game_file = self.game_file_dict[virtual_path]
         # Remove from the main file dict.
         self.game_file_dict.pop(virtual_path)
+        self.game_file_index.Remove(virtual_path)
+        # Signatures generated at write time aren't tracked here.
+        if virtual_path in self.file_use_order:
+            self.loaded_memory_estimate -= self.file_use_order.pop(virtual_path)
 
         # Also remove from anywhere else that might use it.
         # These will use a game_file object search.
-        for key, subdict in self.asset_class_dict.items():
-            for key2, sublist in subdict.items():
-                if game_file in sublist:
-                    sublist.remove(game_file)
-
-        for key, value in self.asset_name_dict.items():
-            if value is game_file:
-                # This should be okay to modify the dict if not continuing
-                # the loop further.
+        # Skip for non-assets, which are never recorded.
+        if isinstance(game_file, XML_File) and game_file.asset_class_name_dict != None:
+            for key, subdict in self.asset_class_dict.items():
+                for key2, sublist in subdict.items():
+                    if game_file in sublist:
+                        sublist.remove(game_file)
+
+            # A file may hold multiple assets, so check all names.
+            for key in [key for key, value in self.asset_name_dict.items()
+                        if value is game_file]:
                 self.asset_name_dict.pop(key)
+        return game_file
+
+
+    def _Enforce_Memory_Budget(self, keep_path = None):
+        '''
+        If the loaded files are estimated to exceed the memory budget
+        in Settings.max_loaded_file_mb, evicts the least recently used
+        files that can be reloaded from source (unmodified, unpinned,
+        and without forced xpath attributes) until back under budget.
+
+        * keep_path
+          - Optional virtual path of a file to not evict, eg. the one
+            just requested.
+        '''
+        max_mb = int(Settings.max_loaded_file_mb)
+        if max_mb <= 0 or self._eviction_holds:
+            return
+        max_bytes = max_mb * 2**20
+        if self.loaded_memory_estimate <= max_bytes:
+            return
+
+        for virtual_path in list(self.file_use_order):
+            if self.loaded_memory_estimate <= max_bytes:
                 break
+            if virtual_path == keep_path:
+                continue
+            game_file = self.game_file_dict[virtual_path]
+            # Only evict what can be rebuilt by reading the source again.
+            # Forced xpath attributes, set up by transforms, would be
+            #  lost on reload, changing later diffs.
+            if (game_file.modified
+            or game_file.pinned
+            or not game_file.from_source
+            or game_file.edit_in_place
+            or getattr(game_file, 'forced_xpath_attributes', None)):
+                continue
+
+            self._Unregister_File(virtual_path)
+            # Remember asset info, so asset lookups can reload it.
+            if isinstance(game_file, XML_File) and game_file.asset_class_name_dict != None:
+                self.evicted_assets[virtual_path] = (
+                    game_file.root_tag, game_file.asset_class_name_dict)
+            self.evicted_files[virtual_path] = game_file
+            self._evicted_paths.add(virtual_path)
+            self.eviction_stats['evictions'] += 1
+        return
+
+
+    def _Restore_Evicted_File(self, virtual_path):
+        '''
+        If the file on the given path was evicted but is still in use
+        elsewhere, puts it back into the game_file_dict.
+        Returns True if restored, else False.
+        '''
+        game_file = self.evicted_files.pop(virtual_path, None)
+        if game_file == None:
+            return False
+        self._evicted_paths.discard(virtual_path)
+        self.Add_File(game_file)
+        self.eviction_stats['restores'] += 1
+        return True
+
+
+    def _Restore_Modified_Evicted_Files(self):
+        '''
+        Puts back any evicted files that were since modified through
+        references held elsewhere, so that their changes get written.
+        '''
+        for virtual_path, game_file in list(self.evicted_files.items()):
+            if game_file.modified:
+                self._Restore_Evicted_File(virtual_path)
         return
 
 
+    def Get_Eviction_Stats(self):
+        '''
+        Returns a dict with the eviction_stats counters, plus the current
+        'loaded_mb' memory estimate and 'max_mb' budget.
+        '''
+        stats = dict(self.eviction_stats)
+        stats['loaded_mb'] = self.loaded_memory_estimate / 2**20
+        stats['max_mb'] = int(Settings.max_loaded_file_mb)
+        return stats
+
+
     def Get_Asset_File(self, name):
         '''
         Returns a loaded asset XML_File object with the corresponding
@@ -206,6 +356,12 @@ class File_System_class:
         
         Example: Get_Asset_File('weapon_tel_l_beam_01_mk1')
         '''
+        # Reload the file if it was evicted.
+        if name not in self.asset_name_dict:
+            for virtual_path, (tag, class_name_dict) in list(self.evicted_assets.items()):
+                if any(name in x for x in class_name_dict.values()):
+                    self.Load_File(virtual_path)
+                    break
         return self.asset_name_dict[name]
 
 
@@ -218,10 +374,21 @@ class File_System_class:
 
         Example: Get_Asset_Files('macros','bullet','missile')
         '''
-        ret_list = []
-        # Collect lists together.
-        for name in class_names:
-            ret_list += self.asset_class_dict[tag][name]
+        # Reload any matching files that were evicted, holding off
+        # on further evictions until the list is collected.
+        self._eviction_holds += 1
+        try:
+            for virtual_path, (evicted_tag, class_name_dict) in list(self.evicted_assets.items()):
+                if evicted_tag == tag and any(x in class_name_dict for x in class_names):
+                    self.Load_File(virtual_path)
+
+            ret_list = []
+            # Collect lists together.
+            for name in class_names:
+                ret_list += self.asset_class_dict[tag][name]
+        finally:
+            self._eviction_holds -= 1
+        self._Enforce_Memory_Budget()
         return ret_list
     
     
@@ -320,7 +487,9 @@ class File_System_class:
         #    if pattern == None or fnmatch(path, pattern):
         #        ret_list.append(game_file)
         # Speed up with filter().
-        paths = fnmatch.filter(self.game_file_dict.keys(), pattern.lower())
+        #paths = fnmatch.filter(self.game_file_dict.keys(), pattern.lower())
+        # Further speed up with an index.
+        paths = self.game_file_index.Filter(pattern.lower())
         return [self.game_file_dict[x] for x in paths]
     
 
@@ -331,6 +500,7 @@ class File_System_class:
             error_if_not_found = True,
             error_if_unmatched_diff = False,
             test_load = False,
+            readonly = False,
             ):
         '''
         Returns a Game_File subclass object for the given file, according
@@ -356,12 +526,25 @@ class File_System_class:
             any currently tracked version of it, and the results will
             not be recorded.
           - When in use, None is returned.
+        * readonly
+          - Bool, if True then the file is only going to be read, eg. by
+            an analysis, and setup only needed for editing (xml node ids)
+            is skipped.
+          - A later non-readonly request for the file, or a Get_Root call
+            on it, will finish the setup.
         '''
         # Standardize all virtual paths to lower case, forward slashes.
         # (Back slashes show up in some xml attribute paths, so converting
         # here makes those easier to manage.)
         virtual_path = virtual_path.lower().replace('\\','/')
 
+        # If the file was evicted but is still in use elsewhere, put
+        # it back instead of making a second copy.
+        if (virtual_path not in self.game_file_dict 
+        and not test_load
+        and virtual_path in self.evicted_files):
+            self._Restore_Evicted_File(virtual_path)
+
         # If the file is not loaded, handle loading.
         if virtual_path not in self.game_file_dict or test_load:
 
@@ -372,7 +555,8 @@ class File_System_class:
             game_file = self.source_reader.Read(
                 virtual_path, 
                 error_if_not_found = False,
-                error_if_unmatched_diff = error_if_unmatched_diff)
+                error_if_unmatched_diff = error_if_unmatched_diff,
+                delayed_init = False)
 
             # Problem if the file isn't found.
             if game_file == None:
@@ -380,23 +564,40 @@ class File_System_class:
                     raise File_Missing_Exception(('Error: Could not find file'
                             ' "{}", or file was empty').format(virtual_path))
                 return None
+
+            game_file.Delayed_Init(readonly = readonly)
         
             # Store the contents in the game_file_dict if not in testing.
             if not test_load:
                 assert game_file.virtual_path == virtual_path
                 self.Add_File(game_file)
+                if virtual_path in self._evicted_paths:
+                    self._evicted_paths.discard(virtual_path)
+                    self.eviction_stats['reloads'] += 1
             else:
                 return None
 
+        # If previously loaded as readonly, finish setup as needed.
+        elif not readonly:
+            self.game_file_dict[virtual_path].Make_Writable()
+
+        # Mark as recently used, and make room if needed.
+        if virtual_path in self.file_use_order:
+            self.file_use_order.move_to_end(virtual_path)
+            self._Enforce_Memory_Budget(keep_path = virtual_path)
+
         # Return the file contents.
         return self.game_file_dict[virtual_path]
     
 
-    def Load_Files(self, pattern):
+    def Load_Files(self, pattern, readonly = False):
         '''
         Searches for and loads in xml files following the given
         virtual_path wildcard pattern (lowercased internally).
         Returns a list of files loaded.
+
+        * readonly
+          - Bool, passed to Load_File for each file.
         '''
         # -Removed; skipping like this fails to fill the return list.
         ## Limit each pattern to running once.
@@ -409,12 +610,107 @@ class File_System_class:
 
         self._patterns_loaded.add(pattern)
 
+        virtual_paths = list(self.Gen_All_Virtual_Paths(pattern))
+
+        # Read any files not yet loaded in parallel; they get recorded
+        # in the game_file_dict in virtual_paths order.
+        new_virtual_paths = [x for x in virtual_paths 
+                             if x not in self.game_file_dict
+                             and x not in self.evicted_files]
+        num_workers = int(Settings.num_load_workers)
+        if num_workers <= 0:
+            num_workers = os.cpu_count() or 1
+        if num_workers > 1 and len(new_virtual_paths) > 1:
+            self._Load_Files_Threaded(new_virtual_paths, num_workers, readonly)
+
         # Load all files matching the pattern.
+        # (Those just loaded above will be quick lookups.)
+        # Hold off on evictions until all are collected.
         files = []
-        for virtual_path in self.Gen_All_Virtual_Paths(pattern):
-            files.append( self.Load_File(virtual_path) )
+        self._eviction_holds += 1
+        try:
+            for virtual_path in virtual_paths:
+                files.append( self.Load_File(virtual_path, readonly = readonly) )
+        finally:
+            self._eviction_holds -= 1
+        self._Enforce_Memory_Budget()
         return files
 
+
+    def _Load_Files_Threaded(self, virtual_paths, num_workers, readonly = False):
+        '''
+        Reads and records the given files, which should not be loaded yet,
+        using a pool of threads. Cat reads, md5 hashing, and lxml parsing
+        and patching release the GIL, so this gets some real overlap.
+        Files are recorded, and their plugin log and console messages
+        printed, in the order given, as for serial loading.
+        Errors are raised when their file is reached in that order.
+        '''
+        source_reader = self.source_reader
+
+        def Read_File(virtual_path):
+            '''
+            Reads the file, capturing messages. Returns a tuple of
+            (game_file, messages, exception), where messages is a list of
+            (printer, line, ext_currently_patching) tuples.
+            '''
+            messages = []
+            Plugin_Log.thread_local.logging_function = lambda line: messages.append(
+                (Plugin_Log, line, source_reader.ext_currently_patching))
+            Print.thread_local.logging_function = lambda line: messages.append(
+                (Print, line, source_reader.ext_currently_patching))
+            game_file = None
+            exception = None
+            try:
+                # Node ids are filled in by Delayed_Init from a shared
+                # counter, so leave that for the main thread.
+                game_file = source_reader.Read(
+                    virtual_path, 
+                    error_if_not_found = False,
+                    delayed_init = False)
+            except Exception as ex:
+                exception = ex
+            finally:
+                Plugin_Log.thread_local.logging_function = None
+                Print.thread_local.logging_function = None
+            return (game_file, messages, exception)
+
+        executor = ThreadPoolExecutor(max_workers = num_workers)
+        try:
+            futures = [executor.submit(Read_File, x) for x in virtual_paths]
+
+            for virtual_path, future in zip(virtual_paths, futures):
+                game_file, messages, exception = future.result()
+
+                # Replay messages, restoring the extension being patched
+                # at the time, for any log monitors that check it.
+                for printer, line, ext_currently_patching in messages:
+                    source_reader.ext_currently_patching = ext_currently_patching
+                    if printer is Print:
+                        Print(line)
+                    else:
+                        Plugin_Log.Print(line)
+                source_reader.ext_currently_patching = None
+
+                if exception != None:
+                    raise exception
+                
+                # Problem if the file isn't found (same as Load_File).
+                if game_file == None:
+                    raise File_Missing_Exception(('Error: Could not find file'
+                            ' "{}", or file was empty').format(virtual_path))
+
+                game_file.Delayed_Init(readonly = readonly)
+                assert game_file.virtual_path == virtual_path
+                self.Add_File(game_file)
+                if virtual_path in self._evicted_paths:
+                    self._evicted_paths.discard(virtual_path)
+                    self.eviction_stats['reloads'] += 1
+        finally:
+            # On error, don't bother with any remaining files.
+            executor.shutdown(wait = True, cancel_futures = True)
+        return
+
     
     @_Verify_Init
     def Get_Source_Reader(self):
@@ -445,6 +741,10 @@ class File_System_class:
          are not removed if the new run had an error during a transform.
         '''
         Print('Cleaning up old files')
+
+        # Release open dat files first, since a memory mapped dat
+        # cannot be deleted on windows. They will reopen if needed.
+        self.source_reader.Close()
         
         # Find all files generated on a prior run, that still appear to be
         #  from that run (eg. were not changed externally), and remove
@@ -519,6 +819,7 @@ class File_System_class:
         with a name conflict.
         '''
         Print('Writing output non-extension files')
+        self._Restore_Modified_Evicted_Files()
 
         # Loop over the files that were loaded.
         for file_name, file_object in self.game_file_dict.items():
@@ -567,6 +868,9 @@ class File_System_class:
               + (' (diff encoded)' if not Settings.make_maximal_diffs else ''))
         #Print('Output dir: {}'.format(Settings.Get_Output_Folder()))
 
+        # Pick up any edits made to evicted files.
+        self._Restore_Modified_Evicted_Files()
+
         # Add copies of leftover files from the user source folder.
         # Do this before the proper writeout, so it can reuse functionality.
         self.Add_Source_Folder_Copies()
@@ -598,7 +902,12 @@ class File_System_class:
         if Settings.generate_sigs:
             for game_file in Generate_Signatures(self.game_file_dict.values()):
                 self.game_file_dict[game_file.virtual_path] = game_file
+                self.game_file_index.Add(game_file.virtual_path)
 
+        # Loose files to write, as tuples of (game_file, file_path).
+        # These are collected first, so that xml binaries can be
+        # generated in parallel.
+        loose_writes = []
 
         # Loop over the files that were loaded.
         for file_name, file_object in self.game_file_dict.items():
@@ -650,18 +959,7 @@ class File_System_class:
                            ).format(file_path))
                     continue
 
-                # Write out the file, using the object's individual method.
-                file_object.Write_File(file_path)
-
-                # Add this to the log, post-write for correct hash.
-                # Only do this if not being edited in place, to avoid
-                # accidental deletion of the file on the next run.
-                if not file_object.edit_in_place:
-                    log.Record_File_Path_Written(file_path)
-
-                    # Refresh the log file, in case a crash happens during file
-                    #  writes, so this last write was captured.
-                    log.Store()
+                loose_writes.append((file_object, file_path))
 
             else:
                 # Add to a catalog writer.
@@ -671,6 +969,28 @@ class File_System_class:
                     cat_writer.Add_File(file_object)
 
 
+        # Generate the xml binaries, in loose_writes order.
+        xml_binaries = Gen_Binaries([x for x, _ in loose_writes 
+                                     if isinstance(x, XML_File)])
+
+        for file_object, file_path in loose_writes:
+            # Write out the file, using the object's individual method.
+            if isinstance(file_object, XML_File):
+                file_object.Write_File(file_path, binary = next(xml_binaries))
+            else:
+                file_object.Write_File(file_path)
+
+            # Add this to the log, post-write for correct hash.
+            # Only do this if not being edited in place, to avoid
+            # accidental deletion of the file on the next run.
+            if not file_object.edit_in_place:
+                log.Record_File_Path_Written(file_path)
+
+                # Refresh the log file, in case a crash happens during file
+                #  writes, so this last write was captured.
+                log.Store()
+
+
         # If anything was added to the cat_writers, do their writes.
         for writer in [cat_writer, subst_cat_writer]:
             if writer.game_files:
@@ -20,16 +20,28 @@ import os
 from lxml import etree as ET
 from copy import deepcopy
 from collections import OrderedDict, defaultdict
+from multiprocessing import Pool, cpu_count, get_start_method
 import fnmatch
 import time
+import re
+import zlib
 
 from ..Common import Plugin_Log
 from ..Common import Settings
 from ..Common import Print
+from ..Common import Path_Index
+from ..Common.XPath_Cache import XPath
 #Settings = Common.Settings
 from . import XML_Diff
 
 
+# Pattern for xpaths that start by selecting a root child by id or name,
+# eg. './ware[@id="energycells"]/price', capturing the tag, attribute,
+# value, and any remaining path.
+_keyed_xpath_re = re.compile(
+    r'''^\./([\w.-]+)\[@(id|name)=(?:"([^"]*)"|'([^']*)')\](.*)$''', re.S)
+
+
 def New_Game_File(binary, **kwargs):
     '''
     Creates and returns a Game_File, picking an appropriate subclass
@@ -121,6 +133,108 @@ def Generate_Signatures(game_file_list):
     return ret_list
 
 
+def Gen_Binaries(game_file_list, for_cat = False, num_workers = None):
+    '''
+    Generator which yields binaries for the given Game_Files, in order,
+    as returned by their Get_Binary methods.
+    XML files, which may need to generate diff patches, are handled
+    in a pool of worker processes that run ahead of the caller.
+    Any plugin log or console messages from the workers are reprinted
+    here, in file order.
+
+    * game_file_list
+      - List of Game_Files.
+    * for_cat
+      - Bool, passed to Get_Binary.
+    * num_workers
+      - Int, optional, number of processes to use.
+      - Defaults to Settings.num_write_workers, where 0 means one
+        per cpu core when worker processes are forked, else 1.
+    '''
+    if num_workers == None:
+        num_workers = int(Settings.num_write_workers)
+    # Only default to parallel when workers are forked; spawned workers
+    # pay to start up and import everything, which can outweigh gains.
+    if num_workers <= 0:
+        num_workers = cpu_count() if get_start_method() == 'fork' else 1
+
+    # Pick out the xml files; others are fast and stay here.
+    xml_files = [x for x in game_file_list if isinstance(x, XML_File)]
+
+    # Only bother with the pool if there is work to split up.
+    pool = None
+    if num_workers > 1 and len(xml_files) > 1:
+        # Workers may not inherit the current Settings (eg. when
+        # spawned instead of forked), so send them along.
+        settings_dict = {field : getattr(Settings, field) 
+                         for field in Settings.Get_Defaults()}
+        pool = Pool(processes = min(num_workers, len(xml_files)))
+        # Results come back in input order.
+        # The node id counter is sent along as well, so that nodes
+        # given new ids in the workers (eg. those added by transforms)
+        # don't reuse ids already in the pickled tables; spawned
+        # workers would otherwise restart it at 0.
+        xml_results = pool.imap(
+            _Generate_Binary_Worker, 
+            [(settings_dict, XML_Diff._running_id, x, for_cat) 
+             for x in xml_files])
+
+    try:
+        for game_file in game_file_list:
+            if pool != None and isinstance(game_file, XML_File):
+                binary, print_lines, log_lines = next(xml_results)
+                for line in print_lines:
+                    Print(line)
+                for line in log_lines:
+                    Plugin_Log.Print(line)
+            else:
+                binary = game_file.Get_Binary(for_cat = for_cat)
+            yield binary
+    finally:
+        if pool != None:
+            pool.terminate()
+    return
+
+
+def _Generate_Binary_Worker(inputs):
+    '''
+    Worker process function for Gen_Binaries, taking a tuple of
+    (settings_dict, running_id, game_file, for_cat), where running_id
+    is the main process XML_Diff node id counter.
+    Returns a tuple of (binary, print_lines, log_lines), with the
+    messages captured while generating the binary.
+    '''
+    settings_dict, running_id, game_file, for_cat = inputs
+    for field, value in settings_dict.items():
+        setattr(Settings, field, value)
+    # Keep new node ids above any already handed out.
+    XML_Diff._running_id = max(XML_Diff._running_id, running_id)
+
+    # Capture messages, to be printed by the main process.
+    print_lines = []
+    log_lines = []
+    Print.logging_function = print_lines.append
+    Plugin_Log.logging_function = log_lines.append
+
+    binary = game_file.Get_Binary(for_cat = for_cat)
+    return (binary, print_lines, log_lines)
+
+
+def _Build_Keyed_Node_Index(root):
+    '''
+    Support function for XML_File.Get_Keyed_Node_Index, building the
+    index for the given root.
+    '''
+    index = defaultdict(list)
+    for node in root.iterchildren(tag = ET.Element):
+        for attribute in ('id', 'name'):
+            value = node.get(attribute)
+            if value != None:
+                index[(node.tag, attribute, value)].append(node)
+    # Return a normal dict, so lookups of missing keys don't add to it.
+    return dict(index)
+
+
 class Game_File:
     '''
     Base class to represent a source file.
@@ -181,6 +295,10 @@ class Game_File:
       - Bool, True if this file experienced a load error.
       - Generally, error files should be skipped.
       - Primarily used for empty xml files.
+    * pinned
+      - Bool, if True then the File_System will keep this file loaded
+        even when over its memory budget.
+      - Modified files are always kept, pinned or not.
     '''
     def __init__(
             self,
@@ -204,6 +322,7 @@ class Game_File:
         self.file_source_path = file_source_path
         self.written = False
         self.load_error = False
+        self.pinned = False
 
         # Can determine substitution status based on the source
         # catalog name.
@@ -367,9 +486,29 @@ class Game_File:
         return other_file
 
 
-    def Delayed_Init(self):
+    def Get_Memory_Estimate(self):
+        '''
+        Returns a rough estimate of the memory used by this file's
+        contents, in bytes. Used for the File_System memory budget.
+        Subclasses should replace this as needed.
+        '''
+        return 0
+
+
+    def Delayed_Init(self, readonly = False):
         '''
         Placeholder function for running any post-merging init.
+
+        * readonly
+          - Bool, if True then the file is only expected to be read,
+            and setup needed only for editing may be skipped.
+        '''
+        return
+
+    def Make_Writable(self):
+        '''
+        Placeholder function for finishing any setup skipped by
+        a readonly Delayed_Init, prior to editing.
         '''
         return
 
@@ -410,11 +549,16 @@ class XML_File(Game_File):
     Attributes:
     * original_root
       - Element holding the original parsed xml, pre-patches, pre-transforms.
+      - Shared with the patched_root until a patch is applied, at which
+        point it is either copied or, unless Settings.keep_vanilla_xml
+        is set, released and read again from the source when requested.
     * patched_root
       - Element holding the diff patched root, pre-transforms.
     * modified_root
       - Element holding transformed xml, suitable for generating
         new diff patches.
+      - None until the first Update_Root; prior to that, the patched_root
+        serves as the current version.
     * root_tag
       - Tag name of the root node, for convenient referencing.
       - This is never expected to change across diff patches or transforms.
@@ -431,11 +575,42 @@ class XML_File(Game_File):
     * forced_xpath_attributes
       - String, similar to the option in Settings, these attributes or child
         xpath checks are added to any taken from Settings.
+    * readonly
+      - Bool, True if this file was set up for reading only, without
+        node ids filled into the patched_root.
+      - Cleared by Make_Writable, which is called automatically by
+        Get_Root and Update_Root.
+    * root_generations
+      - Dict, keyed by version ('vanilla', 'patched', 'current'), holding
+        an int bumped whenever that version of the xml changes, eg. on
+        Update_Root.
+      - Used to detect stale version caches.
+    * _version_caches
+      - Dict, keyed by (cache name, version), holding tuples of
+        (root, generation, value) for data derived from a version
+        of the xml, eg. the keyed node index.
+    * _node_id_tables
+      - OrderedDict, keyed by id() of a root element, holding tuples of
+        (root, node id table) for roots with XML_Diff node ids: the
+        patched_root, modified_root, and the most recently used copies
+        handed out by Get_Root (up to max_root_copy_tables).
     '''
     # For assets, the names of the asset group, and asset node tag.
     # Tag is generally or always the singular of a plural asset group.
     valid_asset_tags = {'macros'     : 'macro',
                         'components' : 'component'}
+    # Rough ratio of memory used by a parsed lxml tree to the size of
+    # the source xml text, for memory estimates.
+    # Note: intuitive guess based on lxml node overhead, not measured
+    # in detail.
+    xml_memory_ratio = 5
+    # Max number of Get_Root copies to keep node id tables for, in
+    # case they get passed to Update_Root. Copies whose tables were
+    # dropped can still be updated, but diff as if all their nodes
+    # were new.
+    # Note: transforms generally edit one copy at a time, with a few
+    # taking two copies of a file before updating both.
+    max_root_copy_tables = 4
     def __init__(
             self, 
             binary = None, 
@@ -444,6 +619,12 @@ class XML_File(Game_File):
         super().__init__(**kwargs)
         self.asset_class_name_dict = None
         self.forced_xpath_attributes = ''
+        self.readonly = False
+        self.root_generations = {'vanilla' : 0, 'patched' : 0, 'current' : 0}
+        self._version_caches = {}
+        self._node_id_tables = OrderedDict()
+        # Record the source size for memory estimates.
+        self.source_size = len(binary) if binary != None else 0
 
         # Should receive either the binary or the xml itself.
         assert binary != None or xml_root != None
@@ -452,7 +633,7 @@ class XML_File(Game_File):
             # Dummy files may have empty binary; handle specially.
             if len(binary) == 0:
                 Plugin_Log.Print(f'Error: empty xml format file: {self.virtual_path}')
-                self.original_root = None
+                self._original_root = None
             else:
                 # Process into an xml tree.
                 # Strip out blank text here, so that prettyprint works later.
@@ -464,44 +645,242 @@ class XML_File(Game_File):
                 # count that line, causing the sourceline attributes on nodes
                 # to be off. (This doesn't happen when using parse() on file
                 # objects.) No clear fix at this time.
-                self.original_root = ET.XML(
+                self._original_root = ET.XML(
                 binary,
                 parser = ET.XMLParser(remove_blank_text=True))
 
         elif xml_root != None:
             assert isinstance(xml_root, ET._Element)
-            self.original_root = xml_root
+            self._original_root = xml_root
             
-        if self.original_root != None:
+        if self._original_root != None:
             # Init the patched version to the original.
-            # Deepcopy this, since patching will edit it in place.
-            self.patched_root = deepcopy(self.original_root)
+            # This is shared until a patch is applied, to avoid a copy
+            # for the many files that never get patched.
+            self.patched_root = self._original_root
 
             # The root tag should never be changed by mods, so can
             #  record it here pre-patching.
-            self.root_tag = self.original_root.tag
+            self.root_tag = self._original_root.tag
         else:
             self.patched_root = None
             self.root_tag = None
             self.load_error = True
 
-        # Modified root starts as None; gets initialized sometime after
-        # Delayed_Init when Get_Root is called by a transform.
+        # Modified root starts as None; gets initialized when a transform
+        # first calls Update_Root.
         self.modified_root = None
         return
+
+
+    @property
+    def original_root(self):
+        # If the vanilla xml was released after patching, read it again.
+        if self._original_root == None and not self.load_error:
+            self._original_root = self._Read_Original_Root()
+        return self._original_root
+
+    @original_root.setter
+    def original_root(self, value):
+        self._original_root = value
+
+
+    def _Read_Original_Root(self):
+        '''
+        Returns the original root of this file as read fresh from the
+        source files, without extension patches, or None if not found.
+        '''
+        # Imported here to avoid a circular import.
+        from .File_System import File_System
+        game_file = File_System.source_reader.Read(
+            self.virtual_path,
+            error_if_not_found = False,
+            apply_patches = False,
+            delayed_init = False)
+        if game_file == None:
+            return None
+        return game_file.patched_root
+
+
+    def _Release_Original_Root(self):
+        '''
+        Support function called before the patched_root is changed
+        from the original_root. Makes sure the original_root is left
+        unaffected, either copying the tree or, if vanilla xml isn't
+        being kept, releasing it.
+        '''
+        if self.patched_root is not self._original_root:
+            return
+        if Settings.keep_vanilla_xml:
+            self.patched_root = deepcopy(self._original_root)
+        else:
+            self._original_root = None
+        return
+
+
+    def Set_Patched_Root(self, patched_root):
+        '''
+        Replaces the patched_root, eg. with patching results that were
+        cached from a prior run.
+        '''
+        self._Release_Original_Root()
+        self.patched_root = patched_root
+        self._Bump_Generation('patched')
+        return
+
+
+    def __getstate__(self):
+        '''
+        Support for pickling (eg. to send to worker processes), which
+        skips the version caches; they are quick to rebuild, and their
+        nodes would otherwise get pickled separately from their trees.
+        Node id tables are likewise packed into plain lists.
+        '''
+        state = self.__dict__.copy()
+        state['_version_caches'] = {}
+        state['_node_id_tables'] = OrderedDict()
+        state['_node_id_lists'] = {}
+        for attr in ['patched_root', 'modified_root']:
+            root = state[attr]
+            node_ids = self.Get_Node_IDs(root) if root != None else None
+            if node_ids != None:
+                state['_node_id_lists'][attr] = XML_Diff.Get_Node_ID_List(root, node_ids)
+        return state
+
+
+    def __setstate__(self, state):
+        '''
+        Support for unpickling, restoring node id tables.
+        '''
+        node_id_lists = state.pop('_node_id_lists', {})
+        self.__dict__.update(state)
+        for attr, id_list in node_id_lists.items():
+            root = getattr(self, attr)
+            self._Set_Node_IDs(root, XML_Diff.Set_Node_ID_List(root, id_list))
+        return
+
+
+    def Get_Node_IDs(self, root = None):
+        '''
+        Returns the XML_Diff node id table (dict keyed by element) for
+        a root of this file, or None if it has no ids (eg. the file is
+        still readonly).
+
+        * root
+          - Element, optional, the root to look up, either the patched
+            or modified root, or a copy returned by Get_Root.
+          - Defaults to the current root.
+        '''
+        if root == None:
+            root = self.Get_Root_Readonly()
+        entry = self._node_id_tables.get(id(root))
+        # Check identity, in case the id() was reused.
+        if entry == None or entry[0] is not root:
+            return None
+        # Note it as recently used.
+        self._node_id_tables.move_to_end(id(root))
+        return entry[1]
+
+
+    def _Set_Node_IDs(self, root, node_ids):
+        '''
+        Records the node id table for a root of this file.
+        '''
+        self._node_id_tables[id(root)] = (root, node_ids)
+        self._node_id_tables.move_to_end(id(root))
+        return
+
+
+    def _Prune_Node_IDs(self):
+        '''
+        Drops node id tables of the least recently used Get_Root copies,
+        keeping at most max_root_copy_tables of them.
+        '''
+        copy_keys = [key for key, (root, _) in self._node_id_tables.items()
+                     if root is not self.patched_root 
+                     and root is not self.modified_root]
+        for key in copy_keys[ : max(0, len(copy_keys) - self.max_root_copy_tables)]:
+            del self._node_id_tables[key]
+        return
+
+
+    def _Fill_Patched_Node_IDs(self):
+        '''
+        Fills in node ids for the patched_root, for any nodes lacking them.
+        '''
+        self._Set_Node_IDs(self.patched_root, XML_Diff.Fill_Node_IDs(
+            self.patched_root, self.Get_Node_IDs(self.patched_root)))
+        return
+
+
+    def _Bump_Generation(self, version):
+        '''
+        Records that the given version of the xml has changed, making
+        its version caches stale. Changes to the 'patched' version
+        also apply to 'current', which shows the patched xml until
+        a first Update_Root.
+        '''
+        self.root_generations[version] += 1
+        if version == 'patched':
+            self.root_generations['current'] += 1
+        return
+
+
+    def Get_Version_Cache(self, cache_name, version, build_function):
+        '''
+        Returns data derived from a version of the xml root, calling
+        build_function(root) to create it on first request or after
+        that version has changed (its root replaced or its generation
+        bumped). The data should be treated as read only.
+
+        * cache_name
+          - String, name of the cache, unique to the build_function.
+        * version
+          - String, version of the root, as in Get_Root_Readonly.
+        * build_function
+          - Function taking the root Element and returning the data.
+        '''
+        if not version:
+            version = 'current'
+        root = self.Get_Root_Readonly(version)
+        generation = self.root_generations[version]
+        key = (cache_name, version)
+        cached = self._version_caches.get(key)
+        if cached == None or cached[0] is not root or cached[1] != generation:
+            cached = (root, generation, build_function(root))
+            self._version_caches[key] = cached
+        return cached[2]
+
+
+    def Get_Keyed_Node_Index(self, version = 'current'):
+        '''
+        Returns a dict indexing the root's child elements by their 'id'
+        and 'name' attributes, keyed by (tag, attribute, value) tuples,
+        holding lists of matching nodes in document order.
+        Nodes should be considered read only.
+        '''
+        return self.Get_Version_Cache('keyed_nodes', version, _Build_Keyed_Node_Index)
     
     
-    def Delayed_Init(self):
+    def Delayed_Init(self, readonly = False):
         '''
         Fills in node ids for the patched_root, and any other delayed
         setup that needs to account for diff patches.
         This should be called once after all patching is finished.
+
+        * readonly
+          - Bool, if True then node ids are not filled in until
+            Make_Writable is called, saving time on files that are
+            only read.
         '''
         if self.load_error:
             return
 
         # Annotate the patched_root with node ids.
-        XML_Diff.Fill_Node_IDs(self.patched_root)
+        if readonly:
+            self.readonly = True
+        else:
+            self._Fill_Patched_Node_IDs()
         
         # Skip if the tag doesn't match supported asset types.
         # Note: diff patches will have a 'diff' root, and don't
@@ -568,6 +947,26 @@ class XML_File(Game_File):
 
             self.asset_class_name_dict[asset_class_name].append(asset_name)
         return
+
+
+    def Get_Memory_Estimate(self):
+        '''
+        Returns a rough estimate of the memory used by the parsed xml,
+        based on the source size.
+        '''
+        return self.source_size * self.xml_memory_ratio
+
+
+    def Make_Writable(self):
+        '''
+        If this file was set up as readonly, fills in the node ids
+        skipped earlier, so that it can be edited and diffed.
+        '''
+        if self.readonly:
+            self._Fill_Patched_Node_IDs()
+            self.readonly = False
+        return
+
     
     def Copy(self, new_path):
         '''
@@ -575,9 +974,11 @@ class XML_File(Game_File):
         Does not automatically add to the file system; use Add_File.
         '''
         assert new_path != self.virtual_path
+        # Note: the new file fills in its own node ids, so this skips
+        #  Get_Root and its id copying.
         return self.__class__(
             virtual_path = new_path,
-            xml_root = self.Get_Root(),
+            xml_root = deepcopy(self.Get_Root_Readonly()),
             )
 
     def Add_Forced_Xpath_Attributes(self, forced_xpath_attributes):
@@ -621,14 +1022,22 @@ class XML_File(Game_File):
         complete, as that is when the patched_root is first annotated
         and copied.
         '''
-        if self.modified_root == None:
-            # Set the initial modified tree to a deep copy of the patched
-            #  version; this will keep node_ids intact.
-            self.modified_root = deepcopy(self.patched_root)
-        # Return a deepcopy of the modified_root, so that a transform
-        #  can edit it safely, even if it exceptions out and doesn't
-        #  complete.
-        return deepcopy(self.modified_root)
+        # Node ids are needed for any changes to be diffed.
+        self.Make_Writable()
+        # Return a deepcopy of the current root, so that a transform can
+        #  edit it safely, even if it exceptions out and doesn't complete.
+        # The modified_root itself is only set up once the transform
+        #  calls Update_Root.
+        root = self.Get_Root_Readonly()
+        root_copy = deepcopy(root)
+        # Carry the node ids over to the copy, to be picked up by
+        #  Update_Root.
+        self._Set_Node_IDs(root_copy, XML_Diff.Copy_Node_IDs(
+            root, root_copy, self.Get_Node_IDs(root)))
+        # Limit how many copies hold on to tables, in case they are
+        #  only read and never updated.
+        self._Prune_Node_IDs()
+        return root_copy
 
 
     def Get_Root_Readonly(self, version = None):
@@ -658,21 +1067,28 @@ class XML_File(Game_File):
                                     ' recognized').format(version))
 
 
-    def Update_Root(self, element_root):
+    def Update_Root(self, element_root, node_ids = None):
         '''
         Update the current modified xml from an xml node, either Element
         or ElementTree. Flags this file as modified. Requires the root
         element type be unchanged.
+
+        * element_root
+          - The new root, normally a copy from Get_Root that was edited.
+        * node_ids
+          - Dict, optional, XML_Diff node id table for element_root.
+          - If not given, the table recorded by Get_Root is used, or
+            if element_root came from elsewhere then all of its nodes
+            are treated as new when diffing.
         '''
         # Error checks: make sure the returned element isn't any of the
         # existing nodes, which would indicate it was pulled as a
         # read only root.
+        # (Note: skip the original_root property, to avoid reading it
+        # back in if released.)
         if (element_root is self.patched_root 
-            or element_root is self.original_root 
-            or element_root is self.modified_root
-            # Backup check in case node ids go awry; the modified root
-            # should have been created.
-            or self.modified_root == None):
+            or element_root is self._original_root 
+            or element_root is self.modified_root):
             raise AssertionError('Attempted to Update_Root with a read-only'
                                  ' existing root.')
         # Ensure tags match up.
@@ -680,8 +1096,21 @@ class XML_File(Game_File):
         # wouldn't support complete xml replacements, it can catch
         # xml being written back from a different file (unless that
         # should be allowed).
-        assert element_root.tag == self.modified_root.tag
+        assert element_root.tag == self.Get_Root_Readonly().tag
+        # Node ids are needed on the patched_root to diff against.
+        self.Make_Writable()
+        if node_ids == None:
+            node_ids = self.Get_Node_IDs(element_root)
+        if node_ids == None:
+            node_ids = {}
+        # Retire the table of the prior modified_root; other copies
+        #  from Get_Root may still get passed here later, so keep
+        #  their tables.
+        if self.modified_root != None:
+            self._node_id_tables.pop(id(self.modified_root), None)
+        self._Set_Node_IDs(element_root, node_ids)
         # Assume the xml changed from the patched version.
+        self._Bump_Generation('current')
         self.modified = True
         self.modified_root = element_root
         return
@@ -695,9 +1124,34 @@ class XML_File(Game_File):
         Subclasses may offer special handling of this to speed up
         xpath searches on large xml files with regular structure
         for doing value lookups.
-        '''
+
+        Xpaths starting with a root child selected by id or name, eg.
+        './ware[@id="energycells"]/price', are accelerated using
+        the keyed node index.
+        '''
+        if not version:
+            version = 'current'
+        match = _keyed_xpath_re.match(xpath)
+        if match:
+            tag, attribute, value_dq, value_sq, remainder = match.groups()
+            value = value_dq if value_dq != None else value_sq
+            # Only handle a remainder that continues the path down
+            # from the matched node; anything else, eg. further predicates
+            # on it or unions, goes to full xpath.
+            if not remainder or (remainder[0] == '/' and '|' not in remainder):
+                nodes = self.Get_Keyed_Node_Index(version).get(
+                    (tag, attribute, value), [])
+                if not nodes:
+                    return []
+                if not remainder:
+                    return list(nodes)
+                # With multiple matches, let xpath sort out ordering
+                # and duplicates of the results.
+                if len(nodes) == 1:
+                    return XPath(nodes[0], '.' + remainder)
+
         root = self.Get_Root_Readonly(version)
-        nodes = root.xpath(xpath)
+        nodes = XPath(root, xpath)
         return nodes
 
 
@@ -719,13 +1173,22 @@ class XML_File(Game_File):
             forced_attributes += ','
         forced_attributes += self.forced_xpath_attributes
 
+        # Verify the patch, unless set up to only verify a sample of
+        # files (picked by path hash, to be consistent across runs).
+        verify_fraction = float(Settings.verify_diff_fraction)
+        verify = (verify_fraction >= 1
+                  or zlib.crc32(self.virtual_path.encode()) % 1000 
+                     < verify_fraction * 1000)
+
         patch_node = XML_Diff.Make_Patch(
             original_node = self.patched_root, 
             modified_node = self.Get_Root_Readonly(),
+            original_ids = self.Get_Node_IDs(self.patched_root),
+            modified_ids = self.Get_Node_IDs(),
             forced_attributes = forced_attributes,
             maximal = Settings.make_maximal_diffs,
             shorten_xpaths = Settings.shorten_xpaths,
-            verify = True)
+            verify = verify)
 
         if Settings.profile:
             Print('XML_Diff.Make_Patch for {} time: {:.2f}'.format(
@@ -777,9 +1240,13 @@ class XML_File(Game_File):
         return binary
 
 
-    def Write_File(self, file_path):
+    def Write_File(self, file_path, binary = None):
         '''
         Write these contents to the target file_path.
+
+        * binary
+          - Optional, binary to write, if already generated with
+            Get_Binary (eg. through Gen_Binaries).
         '''
         # Create the directory as needed.
         if not file_path.parent.exists():
@@ -787,7 +1254,8 @@ class XML_File(Game_File):
 
         # Do a binary write. Get binary first, in case of error, then
         # open the file to write.
-        binary = self.Get_Binary()
+        if binary == None:
+            binary = self.Get_Binary()
         with open(file_path, 'wb') as file:
             file.write(binary)
         return
@@ -818,8 +1286,13 @@ class XML_File(Game_File):
                 ).format(self.root_tag, other_file.root_tag,
                     self.virtual_path, other_file.extension_name))
             
-        # Preserve this root as the original.
-        other_file.original_root = self.original_root
+        # Preserve this root as the original, unless not keeping
+        # vanilla xml, in which case it can be read again (from the
+        # same place as this file) when needed.
+        if Settings.keep_vanilla_xml:
+            other_file.original_root = self.original_root
+        else:
+            other_file.original_root = None
         
         # Based on x4 log errors, it seems that it will handle
         #  diff xmls (when fed as an original file or substitution)
@@ -835,6 +1308,16 @@ class XML_File(Game_File):
         return other_file
 
 
+    def Get_Patch_Ops(self):
+        '''
+        For diff patch files, returns a tuple of XML_Diff.Patch_Ops to
+        apply to other files, compiled on first use; otherwise None.
+        '''
+        if self.root_tag != 'diff':
+            return None
+        return self.Get_Version_Cache('patch_ops', 'patched', XML_Diff.Compile_Patch)
+
+
     def Patch(self, other_xml_file):
         '''
         Merge another xml_file into this one.
@@ -852,9 +1335,14 @@ class XML_File(Game_File):
         # Note: the patched_node root may be replaced, so need to capture
         # the result and restore it (normally it will just be the same
         # patched_root object).
+        self._Release_Original_Root()
+        self._Bump_Generation('patched')
         self.patched_root = XML_Diff.Apply_Patch(
             original_node = self.patched_root, 
             patch_node    = other_xml_file.patched_root,
+            # Reuse compiled ops, for patch files applied repeatedly
+            # (eg. when checking extension load orders).
+            patch_ops     = other_xml_file.Get_Patch_Ops(),
             # For any errors, print out the file name, the patch extension
             # name. TODO: maybe include the already applied source
             # extension names, though that gets overly verbose.
@@ -881,18 +1369,9 @@ class XML_Text_File(XML_File):
     XML file holding game text.
     This provides functionality for looking up text references.
 
-    Attributes:
-    * page_text_dict
-      - Dict, keyed by 'page[id]' then 't[id]', holding the current
-        text values. Keys are kept as strings.
-      - Added to speed up performance compared to looking up
-        text each time in the xml with xpath.
-    * requests_until_refresh
-      - Int, how many text lookup requests may occurred since the
-        last page_text_dict reset (due to modification) before
-        an automatic refresh is triggerred.
-      - Used to prevent refreshing too often when fine grain
-        modifications occur.
+    Text lookups use a dict of the current text values, keyed by
+    'page[id]' then 't[id]', built on first use and rebuilt after
+    the xml is modified (see Get_Version_Cache).
     '''
     '''
     Note: for writing out wares to html, 16% of the long runtime
@@ -900,51 +1379,13 @@ class XML_Text_File(XML_File):
     to speed this process up. (This may have been influenced
     by using a .// style xpath, since reduced to ./ style.)
     '''
-    # Static value for how many requests are allowed before a refresh.
-    # One request may count multiple times if there are recursive
-    # text lookups, so don't make this too sensitive.
-    # Note: number is an intuitive guess, and wasn't tested for optimality.
-    # Note: setting 0 here will disable the refreshes.
-    requests_until_refresh_limit = 20
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.page_text_dict = defaultdict(dict)
-        self.requests_until_refresh = self.requests_until_refresh_limit
-        return
-
-
-    def Refresh_Cache(self):
-        '''
-        Reads the xml and sets up the page_text_dict.
-        This will need a rerun when the xml gets modified and a new
-        Read is requested, if it is to be beneficial.
-        '''
-        # Stop the counter.
-        self.requests_until_refresh = 0
-        # Skip early if the dict is already filled in.
-        if self.page_text_dict:
-            return
-        for page_node in self.Get_Root_Readonly().getchildren():
-            if page_node.tag != 'page':
-                continue
-            page_id = page_node.get('id')
-            for t_node in page_node.getchildren():
-                if t_node.tag != 't':
-                    continue
-                self.page_text_dict[page_id][t_node.get('id')] = t_node.text
-        return
-
-
-    def Update_Root(self, *args, **kwargs):
+    def Get_Page_Text_Dict(self):
         '''
-        Clears the page_text_dict when root is updated.
+        Returns a dict, keyed by 'page[id]' then 't[id]', holding the
+        current text values. Keys are kept as strings.
         '''
-        super().Update_Root(*args, **kwargs)
-        self.page_text_dict.clear()
-        # Set the refresh countdown.
-        self.requests_until_refresh = self.requests_until_refresh_limit
-        return
+        return self.Get_Version_Cache('page_text', 'current', 
+                                      _Build_Page_Text_Dict)
 
 
     def Read(
@@ -963,12 +1404,6 @@ class XML_Text_File(XML_File):
           - Int or string, page and id separated; give for direct
             dereference instead of a full text string.
         '''
-        # Maybe do a refresh of the page_text_dict.
-        if self.requests_until_refresh > 0:
-            self.requests_until_refresh -= 1
-            if self.requests_until_refresh <= 0:
-                self.Refresh_Cache()
-
         # Verify if text is given, it is just in brackets, and split it.
         if text != None:
             try:
@@ -988,21 +1423,27 @@ class XML_Text_File(XML_File):
             id = str(id)
             
         # Look up the entry.
-        # Use xpath if the page_text_dict is not ready,
-        # else use the dict for faster lookup.
-        ret_text = None
-        if self.page_text_dict:
-            try:
-                ret_text = self.page_text_dict[page][id]
-            except KeyError:
-                return
-        else:
-            nodes = self.Get_Root_Readonly().xpath(f'./page[@id="{page}"]/t[@id="{id}"]')
-            if not nodes:
-                return
-            ret_text = nodes[0].text
+        try:
+            return self.Get_Page_Text_Dict()[page][id]
+        except KeyError:
+            return
 
-        return ret_text
+
+def _Build_Page_Text_Dict(root):
+    '''
+    Support function for XML_Text_File, building its page_text_dict
+    from the given root.
+    '''
+    page_text_dict = defaultdict(dict)
+    for page_node in root.getchildren():
+        if page_node.tag != 'page':
+            continue
+        page_id = page_node.get('id')
+        for t_node in page_node.getchildren():
+            if t_node.tag != 't':
+                continue
+            page_text_dict[page_id][t_node.get('id')] = t_node.text
+    return page_text_dict
 
     
 class XML_Index_File(XML_File):
@@ -1012,59 +1453,19 @@ class XML_Index_File(XML_File):
     This will append a '.xml' extension to the looked up paths, since
     it is missing from the x4 source file paths.
 
-    Attributes:
-    * name_path_dict
-      - Dict, keyed by entry name, with the virtual_path to an
-        xml source file.
-      - Paths will be lower cased; name is kept in original case.
-    * requests_until_refresh
-      - Int, how many text lookup requests may occurred since the
-        last page_text_dict reset (due to modification) before
-        an automatic refresh is triggerred.
-      - Used to prevent refreshing too often when fine grain
-        modifications occur.
+    Lookups use a dict of name:path pairs and a Path_Index of the names,
+    built on first use and rebuilt after the xml is modified
+    (see Get_Version_Cache).
     '''
-    requests_until_refresh_limit = 5
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.name_path_dict = {}
-        self.requests_until_refresh = self.requests_until_refresh_limit
-        return
-
-    def Refresh_Cache(self):
-        '''
-        Reads the xml and sets up the name_path_dict.
-        This will need a rerun when the xml gets modified and a new
-        Get is requested, if it is to be beneficial.
-        '''
-        # Stop the counter.
-        self.requests_until_refresh = 0
-        # Skip early if the dict is already filled in.
-        if self.name_path_dict:
-            return
-        # Root is an <index> node, children are <entry> nodes.
-        for entry_node in self.Get_Root_Readonly().getchildren():
-            if entry_node.tag != 'entry':
-                continue
-            # Note: if a mod appends new entries to the index, they will
-            #  overwrite those earlier in the index, as described at
-            #  https://forum.egosoft.com/viewtopic.php?t=347831 .
-            # No warning will be printed here, as such cases are assumed
-            #  to be intentional.
-            self.name_path_dict[entry_node.get('name')] = entry_node.get('value').lower() + '.xml'
-        return
-
-
-    def Update_Root(self, *args, **kwargs):
+    def Get_Name_Path_Dict(self):
         '''
-        Clears the page_text_dict when root is updated.
+        Returns a tuple of (name_path_dict, name_index), where
+        name_path_dict is keyed by entry name, holding the virtual_path
+        to an xml source file, and name_index is a Path_Index of its keys.
+        Paths will be lower cased; name is kept in original case.
         '''
-        super().Update_Root(*args, **kwargs)
-        self.name_path_dict.clear()
-        # Set the refresh countdown.
-        self.requests_until_refresh = self.requests_until_refresh_limit
-        return
+        return self.Get_Version_Cache('name_path', 'current', 
+                                      _Build_Name_Path_Dict)
 
 
     def Find(self, name):
@@ -1072,24 +1473,8 @@ class XML_Index_File(XML_File):
         Returns the indexed path matching the given name, or None
         if the name is not found. Name is case sensitive.
         '''
-        # Maybe do a refresh of the name_path_dict.
-        if self.requests_until_refresh > 0:
-            self.requests_until_refresh -= 1
-            if self.requests_until_refresh <= 0:
-                self.Refresh_Cache()
-
-        # Do a normal or xpath lookup, depending on cache status.
-        # Name is not lowercased, to preserve it for the xpath.
-        if self.name_path_dict:
-            return self.name_path_dict.get(name, None)
-        else:
-            root = self.Get_Root_Readonly()
-            nodes = root.xpath('./entry[@name="{}"]'.format(name))
-            if not nodes:
-                value = nodes[0].get('value', None)
-                if value != None:
-                    return value.lower() + '.xml'
-        return None
+        name_path_dict, _ = self.Get_Name_Path_Dict()
+        return name_path_dict.get(name, None)
 
 
     def Findall(self, pattern):
@@ -1099,8 +1484,7 @@ class XML_Index_File(XML_File):
         Eg. Findall('ship_*') is expected to find every ship file path.
         Duplicates are ignored.
         '''
-        # Use the cached dict for this; ensure it is filled in.
-        self.Refresh_Cache()
+        name_path_dict, name_index = self.Get_Name_Path_Dict()
 
         # Seach the keys.
         #ret_list = []
@@ -1108,129 +1492,43 @@ class XML_Index_File(XML_File):
         #    if fnmatch(key, pattern):
         #        ret_list.add(value)
         # Switch to filter() for speed.
-        keys = fnmatch.filter(self.name_path_dict.keys(), pattern.lower())
+        #keys = fnmatch.filter(self.name_path_dict.keys(), pattern.lower())
+        # Further speed up with an index.
+        keys = name_index.Filter(pattern.lower())
         # TODO: is the set cast needed?
-        return set([self.name_path_dict[x] for x in keys])
+        return set([name_path_dict[x] for x in keys])
 
 
-class XML_Wares_File(XML_File):
+def _Build_Name_Path_Dict(root):
     '''
-    The libraries/wares.xml file. This has some functionality for
-    speeding up xpath reads.
-
-    Attributes:
-    * version_ware_node_dict
-      - Dict, keyed by version then by 'ware[id]', holding the node for
-        each ware.
-      - Added to speed up performance compared to looking up
-        nodes each time in the xml with xpath, when the xpaths
-        have ware id qualifiers.
-    * requests_until_refresh
-      - Int, how many text lookup requests may occurred since the
-        last ware_node_dict reset (due to modification) before
-        an automatic refresh is triggerred.
-      - Used to prevent refreshing too often when fine grain
-        modifications occur.
+    Support function for XML_Index_File, building its name_path_dict
+    and name_index from the given root.
     '''
+    name_path_dict = {}
+    # Root is an <index> node, children are <entry> nodes.
+    for entry_node in root.getchildren():
+        if entry_node.tag != 'entry':
+            continue
+        # Note: if a mod appends new entries to the index, they will
+        #  overwrite those earlier in the index, as described at
+        #  https://forum.egosoft.com/viewtopic.php?t=347831 .
+        # No warning will be printed here, as such cases are assumed
+        #  to be intentional.
+        name_path_dict[entry_node.get('name')] = entry_node.get('value').lower() + '.xml'
+    return (name_path_dict, Path_Index(name_path_dict))
+
+
+class XML_Wares_File(XML_File):
     '''
-    Note: this caching dropped the wares live editor object parsing
-    from 18 seconds down to 2, compared to using the full xpath
-    every time.
+    The libraries/wares.xml file.
+    Xpath lookups of wares by id, eg. './ware[@id="energycells"]/price',
+    are accelerated by the keyed node index in XML_File.Get_Xpath_Nodes.
+    Kept as its own class for compatibility with code that checks for it.
     '''
-    requests_until_refresh_limit = 5
-
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         assert self.virtual_path == 'libraries/wares.xml'
-        self.version_ware_node_dict = defaultdict(dict)
-        self.requests_until_refresh = self.requests_until_refresh_limit
-        return
-    
-
-    def Refresh_Cache(self):
-        '''
-        Reads the xml and sets up the ware_node_dict.
-        This will need a rerun when the xml gets modified and a new
-        Get_Xpath_Nodes is requested, if it is to be beneficial.
-        The 'vanilla' and 'patched' versions will be filled once
-        and never cleared.
-        '''
-        # Stop the counter.
-        self.requests_until_refresh = 0
-        for version in ['vanilla','patched','current']:
-            # Skip if already filled in.
-            if self.version_ware_node_dict[version]:
-                continue
-            # Convenience renaming.
-            this_dict = self.version_ware_node_dict[version]
-            # Loop over the wares.
-            for ware_node in self.Get_Root_Readonly(version).getchildren():
-                if ware_node.tag != 'ware':
-                    continue
-                # Store it by id.
-                this_dict[ware_node.get('id')] = ware_node
-        return
-
-
-    def Update_Root(self, *args, **kwargs):
-        '''
-        Clears version_ware_node_dict['current'] when root is updated.
-        '''
-        super().Update_Root(*args, **kwargs)
-        self.version_ware_node_dict['current'].clear()
-        # Set the refresh countdown.
-        self.requests_until_refresh = self.requests_until_refresh_limit
         return
-    
-
-    def Get_Xpath_Nodes(self, xpath, version = 'current'):
-        '''
-        Returns a list of nodes found using the given xpath on the given
-        version of the xml root. Defaults to the 'current' version.
-        Nodes should be considered read only.
-
-        If the xpath starts with the pattern './ware[@id="*"]/*', its
-        lookup will be accelerated.
-        '''
-        # Maybe do a refresh of the version_ware_node_dict.
-        if self.requests_until_refresh > 0:
-            self.requests_until_refresh -= 1
-            if self.requests_until_refresh <= 0:
-                # This will fill in all versions, which shouldn't
-                # have much overhead vs just one version, and saves
-                # this from having to have separate version countdowns.
-                self.Refresh_Cache()
-
-        # Check if the cache is ready.
-        ware_nodes = None
-        if self.version_ware_node_dict[version]:
-
-            # Check the xpath start.
-            if xpath.startswith('./ware[@id="'):
-                # Split out the id.
-                id, remainder = xpath.replace('./ware[@id="','').split('"]',1)
-
-                # If the remainder is empty or a '/', can continue,
-                # otherwise do a normal xpath since there are more
-                # qualifiers.
-                if not remainder or remainder[0] == '/':
-
-                    # Look up the node from the cache.
-                    ware_node = self.version_ware_node_dict[version].get(id)
-                    if ware_node != None:
-                        # If there is a remainder, reform it into a further
-                        #  xpath starting from the ware node.
-                        if remainder:
-                            new_xpath = '.' + remainder
-                            ware_nodes = ware_node.xpath(new_xpath)
-                        # Otherwise, just return this ware.
-                        else:
-                            ware_nodes = [ware_node]                               
-
-        # If nothing was found in the cache, do a normal lookup.
-        if not ware_nodes:
-            ware_nodes = super().Get_Xpath_Nodes(xpath, version)            
-        return ware_nodes
 
 
 # TODO: split this into separate text and binary versions.
@@ -1255,6 +1553,17 @@ class Misc_File(Game_File):
             self.binary = bytearray(binary)
         
 
+    def Get_Memory_Estimate(self):
+        '''
+        Returns the size of the binary or text.
+        '''
+        if self.binary != None:
+            return len(self.binary)
+        if self.text != None:
+            return len(self.text)
+        return 0
+
+
     def Get_Text(self):
         '''
         Returns the text for this file.
@@ -1330,7 +1639,9 @@ class Text_File(Misc_File):
         else:
             assert binary != None
             # Manually standardize newlines.
-            self.text = binary.decode().replace('\r\n','\n').replace('\r','\n')
+            # Note: catalog reads may hand over a memoryview, which
+            # lacks decode(), so go through bytes.
+            self.text = bytes(binary).decode().replace('\r\n','\n').replace('\r','\n')
     
     def Needs_Subst(self):
         # Shader files may need to be packed, else they are not found
@@ -1356,6 +1667,12 @@ class Machine_Code_File(Game_File):
         super().__init__(**kwargs)
         self.binary = bytearray(binary)
         return
+
+    def Get_Memory_Estimate(self):
+        '''
+        Returns the size of the binary.
+        '''
+        return len(self.binary)
     
     def Get_Output_Path(self):
         '''
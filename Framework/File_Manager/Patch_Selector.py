@@ -0,0 +1,351 @@
+'''
+Fast evaluation of diff patch "sel" xpaths.
+
+Apply_Patch normally runs every sel through lxml xpath on the whole
+tree, which scans all siblings at each step, and bogs down badly on
+indexed paths in large files (see notes in XML_Diff).
+
+Most real patches use a few simple shapes, eg.
+    /wares/ware[@id='x']/price
+    //macro[@name='y']/properties/hull
+    /wares/ware[@id='x']/@max
+    /jobs/job[5]
+
+Patch_Selector parses these shapes and resolves attribute equality
+predicates through per-tree (tag, attribute) -> value indexes, which
+are built lazily and kept up to date as patch ops edit the tree.
+Anything not recognized returns None from Select, and the caller
+should fall back to a normal xpath lookup.
+
+Matches are the same set of nodes xpath would find; ordering is only
+guaranteed to be document order for single-path child steps, which is
+all Apply_Patch needs (it requires exactly one match).
+XML_Diff.Selector_Unit_Test checks this against xpath on random sels.
+'''
+import re
+from functools import lru_cache
+from lxml import etree as ET
+
+__all__ = ['Patch_Selector', 'Parse_Sel']
+
+# Regex pieces for the supported path grammar.
+# Names are plain (no namespace prefix); '*' allowed on steps.
+_name = r'[A-Za-z_][\w.\-]*'
+_step_re = re.compile(r'(//|/)({0}|\*)((?:\[[^\[\]]*\])*)'.format(_name))
+_attrib_tail_re = re.compile(r'/@({0})$'.format(_name))
+_pred_re = re.compile(r'\[([^\[\]]*)\]')
+# Predicate bodies: @attr='value', @attr="value", @attr, or a position.
+_pred_eq_re = re.compile(
+    r'''\s*@({0})\s*=\s*(?:'([^']*)'|"([^"]*)")\s*$'''.format(_name))
+_pred_has_re = re.compile(r'\s*@({0})\s*$'.format(_name))
+_pred_pos_re = re.compile(r'\s*(\d+)\s*$')
+
+
+@lru_cache(maxsize = 2048)
+def Parse_Sel(xpath):
+    '''
+    Parse an absolute sel xpath into a tuple of steps and a final
+    attribute name (or None).
+    Each step is (descendant, tag, predicates), where predicates is
+    a tuple of ('eq', attr, value), ('has', attr) or ('pos', int).
+    Returns None if the xpath is not of a supported shape.
+    Results are cached, and should be treated as read only.
+    '''
+    attrib = None
+    match = _attrib_tail_re.search(xpath)
+    if match:
+        attrib = match.group(1)
+        xpath = xpath[ : match.start()]
+
+    steps = []
+    pos = 0
+    while pos < len(xpath):
+        match = _step_re.match(xpath, pos)
+        if not match:
+            return None
+        pos = match.end()
+        axis, tag, pred_text = match.groups()
+
+        predicates = []
+        for pred_body in _pred_re.findall(pred_text):
+            pred_match = _pred_eq_re.match(pred_body)
+            if pred_match:
+                attr, value_sq, value_dq = pred_match.groups()
+                value = value_sq if value_sq != None else value_dq
+                predicates.append(('eq', attr, value))
+                continue
+            pred_match = _pred_has_re.match(pred_body)
+            if pred_match:
+                predicates.append(('has', pred_match.group(1)))
+                continue
+            pred_match = _pred_pos_re.match(pred_body)
+            if pred_match:
+                predicates.append(('pos', int(pred_match.group(1))))
+                continue
+            # Something more complicated.
+            return None
+
+        # Positions on // steps are per-parent; leave those to xpath.
+        descendant = axis == '//'
+        if descendant and any(p[0] == 'pos' for p in predicates):
+            return None
+
+        steps.append((descendant, tag, tuple(predicates)))
+
+    if not steps:
+        return None
+    return tuple(steps), attrib
+
+
+def _Check(node, predicate):
+    '''
+    Returns True if the node passes a non-positional predicate.
+    '''
+    if predicate[0] == 'eq':
+        return node.get(predicate[1]) == predicate[2]
+    return node.get(predicate[1]) != None
+
+
+class Patch_Selector:
+    '''
+    Evaluates sel xpaths against a patching tree, keeping attribute
+    indexes in sync as patch ops are applied.
+
+    Usage: call Select for each op; if it returns None, use xpath.
+    Around each applied op, call Before_Op and After_Op (or Reset
+    if the op failed partway).
+
+    Attributes:
+    * root
+      - The temporary root element that sels are relative to; its
+        children are the actual document root.
+    * indexes
+      - Dict, keyed by (tag, attribute name), holding dicts of
+        attribute value to list of nodes with that tag and value.
+      - Entries may be stale (removed from the tree or changed), and
+        are verified on use, but every live matching node is present.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.indexes = {}
+        return
+
+
+    def Reset(self):
+        '''
+        Drop all indexes, eg. after a patch op failed partway and the
+        tree may have changed in untracked ways.
+        '''
+        self.indexes.clear()
+        return
+
+
+    def _Get_Index(self, tag, attr):
+        '''
+        Returns the value index for the given tag and attribute,
+        building it if needed.
+        '''
+        key = (tag, attr)
+        index = self.indexes.get(key)
+        if index == None:
+            index = {}
+            for node in self.root.iter(tag):
+                if node is self.root:
+                    continue
+                value = node.get(attr)
+                if value != None:
+                    index.setdefault(value, []).append(node)
+            self.indexes[key] = index
+        return index
+
+
+    def _Index_Nodes(self, nodes, recursive = True, remove = False):
+        '''
+        Add or remove the given nodes (and optionally their descendants)
+        in all existing indexes.
+        '''
+        for (tag, attr), index in self.indexes.items():
+            for node in nodes:
+                # Skip comments and similar.
+                if not isinstance(node.tag, str):
+                    continue
+                if recursive:
+                    matches = node.iter(tag)
+                elif node.tag == tag:
+                    matches = [node]
+                else:
+                    continue
+
+                for match in matches:
+                    value = match.get(attr)
+                    if value == None:
+                        continue
+                    if remove:
+                        entries = index.get(value)
+                        if entries:
+                            index[value] = [x for x in entries if x is not match]
+                    else:
+                        index.setdefault(value, []).append(match)
+        return
+
+
+    def Select(self, xpath):
+        '''
+        Returns a tuple of (nodes, attribute name) matched by the given
+        absolute sel xpath (relative to root), or None if the xpath
+        isn't supported.
+        When the xpath ends in an attribute, its name is returned, and
+        the nodes are the elements that have that attribute; otherwise
+        the attribute name is None.
+        '''
+        parsed = Parse_Sel(xpath)
+        if parsed == None:
+            return None
+        return self.Select_Parsed(parsed)
+
+
+    def Select_Parsed(self, parsed):
+        '''
+        As Select, but takes a sel already parsed by Parse_Sel.
+        '''
+        steps, attrib = parsed
+
+        context = [self.root]
+        for descendant, tag, predicates in steps:
+            if not context:
+                break
+
+            # Use an index when the step leads with an equality check,
+            # and has no positions (which need per-parent counting).
+            if (tag != '*' and predicates and predicates[0][0] == 'eq'
+            and not any(p[0] == 'pos' for p in predicates)):
+                _, attr, value = predicates[0]
+                candidates = self._Get_Index(tag, attr).get(value, [])
+                context_ids = set(id(x) for x in context)
+                matches = []
+                seen = set()
+                for node in candidates:
+                    # Verify the entry is current, and under the context.
+                    if node.get(attr) != value or id(node) in seen:
+                        continue
+                    if descendant:
+                        if not any(id(x) in context_ids
+                                   for x in node.iterancestors()):
+                            continue
+                    elif id(node.getparent()) not in context_ids:
+                        continue
+                    seen.add(id(node))
+                    matches.append(node)
+                remaining = predicates[1:]
+
+            else:
+                remaining = predicates
+                matches = []
+                if descendant:
+                    # Nested context nodes would give duplicates.
+                    seen = set()
+                    for parent in context:
+                        for node in (parent.iterdescendants()
+                                     if tag == '*' else
+                                     parent.iterdescendants(tag)):
+                            if id(node) not in seen and isinstance(node.tag, str):
+                                seen.add(id(node))
+                                matches.append(node)
+                else:
+                    # Positions are counted per-parent, so handle
+                    # predicates here in order.
+                    for parent in context:
+                        children = [x for x in (
+                                        parent.iterchildren()
+                                        if tag == '*' else
+                                        parent.iterchildren(tag))
+                                    if isinstance(x.tag, str)]
+                        for predicate in remaining:
+                            if predicate[0] == 'pos':
+                                index = predicate[1] - 1
+                                children = ([children[index]]
+                                            if 0 <= index < len(children)
+                                            else [])
+                            else:
+                                children = [x for x in children
+                                            if _Check(x, predicate)]
+                        matches.extend(children)
+                    remaining = ()
+
+            for predicate in remaining:
+                matches = [x for x in matches if _Check(x, predicate)]
+            context = matches
+
+        if attrib != None:
+            context = [x for x in context if x.get(attrib) != None]
+        return context, attrib
+
+
+    def Before_Op(self, op_node, target_node, optype):
+        '''
+        Prepare to apply a patch op to the target node; call After_Op
+        with the returned state once the op is done.
+        '''
+        # Nothing to maintain if no indexes are built yet.
+        if not self.indexes or optype == 'text':
+            return None
+
+        if optype == 'attrib':
+            # Pull the node out; it is re-added with new values after.
+            self._Index_Nodes([target_node], recursive = False, remove = True)
+            return ('attrib', target_node)
+
+        # Node edits. Removed subtrees get unindexed now, and added
+        # nodes are found afterward based on how the container's
+        # child count changed.
+        op = op_node.tag
+        pos = op_node.get('pos')
+        parent = target_node.getparent()
+        # Odd case, probably an error; don't try to track it.
+        if parent == None:
+            self.Reset()
+            return None
+        if op in ('remove', 'replace'):
+            self._Index_Nodes([target_node], remove = True)
+        if op == 'remove':
+            return None
+        if op == 'add' and pos in (None, 'prepend'):
+            container = target_node
+        else:
+            container = parent
+        # For replacements the target will be gone, so note its
+        # position now.
+        start_index = parent.index(target_node) if op == 'replace' else None
+        return ('node', op, pos, target_node, container, len(container), start_index)
+
+
+    def After_Op(self, state):
+        '''
+        Finish index maintenance for an applied patch op.
+        '''
+        if state == None:
+            return
+        if state[0] == 'attrib':
+            self._Index_Nodes([state[1]], recursive = False)
+            return
+
+        _, op, pos, target, container, start_len, start_index = state
+        num_added = len(container) - start_len
+
+        if op == 'replace':
+            # Replacements went where the removed target was.
+            num_added += 1
+            added = container[start_index : start_index + num_added]
+        elif pos == None:
+            added = container[len(container) - num_added : ]
+        elif pos == 'prepend':
+            added = container[ : num_added]
+        elif pos == 'before':
+            index = container.index(target)
+            added = container[index - num_added : index]
+        else:
+            index = container.index(target)
+            added = container[index + 1 : index + 1 + num_added]
+
+        self._Index_Nodes(added)
+        return
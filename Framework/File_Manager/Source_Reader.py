@@ -92,7 +92,8 @@ Note on case:
 '''
 from lxml import etree as ET
 from collections import OrderedDict, defaultdict
-import fnmatch
+from itertools import chain
+import threading
 from time import time
 
 from . import File_Types
@@ -101,9 +102,29 @@ from ..Common import Settings
 from ..Common import File_Missing_Exception, Unmatched_Diff_Exception
 from ..Common import File_Loading_Error_Exception
 from ..Common import Plugin_Log, Print
+from ..Common import Path_Index
+from ..Common import Disk_Cache
 from .Source_Reader_Local import Location_Source_Reader
 from .Extension_Finder import Find_Extensions
 
+# Version of the patched xml disk cache, included in its keys.
+# Bump this whenever patch application (eg. XML_Diff.Apply_Patch) or
+# the cached data format changes, so that older results get redone.
+patch_cache_version = 3
+
+def _Serialize_Root(root):
+    '''
+    Returns the xml text of a root element for the patched xml cache.
+    When the root is the top of its document, the whole document is
+    serialized, keeping any comments or processing instructions that
+    sit beside the root, which ET.XML will restore when parsing.
+    (Roots still nested under a patching temp node already lost them.)
+    '''
+    if root.getparent() == None:
+        return ET.tostring(root.getroottree())
+    return ET.tostring(root)
+
+
 class Source_Reader_class:
     '''
     Class used to find and read the highest priority source files,
@@ -126,15 +147,34 @@ class Source_Reader_class:
       - String, during xml patch application this is the name (folder) of the
         extension sourcing the patch.
       - For use by monitoring code.
+      - Tracked per thread, so that files read in parallel don't
+        mix up their values.
+    * patch_source_index
+      - Dict, keyed by mode ('substitution' or 'patch'), holding dicts
+        keyed by virtual_path, holding lists of the extension readers
+        which provide that file in that mode, in extension order.
+      - Substitutions come from 'subst_' catalogs; patches from 'ext_'
+        catalogs or loose files.
+      - Rebuilt whenever the extensions are sorted.
     '''
     def __init__(self):
         self.base_x4_source_reader    = None
         self.loose_source_reader      = None
         self.extension_source_readers = OrderedDict()
-        self.ext_currently_patching = None
+        self._thread_local = threading.local()
+        self.patch_source_index = {'substitution' : {}, 'patch' : {}}
         return
 
 
+    @property
+    def ext_currently_patching(self):
+        return getattr(self._thread_local, 'ext_currently_patching', None)
+
+    @ext_currently_patching.setter
+    def ext_currently_patching(self, value):
+        self._thread_local.ext_currently_patching = value
+
+
     # TODO: maybe merge this in with __init__, changing when the first
     # reader is created (eg. after Settings are set up).
     def Init_From_Settings(self):
@@ -344,6 +384,43 @@ class Source_Reader_class:
 
         # Store the sorted list.
         self.extension_source_readers = sorted_dict
+
+        # Update the patch index to match the new order.
+        self._Build_Patch_Source_Index()
+        return
+
+
+    def _Build_Patch_Source_Index(self):
+        '''
+        Fills in patch_source_index from the extension readers, in their
+        current order.
+        '''
+        if Settings.profile:
+            start = time()
+
+        patch_source_index = {
+            'substitution' : defaultdict(list), 
+            'patch'        : defaultdict(list),
+            }
+        for ext_reader in self.extension_source_readers.values():
+            # Substitutions only come from 'subst_' cats.
+            for virtual_path in ext_reader.Get_Cat_Virtual_Paths('subst_'):
+                patch_source_index['substitution'][virtual_path].append(ext_reader)
+
+            # Patches come from 'ext_' cats or loose files.
+            patch_paths = ext_reader.Get_Cat_Virtual_Paths('ext_')
+            patch_paths.update(ext_reader.Get_All_Loose_Files().keys())
+            for virtual_path in patch_paths:
+                patch_source_index['patch'][virtual_path].append(ext_reader)
+
+        # Swap to plain dicts, so lookups of other paths don't add entries.
+        self.patch_source_index = {mode : dict(path_readers_dict)
+            for mode, path_readers_dict in patch_source_index.items()}
+
+        if Settings.profile:
+            Print('Source_Reader._Build_Patch_Source_Index time: {:.3f} s'.format(
+                time() - start
+                ))
         return
 
 
@@ -439,6 +516,8 @@ class Source_Reader_class:
 
             # Cache the result, casting to set to uniquify paths.
             self._all_virtual_paths = set(path_list)
+            # Index for pattern lookups.
+            self._all_virtual_paths_index = Path_Index(self._all_virtual_paths)
 
             if Settings.profile:
                 Print('Source_Reader.Gen_All_Virtual_Paths build time: {:.3f} s'.format(
@@ -462,14 +541,15 @@ class Source_Reader_class:
                 start = time()
 
             # Note: it takes close to 1 second to do all fnmatches
-            # individually.  Use a fnmatch.filter instead to speed
-            # this up.
+            # individually, and fnmatch.filter was still slow; use
+            # the path index to only check likely candidates.
             #paths = [x for x in self._all_virtual_paths
             #         if fnmatch.fnmatch(x, pattern)]
-            paths = fnmatch.filter(self._all_virtual_paths, pattern)
+            #paths = fnmatch.filter(self._all_virtual_paths, pattern)
+            paths = self._all_virtual_paths_index.Filter(pattern)
 
             if Settings.profile:
-                Print('Source_Reader.Gen_All_Virtual_Paths fnmatch time: {:.3f} s'.format(
+                Print('Source_Reader.Gen_All_Virtual_Paths filter time: {:.3f} s'.format(
                     time() - start
                     ))
 
@@ -484,6 +564,8 @@ class Source_Reader_class:
             virtual_path,
             error_if_not_found = True,
             error_if_unmatched_diff = False,
+            delayed_init = True,
+            apply_patches = True,
         ):
         '''
         Returns a Game_File intialized with the contents read from
@@ -505,6 +587,16 @@ class Source_Reader_class:
           - Bool, if True a Unmatched_Diff_Exception will be thrown
             if the assumed base file is found to be a diff patch.
           - Default is to log an error and return None.
+        * delayed_init
+          - Bool, if True then the file's Delayed_Init is called once
+            patching completes.
+          - Set False when reading from worker threads, in which case
+            the caller should call Delayed_Init on the main thread,
+            since it assigns node ids from a shared counter.
+        * apply_patches
+          - Bool, if False then extension substitutions and patches are
+            skipped, returning the file as it was before them.
+          - Used to read vanilla xml on demand.
         '''
         # Always work with lowercase virtual paths.
         # (Note: this may have been done already in the File_System, but
@@ -518,6 +610,10 @@ class Source_Reader_class:
         # selected extension if present, else from the base x4 folder
         # or source folder.
         game_file = None
+        # Note which reader and local path supplied the file, for
+        # identifying it in the patched xml cache.
+        base_reader = None
+        base_path = None
         if virtual_path.startswith('extensions/'):
             # Can split on all '/' and take the second term for the
             # extension name, 3rd term for virtual path within that
@@ -531,7 +627,9 @@ class Source_Reader_class:
                 # TODO: consider instead giving the whole virtual_path
                 # and a base_file flag to let the location source reader
                 # deal with picking the path apart locally.
-                game_file = self.extension_source_readers[ext_name].Read(ext_path)
+                base_reader = self.extension_source_readers[ext_name]
+                base_path = ext_path
+                game_file = base_reader.Read(ext_path)
 
                 # Fix the virtual_path that was attached to the file.
                 # The reader only give its local path.
@@ -540,15 +638,19 @@ class Source_Reader_class:
 
         else:
             # Read from the source and base x4 locations.
+            base_path = virtual_path
             if self.loose_source_reader != None:
-                game_file = self.loose_source_reader.Read(virtual_path)
+                base_reader = self.loose_source_reader
+                game_file = base_reader.Read(virtual_path)
             if game_file == None:
-                game_file = self.base_x4_source_reader.Read(virtual_path)
+                base_reader = self.base_x4_source_reader
+                game_file = base_reader.Read(virtual_path)
 
             # Special case: if the game_file is not found, and it is a
             # text file, generate a dummy version of it. This is so that
             # extensions can add to 0001.xml, which doesn't normally exist.
             if game_file == None and virtual_path.startswith('t/'):
+                base_reader = None
                 game_file = File_Types.XML_Text_File(
                     virtual_path = virtual_path,
                     xml_root = ET.Element('language'),
@@ -590,6 +692,126 @@ class Source_Reader_class:
             return None
 
 
+        if not apply_patches:
+            if delayed_init:
+                game_file.Delayed_Init()
+            return game_file
+
+        # Check for a cached copy of the patching results from a prior
+        # run, if nothing involved has changed since then.
+        patch_cache_key = None
+        if (isinstance(game_file, File_Types.XML_File)
+        and not game_file.load_error
+        and Settings.use_disk_caches):
+            patch_cache_key = self._Get_Patch_Cache_Key(
+                virtual_path, game_file, base_reader, base_path)
+
+        if patch_cache_key != None:
+            cached = Disk_Cache.Load('patched_xml', virtual_path, patch_cache_key)
+            if cached != None:
+                (patched_binary, sourcelines, 
+                 source_extension_names, messages) = cached
+                # Replay any patching messages, eg. failed patch nodes,
+                # under the extension that caused them.
+                for ext_name, line in messages:
+                    self.ext_currently_patching = ext_name
+                    Plugin_Log.Print(line)
+                self.ext_currently_patching = None
+
+                # Parse the same way as original files, and put back
+                # the node sourcelines, for error messages.
+                patched_root = ET.XML(
+                    patched_binary,
+                    parser = ET.XMLParser(remove_blank_text=True))
+                for node, sourceline in zip(patched_root.iter(), sourcelines):
+                    if sourceline != None:
+                        node.sourceline = sourceline
+                game_file.Set_Patched_Root(patched_root)
+                game_file.source_extension_names = list(source_extension_names)
+                if delayed_init:
+                    game_file.Delayed_Init()
+                return game_file
+
+            # Capture messages during patching, to be cached, while
+            # still passing them along.
+            messages = []
+            prior_logging_function = getattr(
+                Plugin_Log.thread_local, 'logging_function', None)
+            def Record_Message(line):
+                messages.append((self.ext_currently_patching, line))
+                if prior_logging_function != None:
+                    prior_logging_function(line)
+                else:
+                    Plugin_Log.thread_local.logging_function = None
+                    try:
+                        Plugin_Log.Print(line)
+                    finally:
+                        Plugin_Log.thread_local.logging_function = Record_Message
+            Plugin_Log.thread_local.logging_function = Record_Message
+
+        try:
+            game_file = self._Apply_Patches(virtual_path, game_file)
+        finally:
+            if patch_cache_key != None:
+                Plugin_Log.thread_local.logging_function = prior_logging_function
+
+        if patch_cache_key != None:
+            Disk_Cache.Store('patched_xml', virtual_path, patch_cache_key,
+                (_Serialize_Root(game_file.patched_root),
+                 [x.sourceline for x in game_file.patched_root.iter()],
+                 game_file.source_extension_names,
+                 messages))
+
+        # Finish initializing the xml file once patching is complete.
+        if delayed_init:
+            game_file.Delayed_Init()
+
+        return game_file
+
+
+    def _Get_Patch_Cache_Key(self, virtual_path, game_file, base_reader, base_path):
+        '''
+        Returns a key identifying the inputs to patching the given
+        xml game_file, for use with the patched xml disk cache, made from
+        the customizer and patch cache versions, the fingerprint of the
+        base file, and the fingerprints of each patch in extension order.
+        Returns None if the file should not be cached, eg. when there
+        are no patches, or when substitutions are involved (which swap
+        out the game_file, and are rare).
+        '''
+        if base_reader != None:
+            base_fingerprint = base_reader.Get_File_Fingerprint(base_path)
+            if base_fingerprint == None:
+                return None
+        else:
+            # Generated dummy file.
+            base_fingerprint = ('generated',)
+
+        for ext_reader in self.patch_source_index['substitution'].get(virtual_path, []):
+            if ext_reader.extension_name != game_file.extension_name:
+                return None
+
+        patch_fingerprints = []
+        for ext_reader in self.patch_source_index['patch'].get(virtual_path, []):
+            if ext_reader.extension_name == game_file.extension_name:
+                continue
+            fingerprint = ext_reader.Get_File_Fingerprint(
+                virtual_path, include_loose_files = True, cat_prefix = 'ext_')
+            if fingerprint != None:
+                patch_fingerprints.append((ext_reader.extension_name, fingerprint))
+        if not patch_fingerprints:
+            return None
+
+        return (Common.Get_Version(), patch_cache_version,
+                base_fingerprint, tuple(patch_fingerprints))
+
+
+    def _Apply_Patches(self, virtual_path, game_file):
+        '''
+        Support function for Read, applying substitutions and patches
+        from extensions to the given game_file. Returns the resulting
+        game_file, which may differ from the input on substitution.
+        '''
         # Step 2: collect any patches/substitutions.
         # These can come from any extension, except the one the file
         #  was sourced from (if it came from an ext).
@@ -601,7 +823,8 @@ class Source_Reader_class:
             if game_file.load_error and mode == 'patch':
                 continue
 
-            for ext_reader in self.extension_source_readers.values():
+            # Only visit extensions known to provide this file.
+            for ext_reader in self.patch_source_index[mode].get(virtual_path, []):
 
                 # Skip if this ext is the original source.
                 # This should be harmless to allow, but saves a little time.
@@ -631,10 +854,8 @@ class Source_Reader_class:
                     else:
                         # For patches, want to search the 'ext_' catalogs and
                         # any loose files.
-                        ext_game_file = ext_reader.Read(
-                            virtual_path,
-                            include_loose_files = True,
-                            cat_prefix = 'ext_')
+                        # Diff patches get reused on later loads.
+                        ext_game_file = ext_reader.Read_Patch_File(virtual_path)
                         
                 # Catch File_Loading_Error_Exception errors here,
                 # to more reliably skip over problem patch files.
@@ -658,11 +879,21 @@ class Source_Reader_class:
 
         # Clear out the patching note.
         self.ext_currently_patching = None
+        return game_file
 
-        # Finish initializing the xml file once patching is complete.
-        game_file.Delayed_Init()
 
-        return game_file
+    def Close(self):
+        '''
+        Closes any open dat files held by the location readers, eg.
+        memory mapped dats. Reading may continue afterwards, reopening
+        the dats as needed.
+        '''
+        for reader in chain([ self.base_x4_source_reader, 
+                              self.loose_source_reader],
+                            self.extension_source_readers.values()):
+            if reader != None:
+                reader.Close()
+        return
 
 
     def Get_All_Loose_Source_Files(self):
@@ -1,5 +1,7 @@
 
 from pathlib import Path
+import os
+import threading
 from collections import OrderedDict, defaultdict
 from itertools import chain
 
@@ -10,6 +12,7 @@ from ..Common import Settings
 from ..Common import File_Missing_Exception
 from ..Common import File_Loading_Error_Exception
 from ..Common import Plugin_Log, Print
+from ..Common import Disk_Cache
 
 
 # Set a list of subfolders that are standard for x4 files.
@@ -39,6 +42,9 @@ valid_virtual_path_prefixes =  (
     'vulkan/',
     )
 
+# Lock used when creating Cat_Readers.
+_catalog_reader_lock = threading.Lock()
+
 class Location_Source_Reader:
     '''
     Class used to look up source files from a single location, such as the
@@ -79,6 +85,11 @@ class Location_Source_Reader:
         from each of the catalog readers.
     * all_virtual_paths
       - Set of all virtual paths in the catalogs or loose files.
+    * diff_patch_files
+      - Dict, keyed by virtual_path, holding tuples of (fingerprint,
+        XML_File) for diff patch files read through Read_Patch_File,
+        to be reused (along with their compiled patch ops) on
+        later reads.
     '''
     def __init__(
             self, 
@@ -95,6 +106,7 @@ class Location_Source_Reader:
         self.source_file_path_dict = None
         self.cat_path_entry_dict = None
         self.all_virtual_paths = None
+        self.diff_patch_files = {}
 
         # Search for cats and loose files if location given.
         if location != None:
@@ -197,55 +209,121 @@ class Location_Source_Reader:
         '''
         Finds all loose files at the location folder, recording
         them into self.source_file_path_dict.
+        When disk caches are enabled, results from a prior run are
+        reused if none of the walked directories changed their
+        modification times.
         '''
         self.source_file_path_dict = {}
 
-        # Dynamically find all files in the source folder.
-        # The glob pattern means: 
-        #  '**' (recursive search of directories, starting from current)
-        #  '/*' (all files or subdirs in that dir)
-        # Note: to limit overhead from looking at invalid paths, the
-        # outer loop would ideally be limited to the valid path prefixes,
-        # though glob is case sensitive so this might not work great.
-        # TODO: revisit this.
-        for path_prefix in valid_virtual_path_prefixes:
+        # Try the cache first.
+        file_paths = None
+        cache_key = (str(Path(location).resolve()), 
+                     self.is_extension, 
+                     valid_virtual_path_prefixes)
+        if Settings.use_disk_caches:
+            cache_data = Disk_Cache.Load('loose_files', cache_key[0], cache_key)
+            if cache_data != None:
+                dir_mtimes, file_paths = cache_data
+                # Adding, removing or renaming entries in a directory
+                # updates its mtime, so if all walked directories are
+                # unchanged, so are the files.
+                for dir_path, mtime in dir_mtimes.items():
+                    try:
+                        if os.stat(location / dir_path).st_mtime_ns != mtime:
+                            file_paths = None
+                            break
+                    except OSError:
+                        file_paths = None
+                        break
+
+        if file_paths == None:
+            dir_mtimes, file_paths = self._Walk_Loose_Files(location)
+            if Settings.use_disk_caches:
+                Disk_Cache.Store('loose_files', cache_key[0], cache_key,
+                                 (dir_mtimes, file_paths))
+
+        for file_path in file_paths:
+            # The relative part of the path will be the same as a
+            # virtual path once lowercased.
+            self.source_file_path_dict[file_path.lower()] = location / file_path
+        return
 
-            # Ignore the extensions folder if this is the base cat reader.
+
+    def _Walk_Loose_Files(self, location):
+        '''
+        Walks the location folder, finding loose files in the x4
+        subfolders (and exe files in the base folder when not an extension),
+        skipping sig files.
+        Returns a tuple of (dir_mtimes, file_paths), where dir_mtimes is a
+        dict of the mtimes of all walked directories keyed by path relative
+        to the location, and file_paths is a list of relative posix
+        style file paths in original case.
+        '''
+        dir_mtimes = {}
+        file_paths = []
+        if not os.path.isdir(location):
+            return (dir_mtimes, file_paths)
+
+        # Match top level folders to their prefixes. Use normcase to
+        # match the case sensitivity of the os, as glob did.
+        # Ignore the extensions folder if this is the base cat reader.
+        # Ignore the base folder for extensions.
+        normcase_prefix_dict = {}
+        for path_prefix in valid_virtual_path_prefixes:
             if not self.is_extension and path_prefix == 'extensions/':
                 continue
-            # Ignore the base folder for extensions.
             if self.is_extension and path_prefix == '':
                 continue
+            normcase_prefix_dict[os.path.normcase(path_prefix.rstrip('/'))] = path_prefix
+        exe_suffix = os.path.normcase('.exe')
+
+        # Real paths of the directories currently being walked.
+        # Symlinked folders are followed, as glob did, so this guards
+        # against links that loop back to a parent.
+        active_dirs = set()
+
+        def Walk(dir_path, rel_dir):
+            '''
+            Recursively record files under the given directory.
+            '''
+            real_path = os.path.realpath(dir_path)
+            if real_path in active_dirs:
+                return
+            active_dirs.add(real_path)
+            dir_mtimes[rel_dir] = os.stat(dir_path).st_mtime_ns
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    rel_path = rel_dir + '/' + entry.name
+                    if entry.is_dir():
+                        Walk(entry.path, rel_path)
+                    # Skip sig files; don't care about those.
+                    elif entry.is_file() and not entry.name.endswith('.sig'):
+                        file_paths.append(rel_path)
+            active_dirs.discard(real_path)
+            return
+
+        # Sort out the top level entries in one pass, then walk the
+        # subfolders in prefix order.
+        dir_mtimes[''] = os.stat(location).st_mtime_ns
+        prefix_dir_entries = {}
+        with os.scandir(location) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    path_prefix = normcase_prefix_dict.get(os.path.normcase(entry.name))
+                    if path_prefix:
+                        prefix_dir_entries[path_prefix] = entry
+                # Only exe files are picked up from the base folder.
+                elif ('' in normcase_prefix_dict
+                and entry.is_file()
+                and os.path.normcase(entry.name).endswith(exe_suffix)):
+                    file_paths.append(entry.name)
 
-            # Pick the globbing pattern.
-            # If a path_prefix is given, get everything under it.
-            # If no prefix given, just the flat directory, select files.
-            if path_prefix:
-                glob_pattern = path_prefix+'**/*'
-            else:
-                glob_pattern = '*.exe'
-
-            for file_path in self.location.glob(glob_pattern):
-                # Skip folders.
-                if not file_path.is_file():
-                    continue
-                # Skip sig files; don't care about those.
-                if file_path.suffix == '.sig':
-                    continue
-
-                # Isolate the relative part of the path.
-                # This will be the same as a virtual path once lowercased.
-                # Convert from Path to a posix style string (forward slashes).
-                virtual_path = file_path.relative_to(self.location).as_posix().lower()
-
-                # Skip if this doesn't start in an x4 subfolder.
-                if not any(virtual_path.startswith(x) 
-                           for x in valid_virtual_path_prefixes):
-                    continue
-
-                # Can now record it, with lower case virtual_path.
-                self.source_file_path_dict[virtual_path.lower()] = file_path
-        return
+        for path_prefix in valid_virtual_path_prefixes:
+            if path_prefix in prefix_dir_entries:
+                entry = prefix_dir_entries[path_prefix]
+                Walk(entry.path, entry.name)
+
+        return (dir_mtimes, file_paths)
 
 
     def Get_All_Loose_Files(self):
@@ -266,10 +344,25 @@ class Location_Source_Reader:
         creating it if necessary.
         '''
         if self.catalog_file_dict[cat_path] == None:
-            self.catalog_file_dict[cat_path] = Cat_Reader(cat_path)
+            # Lock in case of reads from multiple threads, rechecking
+            # once the lock is held.
+            with _catalog_reader_lock:
+                if self.catalog_file_dict[cat_path] == None:
+                    self.catalog_file_dict[cat_path] = Cat_Reader(cat_path)
         return self.catalog_file_dict[cat_path]
 
 
+    def Close(self):
+        '''
+        Closes any open dat files held by the catalog readers.
+        Readers are kept, and will reopen their dats on the next read.
+        '''
+        for cat_reader in self.catalog_file_dict.values():
+            if cat_reader != None:
+                cat_reader.Close()
+        return
+
+
     #def Get_All_Catalog_Readers(self):
     #    '''
     #    Returns a list of all Cat_Reader objects, opening them
@@ -307,6 +400,23 @@ class Location_Source_Reader:
         return self.cat_path_entry_dict
 
 
+    def Get_Cat_Virtual_Paths(self, cat_prefix = None):
+        '''
+        Returns a set of virtual paths found in catalogs at this location,
+        relative to the location.
+
+        * cat_prefix
+          - Optional string, prefix of catalog files to include.
+        '''
+        virtual_paths = set()
+        for cat_path in self.catalog_file_dict:
+            if cat_prefix and not cat_path.name.startswith(cat_prefix):
+                continue
+            cat_reader = self.Get_Catalog_Reader(cat_path)
+            virtual_paths.update(cat_reader.Get_Cat_Entries().keys())
+        return virtual_paths
+
+
     def Get_Virtual_Paths(self):
         '''
         Returns a set of all virtual paths used at this location
@@ -386,7 +496,84 @@ class Location_Source_Reader:
                 break
 
         return (cat_path, file_binary)
-    
+
+
+    def Get_File_Fingerprint(self,
+             virtual_path,
+             include_loose_files = True,
+             cat_prefix = None,
+             ):
+        '''
+        Returns a tuple identifying the contents of the file that Read
+        would return for the same arguments, without reading it, or None
+        if no file is found.
+        Catalog files are identified by their cat's md5 hash and size,
+        loose files by their path, size and modification time.
+        '''
+        virtual_path = virtual_path.lower()
+
+        # Search in the same order as Read.
+        search_order = ['cat', 'loose']
+        if Settings.prefer_single_files:
+            search_order.reverse()
+        if not include_loose_files:
+            search_order.remove('loose')
+
+        for source in search_order:
+            if source == 'loose':
+                if virtual_path in self.source_file_path_dict:
+                    file_key = Disk_Cache.Get_File_Key(
+                        self.source_file_path_dict[virtual_path])
+                    # Unexpected stat failure; treat as not found.
+                    if file_key == None:
+                        return None
+                    return ('loose',) + file_key
+            else:
+                for cat_path in self.catalog_file_dict:
+                    if cat_prefix and not cat_path.name.startswith(cat_prefix):
+                        continue
+                    cat_entry = self.Get_Catalog_Reader(cat_path
+                                    ).cat_entries.get(virtual_path)
+                    if cat_entry != None:
+                        return ('cat', cat_entry.hash_str, cat_entry.num_bytes)
+        return None
+
+
+    def Read_Patch_File(self, virtual_path):
+        '''
+        Returns a Game_File for a file patching the given virtual_path,
+        read as Read does from loose files and 'ext_' catalogs, or None
+        if not found.
+        Diff patch files are kept and returned again on later calls while
+        the source file is unchanged, and should be treated as read only.
+        '''
+        virtual_path = virtual_path.lower()
+        fingerprint = self.Get_File_Fingerprint(
+            virtual_path, include_loose_files = True, cat_prefix = 'ext_')
+
+        cached = self.diff_patch_files.get(virtual_path)
+        if cached != None and fingerprint != None and cached[0] == fingerprint:
+            game_file = cached[1]
+            # Keep the debug print the same as a real read.
+            if Settings.log_source_paths:
+                Plugin_Log.Print('Loaded file "{}" from "{}"'.format(
+                    virtual_path, game_file.file_source_path))
+            return game_file
+
+        game_file = self.Read(
+            virtual_path, include_loose_files = True, cat_prefix = 'ext_')
+
+        # Only diff patches are safe to reuse; other xml patches get
+        # their nodes moved into the patched file.
+        if (fingerprint != None
+        and isinstance(game_file, File_Types.XML_File)
+        and not game_file.is_substitution
+        and game_file.root_tag == 'diff'):
+            self.diff_patch_files[virtual_path] = (fingerprint, game_file)
+        else:
+            self.diff_patch_files.pop(virtual_path, None)
+        return game_file
+
 
     def Read(self, 
              virtual_path,
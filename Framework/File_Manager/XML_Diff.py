@@ -94,6 +94,18 @@ Note on patch generation approach:
         running id counter, that is sure to assign unique integer
         ids across all calls to id filling function.
 
+    Update: tail ids meant every print had to clear and restore all
+    tails (a full tree pass each way), pickling had to special case
+    the tail, and addnext() was unsafe. Node ids are now kept in a
+    side table instead: a dict keyed by element, holding int ids.
+    Since lxml keeps a python element proxy alive (and identical)
+    as long as something references it, the dict keys stay valid.
+    The tables are owned by whoever owns the tree (normally the
+    XML_File, per root version), and are passed to Make_Patch.
+    Deepcopies do not carry the ids, so Copy_Node_IDs remaps a
+    table onto a copy by walking both trees in parallel, and
+    Get_Node_ID_List/Set_Node_ID_List convert to and from a plain
+    document order list for pickling.
 '''
 '''
 Note on lxml and xpath bugginess:
@@ -131,13 +143,17 @@ Note on namespaces:
 '''
 from lxml import etree as ET
 from copy import deepcopy
-from itertools import zip_longest
+from itertools import zip_longest, islice
+from collections import namedtuple, deque
 import random
+import hashlib
 import time # Used for some profiling.
 
 from ..Common import Plugin_Log
 from ..Common import Print as Print_Log
 from ..Common.Exceptions import XML_Patch_Exception
+from ..Common.XPath_Cache import XPath
+from .Patch_Selector import Patch_Selector, Parse_Sel
 
 
 # Note: multiprocessing is used to speed up ware parsing,
@@ -149,20 +165,16 @@ import copyreg
 
 def LXML_Element_Pickler(element):
     'Pickle an lxml element.'
-    xml_string = ET.tostring(element, encoding = 'unicode')
+    # lxml bugs up when parsing a top element that has a tail, so
+    #  send the tail separately; it needs to be preserved since the
+    #  copied node may be from inside a tree.
+    xml_string = ET.tostring(element, encoding = 'unicode', with_tail = False)
     # Return format is a little funky; based on documentation.
-    return LXML_Element_Depickler, (xml_string,)
+    return LXML_Element_Depickler, (xml_string, element.tail)
 
-def LXML_Element_Depickler(xml_string):
+def LXML_Element_Depickler(xml_string, tail = None):
     'Depickle an lxml element.'
-    # Note: the node ids were attached to tails, but lxml bugs up
-    #  when parsing a top element that has a tail.
-    # As a workaround, manually remove the tail text, and reapply
-    #  it at the end. It needs to be preserved since the copied
-    #  node may be from inside a tree.
-    xml_bulk, tail = xml_string.rsplit('>',1)
-    xml_bulk += '>'
-    element = ET.fromstring(xml_bulk)
+    element = ET.fromstring(xml_string)
     element.tail = tail
     return element
 
@@ -173,42 +185,87 @@ copyreg.pickle(ET._Element, LXML_Element_Pickler, LXML_Element_Depickler)
 # Statically track the number of node id values assigned, and just
 # keep incrementing this.
 _running_id = 0
-def Fill_Node_IDs(xml_node):
+def Fill_Node_IDs(xml_node, node_ids = None):
     '''
-    For all elements, fill their tail property with a unique integer
-    node_id. Values remain unique throughput the python session.
-    Ids are unique across xml documents annotated.
-    If an id string is already in the tail, it will be left unchanged,
-    so it should be safe to call this on already annotated xml to
-    fill out ids for new nodes.
+    For all elements, record a unique integer node_id in a node id
+    table, a dict keyed by element. Values remain unique throughput
+    the python session, so ids are unique across xml documents annotated.
+    Returns the table.
+    Elements already in the table are left unchanged, so it should be
+    safe to call this on already annotated xml to fill out ids for
+    new nodes.
+
+    * xml_node
+      - Element to annotate, along with all of its descendants.
+    * node_ids
+      - Dict, optional, existing table to fill in. A new one is
+        created if not given.
     '''
     global _running_id
+    if node_ids == None:
+        node_ids = {}
     # Loop over the nodes, including comments.
     for node in xml_node.iter():
-        # If the tail is empty, fill it in.
-        if not node.tail:
-            node.tail = str(_running_id)
+        if node not in node_ids:
+            node_ids[node] = _running_id
             _running_id += 1
-    return xml_node
+    return node_ids
+
+
+def Copy_Node_IDs(source_node, copy_node, source_ids, copy_ids = None):
+    '''
+    Carry node ids from a tree over to a deepcopy of it, returning
+    the node id table for the copy.
+
+    * source_node
+      - Element that was copied.
+    * copy_node
+      - Element holding the unedited deepcopy of source_node.
+    * source_ids
+      - Dict, node id table of the source tree. May be None, in which
+        case the copy will have no ids.
+    * copy_ids
+      - Dict, optional, existing table to fill in for the copy.
+    '''
+    if copy_ids == None:
+        copy_ids = {}
+    if source_ids:
+        # Both trees have the same structure, so just walk them together.
+        for source, copy in zip(source_node.iter(), copy_node.iter()):
+            node_id = source_ids.get(source)
+            if node_id != None:
+                copy_ids[copy] = node_id
+    return copy_ids
+
+
+def Get_Node_ID_List(xml_node, node_ids):
+    '''
+    Returns a list of the node ids of xml_node and its descendants,
+    in document order, with None for nodes lacking ids.
+    Used to pickle node id tables alongside their tree.
+    '''
+    return [node_ids.get(node) for node in xml_node.iter()]
+
+
+def Set_Node_ID_List(xml_node, id_list, node_ids = None):
+    '''
+    Returns a node id table for xml_node built from a list made by
+    Get_Node_ID_List (on this tree or an identical one).
+    '''
+    if node_ids == None:
+        node_ids = {}
+    for node, node_id in zip(xml_node.iter(), id_list):
+        if node_id != None:
+            node_ids[node] = node_id
+    return node_ids
 
 
 def Print(xml_node, **kwargs):
     '''
     Returns the prettyprinted string for the xml_node.
-    Handles suppression of the node_id strings.
     Any kwargs are passed to ET.tostring.
     '''
-    # Back up all tails, and clear them.
-    node_id_dict = {}
-    for node in xml_node.iter():
-        node_id_dict[node] = node.tail
-        node.tail = None
-    # Print.
-    text = ET.tostring(xml_node, pretty_print = True, **kwargs)
-    # Put tails back.
-    for node, tail in node_id_dict.items():
-        node.tail = tail
-    return text
+    return ET.tostring(xml_node, pretty_print = True, **kwargs)
 
 
 # Fixed namespaces; assume unchanged.
@@ -243,11 +300,124 @@ def NS_xpath(node, xpath):
     '''
     Returns result of an xpath() lookup on the given node, after unqualifying
     the provided xpath string.
+    The compiled xpath is cached for reuse across patches.
     '''
-    return node.xpath(NS_unqualify(xpath), namespaces=namespaces)
+    return XPath(node, NS_unqualify(xpath), namespaces)
+
+
+# Diff patch operations, as parsed out of a diff patch node.
+# Fields:
+# * op_node: the original add/replace/remove node, holding the payload
+#   (children or text) and the 'pos'/'type' attributes.
+# * tag: the op_node tag.
+# * sourceline: line of the op_node, for error messages.
+# * silent: bool, if errors should be suppressed.
+# * xpath: the sel, with any trailing text() term removed.
+# * rel_xpath: xpath adjusted for lookup from the temporary root.
+# * parsed_sel: xpath as parsed by Patch_Selector, or None if unsupported.
+# * optype: 'node' or 'text' as determined from the sel; attribute ops
+#   are determined when matching.
+# * has_type: bool, True if the op has a 'type', eg. an attribute add.
+# * error: string, an error message if the op is malformed, else None.
+Patch_Op = namedtuple('Patch_Op', 
+    ['op_node', 'tag', 'sourceline', 'silent', 'xpath', 'rel_xpath',
+     'parsed_sel', 'optype', 'has_type', 'error'])
+
+
+def Compile_Patch(patch_node):
+    '''
+    Returns a tuple of Patch_Ops parsed out of a diff patch node,
+    for use by Apply_Patch. Comments are skipped.
+    The patch_node should not be modified while the ops are in use.
+    '''
+    patch_ops = []
+    for op_node in patch_node.getchildren():
+        # Skip comments.
+        if op_node.tag is ET.Comment:
+            continue
+
+        # X4 supports a "silent" attribute which suppresses error messages.
+        # TODO: is "true" the only case, or also "1"/etc.?
+        fields = {
+            'op_node'   : op_node,
+            'tag'       : op_node.tag,
+            'sourceline': op_node.sourceline,
+            'silent'    : op_node.get('silent') == "true",
+            'xpath'     : op_node.get('sel'),
+            'rel_xpath' : None,
+            'parsed_sel': None,
+            'optype'    : 'node',
+            'has_type'  : bool(op_node.get('type')),
+            'error'     : None,
+            }
+
+        # Unexpected node types are flagged as errors.
+        if op_node.tag not in ['add','replace','remove']:
+            fields['error'] = 'node type {} not recognized'.format(op_node.tag)
+
+        # All node types should have a 'sel' attribute with the
+        # desired xpath.
+        elif fields['xpath'] == None:
+            fields['error'] = '"sel" not found'
+
+        else:
+            xpath = fields['xpath']
+            # This gets a little messy here; the modification target
+            # could be a node, a node attribute, or a node's text.
+            # In any case, want to know the node itself being modified.
+            # Do this by picking off of the 'sel' the piece that edits
+            #  attributes or text, leaving just node selection.
+
+            # Determine the type of the op, text/attrib/node change.
+            # Can do this while isolating the xpath.
+
+            # Check for text edits.
+            for suffix in ['/text()[1]', '/text()']:
+                if xpath.endswith(suffix):
+                    fields['optype'] = 'text'
+                    xpath = xpath.replace(suffix, '')
+
+            # Check for attribute edits.
+            # These either end the xpath with '/@<name>' for remove/replace,
+            #  or have a 'type' property for adding.
+            # Note: the xpath search can continue past the ref,
+            #  eg. "@ref[.='scenario_combat_arg_destroyer']" in split dlc,
+            #  so for replacements the full path needs to be kept.
+            # Note: the additional conditions in the [] could also have
+            #  an attribute check; those should be ignored, since are not
+            #  part of an attribute changing op.
+            # -Removed check; look for a non-node being returned later.
+            #if '/@' in xpath:
+            #    optype = 'attrib'
+            #    if xpath.count('/@') != 1:
+            #        Print_Error('multiple "/@"')
+            #        continue
 
+            # The remaining xpath should hopefully work.
+            # Note: when switching from findall to xpath(), a
+            # prefixed '.' was needed to get this to work.
+            # Note: if the xpath is malformed, this will throw an exception
+            # when used.
+            # Note: this will support namespacing the xpath to some extent,
+            # just to enable modifying the schema path.
+            # Note: if the expression is in parentheses, put the '.' inside
+            # the first parenthesis.
+            fields['xpath'] = xpath
+            try:
+                if xpath[0] == '(':
+                    rel_xpath = xpath.replace('(','(.',1)
+                else:
+                    rel_xpath = '.' + xpath
+                fields['rel_xpath'] = rel_xpath
+                fields['parsed_sel'] = Parse_Sel(xpath)
+            except Exception as ex:
+                fields['error'] = 'xpath exception: {}'.format(ex)
 
-def Apply_Patch(original_node, patch_node, error_prefix = None):
+        patch_ops.append(Patch_Op(**fields))
+    return tuple(patch_ops)
+
+
+def Apply_Patch(original_node, patch_node, error_prefix = None, patch_ops = None):
     '''
     Apply a diff patch to the target xml node.
     Returns the modified node, a changed-in-place original_node, or
@@ -260,6 +430,9 @@ def Apply_Patch(original_node, patch_node, error_prefix = None):
     * error_prefix
       - Optional string, a prefix to put before any error messages.
       - Can be used to indicate the sources for the xml nodes.
+    * patch_ops
+      - Optional tuple of Patch_Ops, as from Compile_Patch(patch_node),
+        to reuse when the same diff is applied repeatedly.
     '''
     # Requires elements as inputs.
     assert isinstance(original_node, ET._Element)
@@ -295,22 +468,24 @@ def Apply_Patch(original_node, patch_node, error_prefix = None):
 
     else:
 
+        # Compile the ops if not given.
+        if patch_ops == None:
+            patch_ops = Compile_Patch(patch_node)
+
         # Small convenience function for printing errors in various
         # conditions.
         # TODO: note which extensions the files come from.
-        # TODO: maybe respect a "silent" attribute to suppress errors,
-        #  or maybe just suppress when checking extensions (done elsewhere).
-        def Print_Error(message):
+        def Print_Error(op, message):
             # X4 supports a "silent" attribute which suppresses error messages.
-            # Do the same here. TODO: is "true" the only case, or also "1"/etc.?
-            if op_node.get('silent') == "true":
+            # Do the same here.
+            if op.silent:
                 return
             Plugin_Log.Print(('{}Error: Problem occured when handling diff '
                 'node "{}" on line {}, xpath "{}"; skipping; error message: {}.'
                 ).format(
                     error_prefix,
-                    op_node.tag, op_node.sourceline, 
-                    xpath, message))
+                    op.tag, op.sourceline, 
+                    op.xpath, message))
             return
 
         # For patching purposes, to enable root replacement, nest
@@ -320,109 +495,73 @@ def Apply_Patch(original_node, patch_node, error_prefix = None):
         temp_root = ET.Element('root')
         temp_root.append(original_node)
         temp_tree = ET.ElementTree(temp_root)
+        selector = Patch_Selector(temp_root)
         
-        # Work through the patch operation nodes.
-        for op_node in patch_node.getchildren():
-            # Skip comments.
-            if op_node.tag is ET.Comment:
-                continue
-
-            # Skip unexpected node types.
-            if op_node.tag not in ['add','replace','remove']:
-                Print_Error('node type {} not recognized'.format(op_node.tag))
+        # Work through the patch operations.
+        for op in patch_ops:
+            # Skip ops that failed to compile.
+            if op.error:
+                Print_Error(op, op.error)
                 continue
 
-            # All node types should have a 'sel' attribute with the
-            # desired xpath.
-            xpath = op_node.get('sel')
-            if xpath == None:
-                Print_Error('"sel" not found')
-                continue
-
-            # This gets a little messy here; the modification target
-            # could be a node, a node attribute, or a node's text.
-            # In any case, want to know the node itself being modified.
-            # Do this by picking off of the 'sel' the piece that edits
-            #  attributes or text, leaving just node selection.
-
-            # Determine the type of the op, text/attrib/node change.
-            # Can do this while isolating the xpath.
-            optype = 'node'
-
-            # Check for text edits.
-            for suffix in ['/text()[1]', '/text()']:
-                if xpath.endswith(suffix):
-                    optype = 'text'
-                    xpath = xpath.replace(suffix, '')
-
-            # Check for attribute edits.
-            # These either end the xpath with '/@<name>' for remove/replace,
-            #  or have a 'type' property for adding.
-            # Note: the xpath search can continue past the ref,
-            #  eg. "@ref[.='scenario_combat_arg_destroyer']" in split dlc,
-            #  so for replacements the full path needs to be kept.
-            # Note: the additional conditions in the [] could also have
-            #  an attribute check; those should be ignored, since are not
-            #  part of an attribute changing op.
-            # -Removed check; look for a non-node being returned later.
-            #if '/@' in xpath:
-            #    optype = 'attrib'
-            #    if xpath.count('/@') != 1:
-            #        Print_Error('multiple "/@"')
-            #        continue
-
-            # The remaining xpath should hopefully work.
-            # Note: when switching from findall to xpath(), a
-            # prefixed '.' was needed to get this to work.
-            # Note: if the xpath is malformed, this will throw an exception.
-            # Note: this will support namespacing the xpath to some extent,
-            # just to enable modifying the schema path.
-            # Note: if the expression is in parentheses, put the '.' inside
-            # the first parenthesis.
-            try:
-                if xpath[0] == '(':
-                    rel_xpath = xpath.replace('(','(.',1)
-                else:
-                    rel_xpath = '.' + xpath
-                matched_nodes = NS_xpath(temp_tree, rel_xpath)
-            except Exception as ex:
-                Print_Error('xpath exception: {}'.format(ex))
-                continue
+            # Note: common simple sels are handled by the selector,
+            # with anything else falling back on xpath.
+            selected = None
+            if op.parsed_sel != None:
+                selected = selector.Select_Parsed(op.parsed_sel)
+            if selected != None:
+                matched_nodes, sel_attrib = selected
+            else:
+                sel_attrib = None
+                try:
+                    matched_nodes = NS_xpath(temp_tree, op.rel_xpath)
+                except Exception as ex:
+                    Print_Error(op, 'xpath exception: {}'.format(ex))
+                    continue
 
             # On match failure, skip the operation similar to how
             # X4 would skip it.
             if not matched_nodes:
-                Print_Error('no xpath match found')
+                Print_Error(op, 'no xpath match found')
                 continue
                     
             # Only one node should be returned, as per diff patch reqs.
             if len(matched_nodes) > 1:
-                Print_Error('multiple xpath matches found')
+                Print_Error(op, 'multiple xpath matches found')
                 continue
 
             # If a string attribute was returned (which happens for
             # attribute replacement paths), get the parent node.
+            # (The selector returns the parent node already.)
+            optype = op.optype
             matched_node = matched_nodes[0]
             if isinstance(matched_node, (str, ET._ElementUnicodeResult)):
                 matched_node = matched_node.getparent()
                 optype = 'attrib'
+            elif sel_attrib != None:
+                optype = 'attrib'
                 
             # Check for attribute additions.
             # These have a normal xpath, with a 'type' member holding
             #  the attribute name prefixed with @, eg. type="@id".
-            if op_node.get('type'):
+            if op.has_type:
                 optype = 'attrib'
 
             # Apply the patch op.
+            # Keep the selector indexes in sync with the changes; if the
+            # op failed partway, just have the selector start over.
             error_message = None
             try:
-                _Apply_Patch_Op(op_node, matched_node, optype)
+                selector_state = selector.Before_Op(op.op_node, matched_node, optype)
+                _Apply_Patch_Op(op.op_node, matched_node, optype)
+                selector.After_Op(selector_state)
             except Exception as ex:
                 error_message = f'{type(ex).__name__}: {ex}'
+                selector.Reset()
 
             # Print an error if it occurred.
             if error_message:
-                Print_Error(error_message)
+                Print_Error(op, error_message)
                 
 
         # Done with applying the patch.
@@ -564,12 +703,14 @@ def Make_Patch(
     verify = True, 
     maximal = True,
     shorten_xpaths = False,
+    original_ids = None,
+    modified_ids = None,
    ):
     '''
     Returns an xml diff node, suitable for converting from
     original_node to modified_node. Expects Fill_Node_IDs
-    to have been run on the original_node, and node_ids to have
-    been originally carried into modified_node.
+    to have been run on the original_node, and its node_ids to have
+    been carried into modified_node (eg. with Copy_Node_IDs).
 
     * forced_attributes
       - String or list of strings, optional, list of attributes (comma
@@ -584,6 +725,16 @@ def Make_Patch(
       - Used for testing of other functions.
     * shorten_xpaths
       - Bool, if True (and not maximal) then use // syntax to shorten xpaths.
+    * original_ids
+      - Dict, node id table for original_node (from Fill_Node_IDs).
+      - If not given, the original nodes get fresh ids, and nothing
+        in the modified_node will match them.
+    * modified_ids
+      - Dict, node id table for modified_node. Any nodes missing ids
+        (eg. newly created) are given new ones in this table.
+      - If the modified_node root lacks an id, it is given that of the
+        original_node, so that a missing table results in a larger
+        patch rather than an error.
     '''
     if maximal:
         # Set up a diff node as root.
@@ -621,12 +772,22 @@ def Make_Patch(
         #  the (copied) original xml will be edited with the changes, so
         #  that they are reflected in following xpaths.
         original_copy = deepcopy(original_node)
+        if original_ids == None:
+            original_ids = Fill_Node_IDs(original_node)
+        cfg['original_ids'] = Copy_Node_IDs(original_node, original_copy, original_ids)
+
+        # The roots always correspond; make sure the ids agree, in case
+        #  the modified ids were lost.
+        if modified_ids == None:
+            modified_ids = {}
+        if modified_ids.get(modified_node) == None:
+            modified_ids[modified_node] = original_ids.get(original_node)
         
         # Ensure the modified_node is fully filled in with node ids,
         #  since they are important when the nodes get inserted into
         #  the original_copy. (New nodes added since it was forked
         #  from the original would otherwise have no id.)
-        Fill_Node_IDs(modified_node)
+        cfg['modified_ids'] = Fill_Node_IDs(modified_node, modified_ids)
 
         # Get a list of op elements.
         # Prune out Nones.
@@ -696,7 +857,7 @@ def _Patch_Node_Constructor(
             # Pick off the first term
             throwaway, test_xpath = new_xpath.split('/',1)
             # Test it, with a preceeding //.
-            test_nodes = top_node.xpath('//' + test_xpath)
+            test_nodes = XPath(top_node, '//' + test_xpath)
             # If just the target node returned, then succesful truncation.
             if len(test_nodes) == 1 and test_nodes[0] is target:
                 #print('shortened to {}'.format(test_xpath))
@@ -767,18 +928,38 @@ def _Patch_Node_Constructor(
     return op_node
 
 
+def _Subtrees_Match(original_node, modified_node):
+    '''
+    Returns True if the two nodes have identical subtrees, in which
+    case no patch ops are needed between them.
+    '''
+    # Note: this compares serialized subtrees, which is done in C and
+    # is much faster than walking the nodes in python; an earlier
+    # version hashed every node of both trees in python, which took
+    # longer than the full recursion it was meant to skip.
+    # Differing attribute order will fail the match, but that just
+    # falls back on the normal recursion.
+    return (ET.tostring(original_node, with_tail = False)
+            == ET.tostring(modified_node, with_tail = False))
+
+
 def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
     '''
     Recursive function which will return a list of patch operation elements
     to convert from the original_node to the modified_node.
     Returns a list of elements (add, remove, or replace).
-    Input nodes are expected to have the same tail property.
+    Input nodes are expected to have the same node id.
     The original_node will be edited according to the patch op as this
     progresses, to ensure xpaths update accordingly mid patching.
     '''
-    # As a rule, the inputs will have the same tail, and
+    original_ids = cfg['original_ids']
+    modified_ids = cfg['modified_ids']
+    # As a rule, the inputs will have the same id, and
     # the recursive function will only be called when this is true.
-    assert original_node.tail == modified_node.tail
+    if original_ids.get(original_node) != modified_ids.get(modified_node):
+        raise XML_Patch_Exception(
+            'Mismatched node ids when generating patch for {}'.format(
+                original_node.tag))
 
     patch_nodes = []
 
@@ -850,8 +1031,10 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
     #  so the below code is designed to do all updates in one pass.
 
     # Grab the child lists.
-    orig_children = [x for x in original_node.iterchildren()]
-    mod_children  = [x for x in modified_node.iterchildren()]
+    # Note: these are consumed from the front, so use deques (lists
+    #  were slow on large child lists, eg. wares).
+    orig_children = deque(original_node.iterchildren())
+    mod_children  = deque(modified_node.iterchildren())
         
     # Loop while nodes remain in both lists.
     # Once one runs out, there are no more matches.
@@ -871,12 +1054,10 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                 target = original_node,
                 # Be sure to copy this to avoid xml node confusion,
                 # since this gets put in the patch tree.
-                # Note: this copies over the node id, so the patched
-                # orig child will now match at this position.
                 value  = deepcopy(mod_child),
                 cfg    = cfg ))
 
-            mod_children.remove(mod_child)
+            mod_children.popleft()
             continue
             
         # If there are no more mod_child nodes, then the orig_child
@@ -888,24 +1069,27 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                 target = orig_child,
                 cfg    = cfg ))
             
-            orig_children.remove(orig_child)
+            orig_children.popleft()
             continue
             
+        orig_child_id = original_ids.get(orig_child)
+        mod_child_id  = modified_ids.get(mod_child)
+
         # Something went wrong if both have None for node ids.
-        if orig_child.tail == None and mod_child.tail == None:
+        if orig_child_id == None and mod_child_id == None:
             raise XML_Patch_Exception('node ids not filled in well enough')
 
 
         # Check for a difference.
-        if orig_child.tail != mod_child.tail:
+        if orig_child_id != mod_child_id:
 
             # Want to know what happened.
             # Check if the mod_child is elsewhere later in the original.
-            mod_child_in_orig = any(mod_child.tail == x.tail 
-                                    for x in orig_children[1:])
+            mod_child_in_orig = any(mod_child_id == original_ids.get(x)
+                                    for x in islice(orig_children, 1, None))
             # Check if the orig_child is elsewhere in the child.
-            orig_child_in_mod = any(orig_child.tail == x.tail 
-                                    for x in mod_children[1:])
+            orig_child_in_mod = any(orig_child_id == modified_ids.get(x)
+                                    for x in islice(mod_children, 1, None))
 
             if mod_child_in_orig == True and orig_child_in_mod == False:
 
@@ -915,7 +1099,7 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                     target = orig_child,
                     cfg    = cfg ))
 
-                orig_children.remove(orig_child)
+                orig_children.popleft()
                 continue
             
             elif mod_child_in_orig == False and orig_child_in_mod == True:
@@ -932,7 +1116,7 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                     value  = deepcopy(mod_child),
                     cfg    = cfg ))
 
-                mod_children.remove(mod_child)
+                mod_children.popleft()
                 continue
 
             elif mod_child_in_orig == False and orig_child_in_mod == False:
@@ -945,8 +1129,8 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                     value  = deepcopy(mod_child),
                     cfg    = cfg ))
 
-                orig_children.remove(orig_child)
-                mod_children.remove(mod_child)
+                orig_children.popleft()
+                mod_children.popleft()
                 continue
 
             else:
@@ -959,11 +1143,11 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
                     target = orig_child,
                     cfg    = cfg ))
                 
-                orig_children.remove(orig_child)
+                orig_children.popleft()
                 continue
 
         else:
-            # Quick error check: if tails match, tags must match,
+            # Quick error check: if ids match, tags must match,
             # else something weird happened.
             if orig_child.tag != mod_child.tag:
                 raise Exception('Node pair found with same id but mismatched tags')
@@ -976,27 +1160,25 @@ def _Get_Patch_Ops_Recursive(original_node, modified_node, cfg):
         and orig_child.text != mod_child.text):
             # Pack the text in a Comment node.
             new_comment = ET.Comment(mod_child.text)
-            # Copy over the node id, else the next loop pass will
-            # replace it again. TODO: maybe unnecessary now that
-            # children aren't reiterated.
-            new_comment.tail = orig_child.tail
             patch_nodes.append(_Patch_Node_Constructor(
                 op     = 'replace', type = 'node',
                 target = orig_child,
                 value  = new_comment,
                 cfg    = cfg ))
             
-            orig_children.remove(orig_child)
-            mod_children.remove(mod_child)
+            orig_children.popleft()
+            mod_children.popleft()
             continue
 
 
         # If here, then the nodes appear to be the same, superficially.
         # Still need to handle deeper changes, so recurse and pick out
-        #  lower level patches.
-        patch_nodes += _Get_Patch_Ops_Recursive(orig_child, mod_child, cfg)
-        orig_children.remove(orig_child)
-        mod_children.remove(mod_child)
+        #  lower level patches, unless the subtrees are identical
+        #  (the common case when few nodes were edited).
+        if not _Subtrees_Match(orig_child, mod_child):
+            patch_nodes += _Get_Patch_Ops_Recursive(orig_child, mod_child, cfg)
+        orig_children.popleft()
+        mod_children.popleft()
 
     return patch_nodes
 
@@ -1211,6 +1393,17 @@ def Sort_Attributes(attr_names):
     return ret_list + low_prio_list
 
 
+def Get_Fingerprint(xml_node):
+    '''
+    Returns a digest of the xml_node and its descendants, which will
+    match between trees with the same tags, attributes (in any order),
+    text, and comments.
+    '''
+    # Canonical xml (c14n) sorts attributes, and the serialization is
+    # done in C, which is much faster than hashing nodes in python.
+    return hashlib.sha1(ET.tostring(xml_node, method = 'c14n')).digest()
+
+
 def Verify_Patch(original_node, modified_node, patch_node):
     '''
     Verify that the patch applied to the original recreates the modified
@@ -1219,6 +1412,13 @@ def Verify_Patch(original_node, modified_node, patch_node):
     # Copy the original, to do the patching without changing the input.
     original_node_patched = deepcopy(original_node)
     original_node_patched = Apply_Patch(original_node_patched, patch_node)
+
+    # Normally the trees are identical, which their fingerprints can
+    # confirm quickly. If not, fall back on the node by node comparison,
+    # which allows a few differences that don't matter (eg. namespaced
+    # attributes, tails) and finds where the mismatch is.
+    if Get_Fingerprint(original_node_patched) == Get_Fingerprint(modified_node):
+        return True
     
     # Line comparison works poorly if the attributes are out of
     # order, which can happen since the diff patch adds attributes to
@@ -1232,6 +1432,13 @@ def Verify_Patch(original_node, modified_node, patch_node):
     success = True
     # Compare by node, out to the longest list.
     for orig, mod in zip_longest(original_elements, modified_elements):
+
+        # If one tree ran out of nodes, they don't match.
+        if orig == None or mod == None:
+            Print_Log('Patch test failed; node counts differ ({} vs {}).'.format(
+                len(original_elements), len(modified_elements)))
+            success = False
+            break
     
         # Filter the attributes to remove namespaced ones, which will
         # be allowed to mismatch.
@@ -1289,7 +1496,7 @@ def Unit_Test(test_node, num_tests = 100, edits_per_test = 5, rand_seed = None):
         random.seed(rand_seed)
     assert isinstance(test_node, ET._Element)
     # Make sure the input is annotated with node ids.
-    Fill_Node_IDs(test_node)
+    test_node_ids = Fill_Node_IDs(test_node)
 
     test_number = 0
     while test_number < num_tests:
@@ -1297,6 +1504,7 @@ def Unit_Test(test_node, num_tests = 100, edits_per_test = 5, rand_seed = None):
 
         # Copy the test node, for a modifiable copy.
         modified_node = deepcopy(test_node)
+        modified_node_ids = Copy_Node_IDs(test_node, modified_node, test_node_ids)
 
         # Get a flattened list of all non-comment nodes.
         node_list = modified_node.xpath('.//*')
@@ -1380,8 +1588,139 @@ def Unit_Test(test_node, num_tests = 100, edits_per_test = 5, rand_seed = None):
                 test_node, 
                 modified_node, 
                 maximal = False,
-                verify = True)
+                verify = True,
+                original_ids = test_node_ids,
+                modified_ids = modified_node_ids)
             Print_Log('Test {} passed'.format(test_number))
         except XML_Patch_Exception as ex:
             Print_Log('Test {} failed; message: {}'.format(test_number, ex))
     return
+
+
+def Selector_Unit_Test(test_node, num_tests = 1000, rand_seed = None):
+    '''
+    Performs a test of the Patch_Selector by generating random sel
+    xpaths for nodes in test_node, and checking that the selector
+    finds the same nodes as a normal xpath lookup.
+    Sels include '//' steps, positions, '*' tags, and '/@attr' tails,
+    with some predicates picked to match nothing. Random attribute
+    edits and node removals are made along the way, to check that the
+    selector indexes are kept in sync.
+    Returns True if all tests passed, else False.
+
+    * test_node
+      - The xml node to test on. Will not be modified.
+    * num_tests
+      - Int, how many sels to test.
+    * rand_seed
+      - Int, optional, seed for the rng.
+    '''
+    if rand_seed != None:
+        random.seed(rand_seed)
+    assert isinstance(test_node, ET._Element)
+
+    # Set up the tree the same way as Apply_Patch.
+    temp_root = ET.Element('root')
+    temp_root.append(deepcopy(test_node))
+    temp_tree = ET.ElementTree(temp_root)
+    selector = Patch_Selector(temp_root)
+
+    success = True
+    for test_number in range(1, num_tests + 1):
+        node_list = temp_root.xpath('./*//*')
+        if not node_list:
+            break
+
+        # Occasionally edit the tree, tracked by the selector.
+        if random.random() < 0.1:
+            edit_node = random.choice(node_list)
+            if random.random() < 0.2:
+                state = selector.Before_Op(ET.Element('remove'), edit_node, 'node')
+                edit_node.getparent().remove(edit_node)
+            else:
+                state = selector.Before_Op(None, edit_node, 'attrib')
+                attrib_name = random.choice(edit_node.keys() or ['id'])
+                if random.random() < 0.3:
+                    edit_node.attrib.pop(attrib_name, None)
+                else:
+                    edit_node.set(attrib_name, str(random.randint(0, 3)))
+            selector.After_Op(state)
+            continue
+
+        xpath = _Random_Sel(random.choice(node_list), temp_root)
+        selected = selector.Select(xpath)
+        if selected == None:
+            # Unsupported shapes are fine, as long as they are rare.
+            Print_Log('Test {} unsupported sel: {}'.format(test_number, xpath))
+            continue
+        selector_nodes, _ = selected
+
+        xpath_nodes = NS_xpath(temp_tree, '.' + xpath)
+        # Attribute paths return strings; swap to their elements.
+        xpath_nodes = [x.getparent() if isinstance(x, str) else x 
+                       for x in xpath_nodes]
+
+        if (len(selector_nodes) != len(set(id(x) for x in selector_nodes))
+        or set(id(x) for x in selector_nodes) != set(id(x) for x in xpath_nodes)):
+            success = False
+            Print_Log('Test {} failed on sel {}; selector found {} nodes, xpath {}'.format(
+                test_number, xpath, len(selector_nodes), len(xpath_nodes)))
+
+    Print_Log('Selector test {}'.format('passed' if success else 'failed'))
+    return success
+
+
+def _Random_Sel(target_node, temp_root):
+    '''
+    Returns a random sel xpath leading to the target_node, under the
+    temp_root used in patching. May be made to match other or no nodes.
+    '''
+    # Get the chain of nodes from the document root to the target.
+    chain = [target_node] + [x for x in target_node.iterancestors()
+                             if x is not temp_root]
+    chain.reverse()
+
+    # Maybe start partway down, with a descendant step.
+    start = 0
+    if random.random() < 0.4:
+        start = random.randrange(len(chain))
+
+    steps = []
+    for index in range(start, len(chain)):
+        node = chain[index]
+        descendant = index == start and start > 0
+        tag = '*' if random.random() < 0.15 else node.tag
+
+        predicates = []
+        keys = node.keys()
+        if keys and random.random() < 0.6:
+            attrib_name = random.choice(keys)
+            value = node.get(attrib_name)
+            # Sometimes pick a value that won't match.
+            if random.random() < 0.1:
+                value += 'x'
+            quote = "'" if random.random() < 0.8 else '"'
+            predicates.append('[@{}={}{}{}]'.format(attrib_name, quote, value, quote))
+        if keys and random.random() < 0.2:
+            predicates.append('[@{}]'.format(random.choice(keys)))
+        if not descendant and random.random() < 0.3:
+            siblings = [x for x in node.getparent().iterchildren(
+                            None if tag == '*' else tag)
+                        if isinstance(x.tag, str)]
+            # Positions apply after any prior predicates, so only use
+            # them first, and sometimes point past the end.
+            if not predicates:
+                position = siblings.index(node) + 1
+                if random.random() < 0.1:
+                    position += len(siblings)
+                predicates.append('[{}]'.format(position))
+        steps.append('{}{}{}'.format(
+            '//' if descendant else '/', tag, ''.join(predicates)))
+
+    xpath = ''.join(steps)
+    # Maybe select an attribute.
+    if random.random() < 0.2:
+        keys = target_node.keys()
+        attrib_name = random.choice(keys) if keys and random.random() < 0.9 else 'missing'
+        xpath += '/@' + attrib_name
+    return xpath
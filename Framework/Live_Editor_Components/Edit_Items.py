@@ -291,8 +291,8 @@ class Edit_Item(_Base_Item):
       - Will trigger a reference object update in the parent object
         when this value is changed.
     * xml_node_id
-      - String, the id of an xml element that the patched version of this
-        item was initialized from.
+      - Int, the XML_Diff node id of an xml element that the patched
+        version of this item was initialized from.
       - Used to aid in matching to live editor patches from a prior run.
     '''
     def __init__(
@@ -363,13 +363,17 @@ class Edit_Item(_Base_Item):
         # Record the patched node for reference, to match up to
         # live_editor saved patches which may have had a different xpath.
         if version == 'patched' and nodes:
-            # There should be an id in the node tail.
-            if not nodes[0].tail:
+            # There should be an id recorded for the node.
+            # Files loaded readonly skipped filling ids; fill them now.
+            game_file.Make_Writable()
+            node_ids = game_file.Get_Node_IDs(game_file.Get_Root_Readonly('patched'))
+            xml_node_id = node_ids.get(nodes[0]) if node_ids != None else None
+            if xml_node_id == None:
                 from lxml import etree as ET
-                print('Edit_Item failed a node tail check, ', self.key)
+                print('Edit_Item failed a node id check, ', self.key)
                 print(ET.tostring(nodes[0]))
                 assert False
-            self.xml_node_id = nodes[0].tail
+            self.xml_node_id = xml_node_id
         return
 
 
@@ -5,6 +5,7 @@ from collections import namedtuple
 
 from .Edit_Items import Edit_Item, Display_Item, Placeholder_Item
 from .Edit_Items import version_names
+from ..Common.XPath_Cache import XPath
 
 # Macro tuples for aiding in construction of items.
 # TODO: maybe convert to classes, to make it easier to copy base
@@ -321,7 +322,7 @@ class Edit_Object:
         #  out the starting node, else use root.
         xml_node = game_file.Get_Root_Readonly()
         if xpath_prefix:
-            test_nodes = xml_node.xpath(xpath_prefix)
+            test_nodes = XPath(xml_node, xpath_prefix)
             if len(test_nodes) == 1:
                 xml_node = test_nodes[0]
             else:
@@ -421,7 +422,7 @@ class Edit_Object:
                     next_macro = macro_list.pop(0)
                     
                 # Look up the xml node being expanded.
-                group_nodes = xml_node.xpath(xpath)
+                group_nodes = XPath(xml_node, xpath)
                 # If it wasn't found, skip this macro group entirely.
                 # Note: placeholders aren't added for groups, for now,
                 # unlike raw edit_items.
@@ -430,7 +431,7 @@ class Edit_Object:
                 group_node = group_nodes[0]
 
                 # Find the xml children with the tag being grouped.
-                child_nodes = group_node.xpath(macro.tag)
+                child_nodes = XPath(group_node, macro.tag)
 
                 for index, child_node in enumerate(child_nodes):
                     # Pick an extention for item names, to uniquify
@@ -463,7 +464,7 @@ class Edit_Object:
                 #  valid for only one version of the filep; perhaps an
                 #  Edit_Item should always be created, and it will just
                 #  deal with missing nodes internally.
-                nodes = xml_node.xpath(xpath)
+                nodes = XPath(xml_node, xpath)
                 if not nodes:
                     self.Add_Item( Placeholder_Item(
                         parent       = self,
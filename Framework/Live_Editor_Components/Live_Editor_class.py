@@ -30,7 +30,7 @@ class Custom_Patch:
     '''
     Patch captuing a hand edited value that was changed from default.
 
-    Attributes (all strings):
+    Attributes (all strings, except the int xml_node_id):
     * name
     * virtual_path
     * xpath
@@ -479,9 +479,11 @@ class Live_Editor_class:
                 else:
                     # Don't check for >1 for now; that is checked when
                     # patched are properly applied in a transform.
-                    xml_node_id = nodes[0].tail
+                    node_ids = game_file.Get_Node_IDs(
+                        game_file.Get_Root_Readonly('patched'))
+                    xml_node_id = node_ids.get(nodes[0]) if node_ids != None else None
                     # An id should have been attached.
-                    assert xml_node_id
+                    assert xml_node_id != None
             
             patch = Custom_Patch(
                 name         = split_key[0],
@@ -1,10 +1,10 @@
 
 from Framework import Load_File, File_System, Plugin_Log, File_Manager
+from Framework.Common import Path_Index
 
 from collections import defaultdict
 from lxml import etree
 from lxml.etree import Element
-import fnmatch
 
 
 from .Macro import *
@@ -61,11 +61,15 @@ class Database:
         macros keyed by name.
     * macros
       - Dict of all macros, keyed by lowercase name, collected from the above.
+    * macro_index
+      - Path_Index of the macros keys, for pattern lookups.
     * class_components
       - Dict, keyed by component class (eg. 'engine'), holding a subdict of
         components keyed by name.
     * components
       - Dict of all components, keyed by lowercase name, collected from the above.
+    * component_index
+      - Path_Index of the components keys, for pattern lookups.
     * object_gamefile_dict
       - Dict, keyed by macro or component, linking to the game file it 
         came from.
@@ -77,8 +81,10 @@ class Database:
         self.gamefile_roots = {}
         self.writable_gamefiles = []
         self.macros = {}
+        self.macro_index = Path_Index()
         self.class_macros = defaultdict(dict)
         self.components = {}
+        self.component_index = Path_Index()
         self.class_components = defaultdict(dict)
         self.object_gamefile_dict = {}
         self.gamefile_objects_dict = defaultdict(list)
@@ -129,6 +135,7 @@ class Database:
 
             self.class_macros[class_name][object.name] = object
             self.macros[object.name.lower()] = object
+            self.macro_index.Add(object.name.lower())
             self.object_gamefile_dict[object] = game_file
             self.gamefile_objects_dict[game_file].append(object)
 
@@ -138,6 +145,7 @@ class Database:
                 
             self.class_components[class_name][object.name] = object
             self.components[object.name.lower()] = object
+            self.component_index.Add(object.name.lower())
             self.object_gamefile_dict[object] = game_file
             self.gamefile_objects_dict[game_file].append(object)
 
@@ -217,7 +225,7 @@ class Database:
                 self.Load_File(game_file)
 
         # Now pick out the actual macros.
-        macro_names = fnmatch.filter(self.macros.keys(), pattern.lower())
+        macro_names = self.macro_index.Filter(pattern.lower())
         # Filter for wanted classes, if a list was given.
         return [self.macros[x] for x in macro_names 
                 if ((not class_names or self.macros[x].class_name in class_names) 
@@ -262,7 +270,7 @@ class Database:
                 self.Load_File(game_file)
 
         # Now pick out the actual components.
-        component_names = fnmatch.filter(self.components.keys(), pattern.lower())
+        component_names = self.component_index.Filter(pattern.lower())
         return [self.components[x] for x in component_names]
 
 
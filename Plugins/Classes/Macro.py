@@ -1,5 +1,6 @@
 
 from Framework import Load_File, File_System, Plugin_Log
+from Framework.Common.XPath_Cache import XPath
 from .Connection import Connection
 from .Component import Component
 __all__ = ['Macro']
@@ -61,11 +62,20 @@ class Macro:
             conn.Replace_XML(replacements)
         return
 
+    def _Find(self, xpath):
+        '''
+        Returns the first node matching the given xpath, or None.
+        Uses a cached compiled xpath, since the same few xpaths get
+        used across every macro.
+        '''
+        nodes = XPath(self.xml_node, xpath)
+        return nodes[0] if nodes else None
+
     def Get(self, xpath, attr, default = None):
         '''
         Return an attribute or element matching the given xpath and attribute.
         '''
-        node = self.xml_node.find(xpath)
+        node = self._Find(xpath)
         if node != None:
             return node.get(attr)
         return default
@@ -76,11 +86,11 @@ class Macro:
         XML is updated directly, and modified flag set.
         '''
         # First, skip if the xpath doesn't match anything.
-        if self.xml_node.find(xpath) == None:
+        if self._Find(xpath) == None:
             # TODO: maybe warning.
             return
         self.database.Set_Object_Writable(self)
-        self.xml_node.find(xpath).set(attr, value)
+        self._Find(xpath).set(attr, value)
         self.modified = True
         return
 
@@ -89,7 +99,7 @@ class Macro:
         Remove matching subnodes, if found.
         '''
         self.database.Set_Object_Writable(self)
-        nodes = self.xml_node.xpath(xpath)
+        nodes = XPath(self.xml_node, xpath)
         for node in nodes:
             node.getparent().remove(node)
             self.modified = True
@@ -2,6 +2,7 @@
 from collections import defaultdict
 from Framework import Transform_Wrapper, Settings, Plugin_Log, Load_File
 from Framework import Live_Editor
+from Framework.Common.XPath_Cache import XPath
 
 
 @Transform_Wrapper(category = 'Live_Editor')
@@ -57,7 +58,7 @@ def Apply_Live_Editor_Patches(
 
         for patch in patch_list:
             # Look up the edited node; assume just one xpath match.
-            nodes = root.xpath(patch.xpath)
+            nodes = XPath(root, patch.xpath)
             if not nodes:
                 Plugin_Log.Print(('Warning: Apply_Live_Editor_Patches could'
                                 ' not find node "{}" in file "{}"'
@@ -192,11 +192,6 @@ def Increase_AI_Script_Waits(
                                 name = varname,
                                 exact = f'{varname} * {mult_str}')
                     node.addnext(new_node)
-                    # lxml can mess up node id tails, so fix it.
-                    if new_node.tail != None:
-                        assert node.tail == None
-                        node.tail = new_node.tail
-                        new_node.tail = None
                     
             game_file.Update_Root(xml_root)
                     
@@ -248,11 +243,6 @@ def Adjust_OOS_Damage(multiplier):
                             name = varname,
                             exact = f'{varname} * {multiplier}')
                 node.addnext(new_node)
-                # lxml can mess up node id tails, so fix it.
-                if new_node.tail != None:
-                    assert node.tail == None
-                    node.tail = new_node.tail
-                    new_node.tail = None
                     
         game_file.Update_Root(xml_root)
 
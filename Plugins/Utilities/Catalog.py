@@ -1,5 +1,10 @@
 
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import os
+import json
 # Note: re was looked at, but deemed overkill when just regular
 # wildcard expressions are good enough for all expected uses.
 #import re
@@ -14,7 +19,8 @@ def Cat_Unpack(
         dest_dir_path,
         include_pattern  = None,
         exclude_pattern  = None,
-        allow_md5_errors = False
+        allow_md5_errors = False,
+        num_workers      = None,
     ):
     '''
     Unpack a single catalog file, or a group if a folder given.
@@ -22,6 +28,10 @@ def Cat_Unpack(
     will be used. If a file is already present at the destination,
     it is compared to the catalog version and skipped if the same.
 
+    A manifest of unpacked files (with their catalog hashes, sizes
+    and modification times) is kept in the dest folder, so that later
+    unpacks only need to check file stats to skip unchanged files.
+
     * source_cat_path
       - Path to the catalog file, or to a folder.
       - When a folder given, catalogs are read in X4 priority order
@@ -41,6 +51,9 @@ def Cat_Unpack(
       - Bool, if True then files with md5 errors will be unpacked, otherwise
         they are skipped.
       - Such errors may arise from poorly constructed catalog files.
+    * num_workers
+      - Int, optional, number of threads used to hash and write files.
+      - Defaults to the number of cpu cores.
     '''
     # Do some error checking on the paths.
     try:
@@ -98,68 +111,129 @@ def Cat_Unpack(
     num_pattern_skips = 0
     num_hash_skips    = 0
     num_md5_skips     = 0
-    
-
-    # TODO:
-    # Record a json record of already extracted file hashes, for fast
-    # checking them instead of re-hashing every time.
+    num_bytes_written = 0
+    start_time = time()
 
-    # TODO:
-    # Switch to pulling out all virtual_paths first, then use fnmatch.filter
-    # on them for each pattern, then use some set operations to merge the
-    # results down to the desired set of paths.
-    # This would mostly be useful if switching to storing hashes from
-    # prior extractions for fast comparison, as currently the hashing
-    # takes far more time than the fnmatching.
+    # Load the manifest of prior unpacks to this dest, if any.
+    manifest_path = dest_dir_path / _manifest_name
+    manifest = _Load_Unpack_Manifest(manifest_path)
 
-    # Loop over the Cat_Entry objects; the reader takes care of
-    #  cat priorities.
+    # Gather the entries to unpack, paired with their Cat_Reader.
+    # Cats are looped over in priority order, and the first cat with
+    # a given virtual_path wins (same as source_reader.Get_Cat_Entries).
     # Note: virtual_path is lowercase, but cat_entry.cat_path has
     #  original case.
-    for virtual_path, cat_entry in source_reader.Get_Cat_Entries().items():
-
-        # Skip if a pattern given and this doesn't match.
-        if not _Pattern_Match(virtual_path, include_pattern, exclude_pattern):
-            num_pattern_skips += 1
-            continue
-
-        dest_path = dest_dir_path / cat_entry.cat_path
-
-        # To save some effort, check if the file already exists at
-        #  the dest, and if so, get its md5 hash.
-        if dest_path.exists():
-            existing_binary = dest_path.read_bytes()
-            dest_hash = File_Manager.Cat_Reader.Get_Hash_String(existing_binary)
-            # If hashes match, skip.
-            # Ego uses 0's instead of a proper hash for empty files, so also
-            # check that case.
-            if (dest_hash == cat_entry.hash_str 
-            or (not existing_binary and cat_entry.hash_str == '00000000000000000000000000000000')):
-                num_hash_skips += 1
+    cat_readers = [source_reader.Get_Catalog_Reader(cat_path)
+                   for cat_path in source_reader.catalog_file_dict]
+    seen_virtual_paths = set()
+    # Lists of (virtual_path, cat_entry), one per cat_reader.
+    cat_reader_entries = []
+    for cat_reader in cat_readers:
+        this_entries = []
+        cat_reader_entries.append(this_entries)
+        for virtual_path, cat_entry in cat_reader.Get_Cat_Entries().items():
+            if virtual_path in seen_virtual_paths:
                 continue
+            seen_virtual_paths.add(virtual_path)
 
-        # Make a folder for the dest if needed.
-        dest_path.parent.mkdir(parents = True, exist_ok = True)
-
-        # Get the file binary, catching any md5 error.
-        # This will only throw the exception if allow_md5_errors is False.
-        try:
-            cat_path, file_binary = source_reader.Read_Catalog_File(
-                virtual_path,
-                allow_md5_error = allow_md5_errors)
-        except Cat_Hash_Exception:
+            # Skip if a pattern given and this doesn't match.
+            if not _Pattern_Match(virtual_path, include_pattern, exclude_pattern):
+                num_pattern_skips += 1
+                continue
+            this_entries.append((virtual_path, cat_entry))
+
+        # Sort by dat offset, so that each dat gets read front to back.
+        this_entries.sort(key = lambda x: x[1].start_byte)
+
+
+    # Hashing (md5 check of the cat data and of any existing dest file)
+    # and file writing both release the GIL, so they are farmed out to
+    # threads, while this thread streams through the dats in order.
+    if not num_workers:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, int(num_workers))
+    # Limit how many entries are in flight, to bound the memory held
+    # by read binaries waiting on a worker.
+    max_pending = num_workers * 4
+    # Deque of (virtual_path, cat_entry, future), in dat order; results are
+    # collected in this same order, so printouts stay deterministic.
+    pending = deque()
+
+    def Collect_Result():
+        '''
+        Waits on the oldest pending entry and tallies its result.
+        '''
+        nonlocal num_writes, num_hash_skips, num_md5_skips, num_bytes_written
+        virtual_path, cat_entry, future = pending.popleft()
+        result, num_bytes, manifest_entry = future.result()
+        if manifest_entry != None:
+            manifest[cat_entry.cat_path] = manifest_entry
+        if result == 'hash_skip':
+            num_hash_skips += 1
+        elif result == 'md5_skip':
             num_md5_skips += 1
-            continue
-        
-        # Write it back out to the destination.
-        with open(dest_path, 'wb') as file:
-            file.write(file_binary)
-
-        # Be verbose for now.
-        num_writes += 1
-        Print('Extracted {}'.format(virtual_path))
+        else:
+            # Be verbose for now.
+            num_writes += 1
+            num_bytes_written += num_bytes
+            Print('Extracted {}'.format(virtual_path))
+        return
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        for cat_reader, this_entries in zip(cat_readers, cat_reader_entries):
+            if not this_entries:
+                continue
 
-        
+            # When not memory mapping, keep one handle open for the
+            # whole pass over this dat.
+            dat_file = None
+            if not cat_reader.use_mmap:
+                dat_file = open(cat_reader.dat_path, 'rb')
+            try:
+                for virtual_path, cat_entry in this_entries:
+                    dest_path = dest_dir_path / cat_entry.cat_path
+
+                    # If the manifest shows this file was already unpacked
+                    # from the same cat data, and it hasn't been touched
+                    # since, skip it without reading anything.
+                    if _Manifest_Match(manifest, cat_entry, dest_path):
+                        num_hash_skips += 1
+                        continue
+
+                    binary = cat_reader.Read_Entry_Binary(
+                        cat_entry, dat_file = dat_file)
+                    future = executor.submit(
+                        _Unpack_Entry,
+                        cat_reader, cat_entry, binary, dest_path,
+                        allow_md5_errors)
+                    pending.append((virtual_path, cat_entry, future))
+                    # Drop the local reference so that mapped slices
+                    # get released once their worker finishes.
+                    binary = None
+
+                    if len(pending) >= max_pending:
+                        Collect_Result()
+            finally:
+                if dat_file != None:
+                    dat_file.close()
+
+        # Finish off the remaining entries.
+        while pending:
+            Collect_Result()
+
+    # Release dat handles, and save any verified hashes.
+    source_reader.Close()
+
+    # Update the manifest, if the dest folder is present (it may not
+    # be if nothing was ever written).
+    if dest_dir_path.exists():
+        _Save_Unpack_Manifest(manifest_path, manifest)
+
+    run_time = time() - start_time
+    Print('Data written                     : {:.2f} MB in {:.2f} s ({:.2f} MB/s)'.format(
+        num_bytes_written / 1e6, 
+        run_time,
+        num_bytes_written / 1e6 / run_time if run_time else 0))
     Print('Files written                    : {}'.format(num_writes))
     Print('Files skipped (pattern mismatch) : {}'.format(num_pattern_skips))
     Print('Files skipped (hash match)       : {}'.format(num_hash_skips))
@@ -169,6 +243,118 @@ def Cat_Unpack(
 
 
 
+def _Unpack_Entry(
+        cat_reader, 
+        cat_entry, 
+        binary, 
+        dest_path, 
+        allow_md5_errors
+    ):
+    '''
+    Worker function for Cat_Unpack, handling one catalog entry.
+    Returns a tuple of (result, num_bytes, manifest_entry), where result
+    is one of 'hash_skip', 'md5_skip', or 'write', and manifest_entry
+    is the new manifest dict for the dest file (or None if not present).
+    '''
+    # To save some effort, check if the file already exists at
+    #  the dest, and if so, get its md5 hash.
+    if dest_path.exists():
+        existing_binary = dest_path.read_bytes()
+        dest_hash = File_Manager.Cat_Reader.Get_Hash_String(existing_binary)
+        # If hashes match, skip.
+        # Ego uses 0's instead of a proper hash for empty files, so also
+        # check that case.
+        if (dest_hash == cat_entry.hash_str 
+        or (not existing_binary and cat_entry.hash_str == '00000000000000000000000000000000')):
+            return ('hash_skip', 0, _Make_Manifest_Entry(cat_entry, dest_path))
+
+    # Check the file binary, catching any md5 error.
+    # This will only throw the exception if allow_md5_errors is False.
+    try:
+        cat_reader.Verify_Entry_Binary(
+            cat_entry, binary, allow_md5_error = allow_md5_errors)
+    except Cat_Hash_Exception:
+        return ('md5_skip', 0, None)
+
+    # Make a folder for the dest if needed.
+    dest_path.parent.mkdir(parents = True, exist_ok = True)
+        
+    # Write it back out to the destination.
+    with open(dest_path, 'wb') as file:
+        file.write(binary)
+    return ('write', len(binary), _Make_Manifest_Entry(cat_entry, dest_path))
+
+
+# Name of the manifest file Cat_Unpack places in its dest folder.
+_manifest_name = 'cat_unpack_manifest.json'
+# Version of the manifest format; manifests of other versions are ignored.
+_manifest_version = 1
+
+def _Load_Unpack_Manifest(manifest_path):
+    '''
+    Returns the Cat_Unpack manifest dict loaded from the given path,
+    keyed by dest relative path, holding dicts with 'hash', 'size'
+    and 'mtime' fields.
+    Returns an empty dict if the file is missing or unusable.
+    '''
+    if not manifest_path.exists():
+        return {}
+    try:
+        with open(manifest_path, 'r') as file:
+            json_dict = json.load(file)
+        if json_dict.get('version') != _manifest_version:
+            return {}
+        return json_dict['files']
+    except Exception:
+        return {}
+
+
+def _Save_Unpack_Manifest(manifest_path, manifest):
+    '''
+    Writes the Cat_Unpack manifest dict to the given path.
+    A temp file is written first and swapped in, so an interrupted
+    write doesn't leave a broken manifest behind.
+    '''
+    json_dict = {
+        'version' : _manifest_version,
+        'files'   : manifest,
+        }
+    temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(json_dict, file, sort_keys = True)
+    os.replace(temp_path, manifest_path)
+    return
+
+
+def _Make_Manifest_Entry(cat_entry, dest_path):
+    '''
+    Returns a manifest dict recording that dest_path holds the
+    contents of cat_entry.
+    '''
+    stat = dest_path.stat()
+    return {
+        'hash'  : cat_entry.hash_str,
+        'size'  : stat.st_size,
+        'mtime' : stat.st_mtime_ns,
+        }
+
+
+def _Manifest_Match(manifest, cat_entry, dest_path):
+    '''
+    Returns True if the manifest shows dest_path as already holding
+    the contents of cat_entry, and the file is unchanged since.
+    '''
+    manifest_entry = manifest.get(cat_entry.cat_path)
+    if manifest_entry == None or manifest_entry['hash'] != cat_entry.hash_str:
+        return False
+    try:
+        stat = dest_path.stat()
+    except OSError:
+        return False
+    return (stat.st_size == manifest_entry['size'] 
+            and stat.st_mtime_ns == manifest_entry['mtime'])
+
+
 @Utility_Wrapper(uses_paths_from_settings = False)
 def Cat_Pack(
         source_dir_path,
@@ -1,5 +1,7 @@
 
 from pathlib import Path
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count, get_start_method
 import re
 from Framework import Utility_Wrapper
 from Framework import File_Manager
@@ -11,11 +13,29 @@ from Framework import File_Loading_Error_Exception
 from Framework import Unmatched_Diff_Exception
 from Framework import Settings
 
+
+# Record of an error found by Check_Extension.
+# * extension
+#   - Name of the extension being checked, lowercase.
+# * virtual_path
+#   - Virtual path of the file being loaded when the error was found,
+#     or None for errors outside file loading (eg. dependencies).
+# * message
+#   - String, the error message.
+# * ordering
+#   - String, the loading order being tested: 'alphabetical',
+#     'earliest', or 'latest'.
+Check_Result = namedtuple(
+    'Check_Result', 
+    ['extension', 'virtual_path', 'message', 'ordering'])
+
+
 @Utility_Wrapper()
 def Check_Extension(
         extension_name,
         check_other_orderings = False,
-        return_log_messages = False
+        return_log_messages = False,
+        return_results = False,
     ):
     '''
     Checks an extension for xml diff patch errors and dependency errors.
@@ -45,6 +65,10 @@ def Check_Extension(
         this will instead return a list of logged lines that
         contain any error messages.
       - Does not stop the normal message Prints.
+    * return_results
+      - Bool, if True then instead of the normal True/False return,
+        this will return a list of Check_Results for the errors found.
+      - Does not stop the normal message Prints.
     '''
     # TODO: think about also checking later extensions to see if they
     #  might overwrite this extension.
@@ -80,6 +104,11 @@ def Check_Extension(
 
     # Keep a list of lines seen, to possibly return.
     logged_messages = []
+    # Structured versions of the above, and the loading order and file
+    # currently being checked, for filling them in.
+    results = []
+    ordering = None
+    current_virtual_path = None
 
     # For name checks, use re to protect against one extension name
     # being inside another longer name by using '\b' as word edges;
@@ -129,12 +158,19 @@ def Check_Extension(
             # Record the message, if requested.
             if return_log_messages:
                 logged_messages.append(message)
+            results.append(Check_Result(
+                extension    = extension_name,
+                virtual_path = current_virtual_path,
+                message      = message,
+                ordering     = ordering))
 
             # Print with an indent for visual niceness.
             Print('  ' + message)
         return
 
-    # Connect the custom logging function.
+    # Connect the custom logging function, keeping any prior one to
+    # restore afterward.
+    prior_logging_function = Plugin_Log.logging_function
     Plugin_Log.logging_function = Logging_Function
     
     # Set up the loading orders by adjusting priority.
@@ -149,10 +185,13 @@ def Check_Extension(
     for priority in priorities:
         if priority == 0:
             Print('  Loading alphabetically...')
+            ordering = 'alphabetical'
         elif priority == -1:
             Print('  Loading at earliest...')
+            ordering = 'earliest'
         else:
             Print('  Loading at latest...')
+            ordering = 'latest'
 
         # Resort the extensions.
         # This will also check dependencies and for unique extension ids.
@@ -175,6 +214,7 @@ def Check_Extension(
             # for substitutions.
             if not virtual_path.endswith('xml'):
                 continue
+            current_virtual_path = virtual_path
 
             # The path could be to an original file, or to a patch on an
             # existing file.  Without knowing, need to try out both cases
@@ -184,6 +224,7 @@ def Check_Extension(
                 Load_File(
                     virtual_path, 
                     test_load = True, 
+                    readonly = True,
                     error_if_unmatched_diff = True)
 
             # If it was a diff with no base file, catch the error.
@@ -207,6 +248,7 @@ def Check_Extension(
                     game_file = Load_File(
                         test_path, 
                         test_load = True, 
+                        readonly = True,
                         error_if_not_found = error_if_not_found)
                     if game_file == None:
                         Print('  Warning: could not find file "{test_path}"; skipping diff')
@@ -228,14 +270,18 @@ def Check_Extension(
                 Logging_Function(
                     ('Error when loading file {}; returned exception: {}'
                         ).format(virtual_path, exception))
+
+        current_virtual_path = None
             
 
     Print('  Overall result: ' + ('Success' if success else 'Error detected'))
 
     # Detach the logging function override.
-    Plugin_Log.logging_function = None
+    Plugin_Log.logging_function = prior_logging_function
 
     # Return the messages if requested, else the success flag.
+    if return_results:
+        return results
     if return_log_messages:
         return logged_messages
     return success
@@ -243,10 +289,26 @@ def Check_Extension(
 
 
 @Utility_Wrapper()
-def Check_All_Extensions():
+def Check_All_Extensions(
+        num_workers = 0,
+        return_results = False,
+    ):
     '''
     Calls Check_Extension on all enabled extensions, looking for errors.
     Returns True if no errors found, else False.
+
+    * num_workers
+      - Int, number of processes used to check extensions in parallel.
+      - Defaults to 0, using one per cpu core where worker processes
+        are forked (eg. linux), so that they start from the already
+        loaded source files. Elsewhere (eg. windows) workers would each
+        have to reload everything, so the default checks everything
+        in the main process, the same as setting this to 1.
+      - Printed output is the same regardless of worker count.
+    * return_results
+      - Bool, if True then instead of the normal True/False return,
+        this will return a list of Check_Results for all errors found,
+        in extension order.
     '''
     # Two options here: call Check_Extension on each individual extension,
     #  which maybe does excessive work, or use custom code to check
@@ -257,12 +319,72 @@ def Check_All_Extensions():
     success = True
 
     # Pull out the source_reader; this also initializes it if needed.
+    # Worker processes start from a copy of this (when forked), so that
+    # they can skip the setup, and each can resort extensions and
+    # reroute logging without affecting the others.
     source_reader = File_Manager.File_System.Get_Source_Reader()
 
     # Gather the names of enabled extensions.
     extension_names = [x for x in source_reader.extension_source_readers]
 
-    for extension_name in extension_names:
-        if not Check_Extension(extension_name):
-            success = False
-    return success
\ No newline at end of file
+    # Only default to parallel when workers can share the loaded
+    # source_reader; spawned workers start over from scratch.
+    if num_workers <= 0:
+        num_workers = cpu_count() if get_start_method() == 'fork' else 1
+
+    # Only bother with the pool if there is work to split up.
+    pool = None
+    if num_workers > 1 and len(extension_names) > 1:
+        # Workers may not inherit the current Settings (eg. when
+        # spawned instead of forked), so send them along.
+        settings_dict = {field : getattr(Settings, field) 
+                         for field in Settings.Get_Defaults()}
+        pool = Pool(processes = min(num_workers, len(extension_names)))
+        # Results come back in input order, so messages print in the
+        # same order as a serial run.
+        worker_results = pool.imap(
+            _Check_Extension_Worker,
+            [(settings_dict, x) for x in extension_names])
+
+    # Merged results from all extensions.
+    all_results = []
+    try:
+        for extension_name in extension_names:
+            if pool != None:
+                results, print_lines = next(worker_results)
+                for line in print_lines:
+                    Print(line)
+            else:
+                results = Check_Extension(extension_name, return_results = True)
+
+            # A None result means the check failed with an exception.
+            if results == None or results:
+                success = False
+            if results:
+                all_results += results
+    finally:
+        if pool != None:
+            pool.terminate()
+
+    if return_results:
+        return all_results
+    return success
+
+
+def _Check_Extension_Worker(inputs):
+    '''
+    Worker process function for Check_All_Extensions, taking a tuple of
+    (settings_dict, extension_name).
+    Returns a tuple of (results, print_lines), with the Check_Extension
+    results and the messages printed while checking.
+    '''
+    settings_dict, extension_name = inputs
+    for field, value in settings_dict.items():
+        setattr(Settings, field, value)
+
+    # Capture messages, to be printed by the main process.
+    print_lines = []
+    Print.logging_function = print_lines.append
+
+    results = Check_Extension(extension_name, return_results = True)
+    return (results, print_lines)
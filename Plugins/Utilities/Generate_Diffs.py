@@ -1,13 +1,18 @@
 
 from pathlib import Path
 from itertools import zip_longest
+from collections import deque
+from bisect import bisect_left
+from multiprocessing import Pool, cpu_count, get_start_method
 import difflib
+import time
+from lxml import etree as ET
 
 from Framework import Utility_Wrapper
 from Framework import Plugin_Log
 from Framework import Print
+from Framework import Settings
 from Framework.File_Manager import XML_File
-from Framework.File_Manager.Cat_Reader import Get_Hash_String
 from Framework.File_Manager.XML_Diff import Print as XML_Print
 
 # TODO: merge this in with the Game_File system if run as part of
@@ -22,6 +27,7 @@ def Generate_Diffs(
         output_dir_path,
         skip_unchanged = False,
         verbose = False,
+        num_workers = 0,
     ):
     '''
     Generate diffs for changes between two xml containing folders, 
@@ -39,6 +45,12 @@ def Generate_Diffs(
       - Default will generate empty diff patches.
     * verbose
       - Bool, print the path of the outputs on succesful writes.
+    * num_workers
+      - Int, number of processes used to diff files in parallel.
+      - Defaults to 0, using one per cpu core where worker processes
+        are forked (eg. linux), else diffing everything in the main
+        process, the same as setting this to 1.
+      - Output is identical regardless of worker count.
     '''
     # Cast to paths to be safe.
     original_dir_path = Path(original_dir_path).resolve()
@@ -51,9 +63,15 @@ def Generate_Diffs(
     #original_paths = {x.relative_to(original_dir_path) : x for x in original_dir_path.glob('**/*.xml')}
     modified_paths = {x.relative_to(modified_dir_path) : x for x in modified_dir_path.glob('**/*.xml')}
 
+    # Timings per file, as tuples of (rel_path, seconds, status).
+    timings = []
+
     # Pair off the modified files with originals by name.
     # If an original is not found, error.
     # Ignore excess originals.
+    # Files that are byte-identical are handled right away, without
+    # parsing the xml; the rest are gathered up for diffing.
+    diff_tasks = []
     for rel_path, mod_path in modified_paths.items():
 
         orig_path = original_dir_path / rel_path
@@ -64,22 +82,125 @@ def Generate_Diffs(
         # Set up the output.
         out_path = output_dir_path / rel_path
 
-        if verbose:
-            Print('Generating diff for {}'.format(rel_path.name))
-
-        # Generate the diff. If this errors, the file will be skipped
-        # (due to plugin wrapper).
-        Generate_Diff(
-            original_file_path = orig_path,
-            modified_file_path = mod_path,
-            output_file_path   = out_path,
-            skip_unchanged     = skip_unchanged,
-            verbose            = verbose
-        )
+        start = time.time()
+        if Files_Match(orig_path, mod_path):
+            if verbose:
+                Print('Generating diff for {}'.format(rel_path.name))
+            Generate_Diff(
+                original_file_path = orig_path,
+                modified_file_path = mod_path,
+                output_file_path   = out_path,
+                skip_unchanged     = skip_unchanged,
+                verbose            = verbose,
+                files_match        = True,
+            )
+            timings.append((rel_path, time.time() - start, 'identical'))
+            continue
 
+        diff_tasks.append((rel_path, orig_path, mod_path, out_path))
+
+    # Only default to parallel when workers are forked; spawned workers
+    # pay to start up and import everything, which can outweigh gains.
+    if num_workers <= 0:
+        num_workers = cpu_count() if get_start_method() == 'fork' else 1
+
+    # Only bother with the pool if there is work to split up.
+    pool = None
+    if num_workers > 1 and len(diff_tasks) > 1:
+        # Workers may not inherit the current Settings (eg. when
+        # spawned instead of forked), so send them along.
+        settings_dict = {field : getattr(Settings, field) 
+                         for field in Settings.Get_Defaults()}
+        pool = Pool(processes = min(num_workers, len(diff_tasks)))
+        # Results come back in input order, so messages print in the
+        # same order as a serial run.
+        results = pool.imap(
+            _Generate_Diff_Worker,
+            [(settings_dict, task, skip_unchanged, verbose) for task in diff_tasks])
+
+    try:
+        for task in diff_tasks:
+            if pool != None:
+                seconds, status, print_lines, log_lines = next(results)
+                for line in print_lines:
+                    Print(line)
+                for line in log_lines:
+                    Plugin_Log.Print(line)
+            else:
+                seconds, status = _Generate_Diff_Task(task, skip_unchanged, verbose)
+            timings.append((task[0], seconds, status))
+    finally:
+        if pool != None:
+            pool.terminate()
+
+    # Summarize timings, slowest first.
+    # Byte-identical files are just counted.
+    num_identical = sum(1 for x in timings if x[2] == 'identical')
+    Print('Generate_Diffs: {} files, {} identical, {:.2f}s total'.format(
+        len(timings), num_identical, sum(x[1] for x in timings)))
+    for rel_path, seconds, status in sorted(timings, key = lambda x: -x[1]):
+        if status == 'identical':
+            continue
+        Print('  {:8.2f}s  {:<10}  {}'.format(seconds, status, rel_path.as_posix()))
     return
 
 
+def Files_Match(path_a, path_b):
+    '''
+    Returns True if the two files have identical contents, checking
+    sizes first and then the bytes.
+    '''
+    if path_a.stat().st_size != path_b.stat().st_size:
+        return False
+    return path_a.read_bytes() == path_b.read_bytes()
+
+
+def _Generate_Diff_Task(task, skip_unchanged, verbose):
+    '''
+    Runs Generate_Diff for a tuple of (rel_path, orig_path, mod_path,
+    out_path), as set up by Generate_Diffs.
+    Returns a tuple of (seconds, status), where status is 'diffed' or
+    'error'.
+    '''
+    rel_path, orig_path, mod_path, out_path = task
+    start = time.time()
+    if verbose:
+        Print('Generating diff for {}'.format(rel_path.name))
+
+    # Generate the diff. If this errors, the file will be skipped
+    # (due to plugin wrapper), and it returns False.
+    success = Generate_Diff(
+        original_file_path = orig_path,
+        modified_file_path = mod_path,
+        output_file_path   = out_path,
+        skip_unchanged     = skip_unchanged,
+        verbose            = verbose
+    )
+    status = 'diffed' if success else 'error'
+    return time.time() - start, status
+
+
+def _Generate_Diff_Worker(inputs):
+    '''
+    Worker process function for Generate_Diffs, taking a tuple of
+    (settings_dict, task, skip_unchanged, verbose).
+    Returns a tuple of (seconds, status, print_lines, log_lines), with
+    the messages captured while generating the diff.
+    '''
+    settings_dict, task, skip_unchanged, verbose = inputs
+    for field, value in settings_dict.items():
+        setattr(Settings, field, value)
+
+    # Capture messages, to be printed by the main process.
+    print_lines = []
+    log_lines = []
+    Print.logging_function = print_lines.append
+    Plugin_Log.logging_function = log_lines.append
+
+    seconds, status = _Generate_Diff_Task(task, skip_unchanged, verbose)
+    return (seconds, status, print_lines, log_lines)
+
+
 @Utility_Wrapper(uses_paths_from_settings = False)
 def Generate_Diff(
         original_file_path,
@@ -87,6 +208,7 @@ def Generate_Diff(
         output_file_path,
         skip_unchanged = False,
         verbose = False,
+        files_match = None,
     ):
     '''
     Generate a diff of changes between two xml files, creating a diff patch.
@@ -103,6 +225,12 @@ def Generate_Diff(
       - Default will generate empty diff patches.
     * verbose
       - Bool, print the path of the outputs on succesful writes.
+    * files_match
+      - Bool, optional, True if the files are already known to be
+        byte-identical (eg. checked by Generate_Diffs), to skip
+        reading them again.
+
+    Returns True on success (or None if skipped due to an error).
     '''
     # Cast to paths to be safe.
     original_file_path = Path(original_file_path).resolve()
@@ -127,12 +255,36 @@ def Generate_Diff(
                 Print(message)
 
 
+    if not files_match:
+        original_binary = original_file_path.read_bytes()
+        modified_binary = modified_file_path.read_bytes()
+        if files_match == None:
+            files_match = original_binary == modified_binary
+
+    # If the files are byte-identical, skip the xml parsing and matching.
+    if files_match:
+        if skip_unchanged:
+            messages.append('File unchanged: {}'.format(modified_file_path))
+            if output_file_path.exists():
+                output_file_path.unlink()
+                messages.append('Removing prior diff: {}'.format(output_file_path))
+        else:
+            # Write out an empty diff, same as a diff of unchanged xml.
+            diff_file = XML_File(
+                virtual_path = output_file_path.name,
+                xml_root = ET.Element('diff'),
+                )
+            diff_file.Write_File(output_file_path)
+            messages.append('Generated diff written to: {}'.format(output_file_path))
+        Print_Messages()
+        return True
+
     # Load the original.
     base_game_file = XML_File(
         # Virtual path doesn't matter, though can be useful for debug,
         # so try to fill in something.
         virtual_path = output_file_path.name,
-        binary = original_file_path.read_bytes(),
+        binary = original_binary,
         # Flag as the source; this will trigger diff patch generation later.
         from_source = True,
         )
@@ -145,16 +297,18 @@ def Generate_Diff(
     # for consistent loading format.
     temp_game_file = XML_File(
         virtual_path = '',
-        binary = modified_file_path.read_bytes(),
+        binary = modified_binary,
         )
     # Go ahead and give node ids. Not too important, but might do some
     # misc formatting, eg. removing tails.
     temp_game_file.Delayed_Init()
 
 
-    # Pick out the roots.
+    # Pick out the roots, and their node ids.
     original_root = base_game_file.Get_Root()
     modified_root = temp_game_file.Get_Root()
+    original_ids = base_game_file.Get_Node_IDs(original_root)
+    modified_ids = temp_game_file.Get_Node_IDs(modified_root)
     
     # Start by using a standard text diff library.
     # This is very good at matching up exact nodes regardless of their
@@ -176,10 +330,11 @@ def Generate_Diff(
         # Don't need to put the modified root back if there are no changes.
         if changed:
             # Follow up with a manual traversal of the trees, completing matches.
-            Match_Trees(original_root, modified_root, text_based_node_matches)
+            Match_Trees(original_root, modified_root, text_based_node_matches,
+                        original_ids, modified_ids)
 
             # Put the modified xml back in the game_file.
-            base_game_file.Update_Root(modified_root)
+            base_game_file.Update_Root(modified_root, node_ids = modified_ids)
 
         # Write to file. This will trigger the diff patch generation,
         # empty if no changes.
@@ -190,145 +345,78 @@ def Generate_Diff(
         messages.append('Generated diff written to: {}'.format(output_file_path))
 
     Print_Messages()
-    return
-
-
-class Element_Wrap:
-    '''
-    Wrapper on xml elements with custom comparison rules.
-    '''
-    def __init__(self, xml):
-        self.xml = xml
-        self.tag = xml.tag
-        self.attrib = dict(xml.attrib)
-        self.text = xml.text
-
-        # String version of this element, flattened, for easy comparison.
-        # TODO: maybe check parent tags as well, for conservative matching.
-        self.hash_str = '{}{{{}}}{}'.format(
-            self.tag, 
-            ','.join(['{}:{}'.format(k,v) for k,v in sorted(self.attrib.items())]),
-            self.text)
-        
-        # Hash to be used.
-        # Note: just doing something like id(self) gives horrible results;
-        # the hash appears to be part of the comparison.
-        self.hash_int = hash(self.hash_str)        
-        return
-
-    def __eq__(self, other):
-        return self.hash_str == other.hash_str
-    def __ne__(self, other):
-        return not self.__eq__(other)
-    def __hash__(self):
-        return self.hash_int
-
-
-# Alternative to the above: breaks out the element into a series
-# of pieces for finer grain matching.
-class Element_Piece:
-    '''
-    For better difflib matching, this will be just a piece of an xml
-    element.
-
-    * text
-      - String, text for this piece.
-    * is_tag
-      - Bool, True if this is the tag string.
-    * xml
-      - Original XML Element.
-    '''
-    def __init__(self, text, is_tag = False, xml = None):
-        self.text = text
-        self.is_tag = is_tag
-        self.xml = xml
-
-        # Stich the is_tag flag in the hash/comparison string for
-        # robustness.
-        self.hash_str = f'{"_t_" if is_tag else ""}{text}'
-        self.hash_int = hash(self.hash_str)
-        return
-    
-    def __eq__(self, other):
-        return self.hash_str == other.hash_str
-    def __ne__(self, other):
-        return not self.__eq__(other)
-    def __hash__(self):
-        return self.hash_int
-
-
-def Element_To_Pieces(node):
-    '''
-    Returns a list of Element_Pieces for a given xml node.
-    '''
-    ret_list = [Element_Piece(node.tag, is_tag = True, xml = node)]
-    for k,v in sorted(node.attrib.items()):
-        ret_list.append(Element_Piece(f'{k}:{v}'))
-    if node.text:
-        ret_list.append(Element_Piece(node.text))
-    return ret_list
+    return True
 
 
 def Get_Text_Diff_Matches(original_root, modified_root):
     '''
-    Identify modifications with the help of a text diff library.
+    Identify modifications with the help of a text diff style matcher.
     Returns a dict matching original elements to modified elements that
     appear to be the same, along with a bool "changed" flag indicating
     if any changes were found.
     '''
-
-    # Flatten out all of the nodes, and wrap them with custom
-    # match logic.
-    original_nodes = [Element_Wrap(x) for x in original_root.iter()]
-    modified_nodes = [Element_Wrap(x) for x in modified_root.iter()]
-    
-    # -Removed; expanded style didn't help, and just ran a lot slower.
-    # Alternative: get tighter matching logic by breaking apart tags,
-    # attributes, and tails (eg. an element expands to 2+ subelements), since
-    # the difflib really wants to match sequences, and does poorly at matching
-    # a full xml element that has changes on both sides.
-    #original_nodes = [y for x in original_root.iter() for y in Element_To_Pieces(x)]
-    #modified_nodes = [y for x in modified_root.iter() for y in Element_To_Pieces(x)]
-
-    # Sequence matcher will pair up the nodes.
-    matcher = difflib.SequenceMatcher(
-        # Lambda function that takes an element and returns if it is ignorable.
-        # Nothing ignorable, so no function.
-        None, 
-        original_nodes, 
-        modified_nodes,
-        # There is some weird background algorithm that selects elements
-        # to ignore based on frequency? Anyway, in practice on a big
-        # wares file it caused a bunch of matches to be missed, so
-        # disable it.
-        autojunk = False)
-    
-    # Dict pairing original to modified nodes that the sequencer matched.
-    orig_mod_matches = {}
+    # Note: this originally ran difflib over wrapped lists of every
+    # element of both trees, which went quadratic on large files
+    # (minutes for a modded wares file).
+
+    # Instead, nodes are matched up patience diff style: first whole
+    # subtrees that are identical and unique in both trees are paired
+    # as anchors, then the remaining regions between anchors are matched
+    # node by node, anchoring on unique nodes, with difflib only used on
+    # leftover regions that have no unique nodes.
+
+    # Flatten out all of the nodes, in document order.
+    # Since subtrees are contiguous in this order, an anchored subtree
+    # covers a run of nodes in both lists.
+    original_nodes = [x for x in original_root.iter()]
+    modified_nodes = [x for x in modified_root.iter()]
+    orig_keys, orig_tree_hashes, orig_sizes, orig_parents = _Get_Node_Hashes(original_nodes)
+    mod_keys,  mod_tree_hashes,  mod_sizes,  _            = _Get_Node_Hashes(modified_nodes)
+
+    # List of (orig index, mod index) pairs of matched nodes.
+    matched_indices = []
+
+    # Find subtrees unique and identical in both trees.
+    orig_unique = _Get_Unique_Indices(orig_tree_hashes, 0, len(orig_tree_hashes))
+    mod_unique  = _Get_Unique_Indices(mod_tree_hashes,  0, len(mod_tree_hashes))
+    anchors = []
+    for tree_hash, orig_index in orig_unique.items():
+        mod_index = mod_unique.get(tree_hash)
+        if mod_index == None:
+            continue
+        # Skip if the parent will be anchored, covering this node.
+        parent_index = orig_parents[orig_index]
+        if parent_index != None:
+            parent_hash = orig_tree_hashes[parent_index]
+            if parent_hash in orig_unique and parent_hash in mod_unique:
+                continue
+        anchors.append((orig_index, mod_index))
+
+    # Keep anchors that are in the same order in both trees, and match
+    # the regions between them.
+    orig_start = 0
+    mod_start  = 0
+    for orig_index, mod_index in _Get_Ordered_Anchors(anchors):
+        _Match_Regions(orig_keys, mod_keys, orig_start, orig_index,
+                       mod_start, mod_index, matched_indices)
+        size = orig_sizes[orig_index]
+        for offset in range(size):
+            matched_indices.append((orig_index + offset, mod_index + offset))
+        orig_start = orig_index + size
+        mod_start  = mod_index  + size
+    _Match_Regions(orig_keys, mod_keys, orig_start, len(orig_keys),
+                   mod_start, len(mod_keys), matched_indices)
     
-    # get_matching_blocks returns a series of tuples of
-    # (i, j, n) where a[i:i+n] == b[j:j+n]
+    # Dict pairing original to modified nodes that the matcher paired.
     # Note: this may end up matching nodes from one parent's child elements
     # to those of another parent. However, this is not expected to be a
     # problem, since the diff generator just checks for matches under
     # an already matched parent.
-    for orig_base, mod_base, length in matcher.get_matching_blocks():    
-        for offset in range(length):
-
-            # -Removed; expanded style didn't help.
-            #orig_piece = original_nodes[orig_base + offset]
-            #mod_piece  = modified_nodes[mod_base + offset]
-            ## When a non-tag is matched, ignore it. Only care about
-            ## the tags.
-            #if not orig_piece.is_tag:
-            #    continue
-            #assert mod_piece.is_tag
-            #orig_node = orig_piece.xml
-            #mod_node  = mod_piece.xml
-            
-            orig_node = original_nodes[orig_base + offset].xml
-            mod_node  = modified_nodes[mod_base + offset].xml            
-            orig_mod_matches[orig_node] = mod_node
+    # Note: these are sorted to get document order, which the parent
+    # matching below depends on.
+    orig_mod_matches = {}
+    for orig_index, mod_index in sorted(matched_indices):
+        orig_mod_matches[original_nodes[orig_index]] = modified_nodes[mod_index]
                         
 
     # Set a flag indicating if there are any mismatches, since the following
@@ -349,9 +437,9 @@ def Get_Text_Diff_Matches(original_root, modified_root):
 
     # Loop until all orig nodes processed; this list will extend on
     # each new match.
-    orig_nodes_to_check = [x for x in orig_mod_matches]
+    orig_nodes_to_check = deque(orig_mod_matches)
     while orig_nodes_to_check:
-        orig_node = orig_nodes_to_check.pop(0)
+        orig_node = orig_nodes_to_check.popleft()
         mod_node  = orig_mod_matches[orig_node]
 
         # Get their parents.
@@ -379,10 +467,162 @@ def Get_Text_Diff_Matches(original_root, modified_root):
 
 
 
-def Match_Trees(original_root, modified_root, text_based_node_matches):
+def _Get_Node_Hashes(nodes):
+    '''
+    Returns a tuple of lists with, for each node in a document order list
+    of a full tree: a hash of the node tag, attributes, and text; a hash
+    of the full subtree; the subtree size (node count); and the index of
+    the parent node (None for the root).
+    '''
+    # Note: python's builtin hash is used, since it is fast and only
+    # needs to be consistent within a run.
+    node_keys   = [None] * len(nodes)
+    tree_hashes = [None] * len(nodes)
+    sizes       = [1] * len(nodes)
+    parents     = [None] * len(nodes)
+    # Dict of node to index, for looking up child results.
+    node_indices = {node : index for index, node in enumerate(nodes)}
+
+    # Work backwards, so that children are handled before parents.
+    for index in range(len(nodes) -1, -1, -1):
+        node = nodes[index]
+        node_key = hash((node.tag, tuple(sorted(node.items())), node.text))
+        child_hashes = []
+        for child in node.iterchildren():
+            child_index = node_indices[child]
+            child_hashes.append(tree_hashes[child_index])
+            sizes[index] += sizes[child_index]
+            parents[child_index] = index
+        node_keys[index] = node_key
+        tree_hashes[index] = hash((node_key, tuple(child_hashes)))
+    return node_keys, tree_hashes, sizes, parents
+
+
+def _Get_Unique_Indices(keys, start, end):
+    '''
+    Returns a dict of key to index for keys that occur only once in
+    the given range of the list.
+    '''
+    indices = {}
+    repeats = set()
+    for index in range(start, end):
+        key = keys[index]
+        if key in indices:
+            repeats.add(key)
+        else:
+            indices[key] = index
+    for key in repeats:
+        del indices[key]
+    return indices
+
+
+def _Get_Ordered_Anchors(anchors):
+    '''
+    Given a list of (orig index, mod index) pairs, returns the longest
+    subset that has both indices increasing, sorted.
+    '''
+    # Patience sorting to find the longest increasing subsequence of
+    # mod indices, when ordered by orig index.
+    anchors = sorted(anchors)
+    # Mod indices at the top of each pile, and the anchor index there.
+    pile_tops = []
+    pile_anchors = []
+    # For each anchor, the anchor index on the prior pile.
+    back_links = []
+    for anchor_index, (_, mod_index) in enumerate(anchors):
+        pile = bisect_left(pile_tops, mod_index)
+        back_links.append(pile_anchors[pile -1] if pile > 0 else None)
+        if pile == len(pile_tops):
+            pile_tops.append(mod_index)
+            pile_anchors.append(anchor_index)
+        else:
+            pile_tops[pile] = mod_index
+            pile_anchors[pile] = anchor_index
+
+    # Follow links back from the last pile.
+    ordered = []
+    anchor_index = pile_anchors[-1] if pile_anchors else None
+    while anchor_index != None:
+        ordered.append(anchors[anchor_index])
+        anchor_index = back_links[anchor_index]
+    ordered.reverse()
+    return ordered
+
+
+def _Match_Regions(orig_keys, mod_keys, orig_start, orig_end, mod_start, mod_end, matched_indices):
+    '''
+    Match up nodes by key within the given index ranges of the orig
+    and mod lists, appending (orig index, mod index) pairs to
+    matched_indices.
+    '''
+    # Regions still to match; handled in a loop instead of recursively,
+    # since there may be many nested regions.
+    regions = [(orig_start, orig_end, mod_start, mod_end)]
+    while regions:
+        orig_start, orig_end, mod_start, mod_end = regions.pop()
+
+        # Match any common start and end, which is often most of it.
+        while (orig_start < orig_end and mod_start < mod_end
+        and orig_keys[orig_start] == mod_keys[mod_start]):
+            matched_indices.append((orig_start, mod_start))
+            orig_start += 1
+            mod_start  += 1
+        while (orig_start < orig_end and mod_start < mod_end
+        and orig_keys[orig_end -1] == mod_keys[mod_end -1]):
+            orig_end -= 1
+            mod_end  -= 1
+            matched_indices.append((orig_end, mod_end))
+        if orig_start == orig_end or mod_start == mod_end:
+            continue
+
+        # Anchor on nodes unique to this region in both lists.
+        orig_unique = _Get_Unique_Indices(orig_keys, orig_start, orig_end)
+        mod_unique  = _Get_Unique_Indices(mod_keys,  mod_start,  mod_end)
+        anchors = [(orig_index, mod_unique[key]) 
+                   for key, orig_index in orig_unique.items()
+                   if key in mod_unique]
+
+        if anchors:
+            # Split into the regions between anchors.
+            for orig_index, mod_index in _Get_Ordered_Anchors(anchors):
+                matched_indices.append((orig_index, mod_index))
+                regions.append((orig_start, orig_index, mod_start, mod_index))
+                orig_start = orig_index + 1
+                mod_start  = mod_index  + 1
+            regions.append((orig_start, orig_end, mod_start, mod_end))
+
+        else:
+            # Nothing unique, eg. runs of repeated nodes; fall back on
+            # difflib for this region.
+            matcher = difflib.SequenceMatcher(
+                None, 
+                orig_keys[orig_start : orig_end], 
+                mod_keys[mod_start : mod_end],
+                # There is some weird background algorithm that selects elements
+                # to ignore based on frequency? Anyway, in practice on a big
+                # wares file it caused a bunch of matches to be missed, so
+                # disable it.
+                autojunk = False)
+            # get_matching_blocks returns a series of tuples of
+            # (i, j, n) where a[i:i+n] == b[j:j+n]
+            for orig_base, mod_base, length in matcher.get_matching_blocks():
+                for offset in range(length):
+                    matched_indices.append((orig_start + orig_base + offset,
+                                            mod_start  + mod_base  + offset))
+    return
+
+
+def Match_Trees(
+        original_root, 
+        modified_root, 
+        text_based_node_matches,
+        original_ids,
+        modified_ids,
+    ):
     '''
     Manually compare nodes between the xml trees, and try to find matches.
-    Updates modified_root tail ids directly.
+    Updates the modified_ids node id table directly, copying ids from
+    original_ids for matched nodes.
     '''
     # Gather hashes, with and without attributes included.
     attr_hash_dict, no_attr_hash_dict = Fill_Element_Hashes(original_root)
@@ -393,18 +633,35 @@ def Match_Trees(original_root, modified_root, text_based_node_matches):
         Print('Generate_Diffs error: root tag mismatch, {} vs {}'.format(
             original_root.tag,
             modified_root.tag ))
-    modified_root.tail = original_root.tail
+    Copy_Node_ID(original_root, modified_root, original_ids, modified_ids)
+
+    # Reverse of the text diff matches, for quick lookups.
+    mod_orig_matches = {v:k for k,v in text_based_node_matches.items()}
 
     # Fill in child node matches, recursively.
     Match_Children(original_root, modified_root, 
                    attr_hash_dict, no_attr_hash_dict,
-                   text_based_node_matches)
+                   text_based_node_matches,
+                   original_ids, modified_ids,
+                   mod_orig_matches)
+    return
+
+
+def Copy_Node_ID(original_node, modified_node, original_ids, modified_ids):
+    '''
+    Copy the node id of a single matched node into the modified_ids.
+    '''
+    node_id = original_ids.get(original_node)
+    if node_id != None:
+        modified_ids[modified_node] = node_id
+    else:
+        modified_ids.pop(modified_node, None)
     return
 
 
 def Fill_Element_Hashes(element, attr_hash_dict = None, no_attr_hash_dict = None):
     '''
-    Returns a pair of dicts matching each xml element to a hash string, where
+    Returns a pair of dicts matching each xml element to a hash, where
     the hash accounts for the node tag, attributes, and the hashes of
     all child nodes in order.
 
@@ -417,35 +674,20 @@ def Fill_Element_Hashes(element, attr_hash_dict = None, no_attr_hash_dict = None
     if no_attr_hash_dict == None:
         no_attr_hash_dict = {}
 
-    # Construct a text string the summarizes this node and child hashes.
-    # TODO: could maybe loop the attr and no-attr versions.
-    attr_hash_text    = ''
-    no_attr_hash_text = ''
-
-    # Start with the element tag and attributes.
-    attr_hash_text    += 'tag:{},'.format(element.tag)
-    no_attr_hash_text += 'tag:{},'.format(element.tag)
-
-    for attr, value in sorted(element.items()):
-        attr_hash_text += '{}:{},'.format(attr, value)
-
-    # Gather all child hashes.
-    for child in element.getchildren():
-
-        # Costruct the hash if needed (should generally occur).
-        if child not in attr_hash_dict:
-            Fill_Element_Hashes(child, attr_hash_dict, no_attr_hash_dict)
-
-        # Use the attribute-including hash of the child.
-        attr_hash_text    += attr_hash_dict[child]+','
-        no_attr_hash_text += no_attr_hash_dict[child]+','
-
-    # Shorten it for faster matching, using an md5 hash.
-    attr_hash = Get_Hash_String(attr_hash_text.encode())
-    attr_hash_dict[element] = attr_hash
-    
-    no_attr_hash = Get_Hash_String(no_attr_hash_text.encode())
-    no_attr_hash_dict[element] = no_attr_hash
+    # Note: this used to build up ever-growing strings of child hashes
+    # and md5 them recursively, which was slow on large files.
+    # Instead, work backwards through the document order nodes, so that
+    # children are hashed before parents, using python's builtin hash
+    # (only needs to be consistent within a run).
+    for node in reversed([x for x in element.iter()]):
+        children = node.getchildren()
+        attr_hash_dict[node] = hash((
+            node.tag, 
+            tuple(sorted(node.items())),
+            tuple([attr_hash_dict[x] for x in children])))
+        no_attr_hash_dict[node] = hash((
+            node.tag,
+            tuple([no_attr_hash_dict[x] for x in children])))
 
     return attr_hash_dict, no_attr_hash_dict
 
@@ -455,11 +697,15 @@ def Match_Children(
         modified_node, 
         attr_hash_dict, 
         no_attr_hash_dict,
-        text_based_node_matches
+        text_based_node_matches,
+        original_ids,
+        modified_ids,
+        mod_orig_matches,
     ):
     '''
-    Search the children of the given pair of elements, and copy tags from
-    the original elements to the modified elements where matches are found.
+    Search the children of the given pair of elements, and copy node ids
+    from the original elements to the modified elements where matches
+    are found.
     '''
     # This will use code similar to what is in XML_Diff for matching children,
     # but modified somewhat to use hashes which may repeat.
@@ -475,9 +721,16 @@ def Match_Children(
     # status is determined. Matches pop off both lists. Mismatches may
     # pop off one list depending on if it appears to be an insert or delete.
     # Note: use iterchildren instead of children to pick up comments.
-    orig_children = [x for x in original_node.iterchildren()]
-    mod_children  = [x for x in modified_node.iterchildren()]
+    # Note: nodes are only popped from the front, so use deques, with
+    #  sets for quick checks of which nodes remain.
+    orig_children = deque(original_node.iterchildren())
+    mod_children  = deque(modified_node.iterchildren())
+    orig_remaining = set(orig_children)
+    mod_remaining  = set(mod_children)
     
+    def Pop_Child(children, remaining):
+        remaining.discard(children.popleft())
+
     # Handy match check functions.
     def Is_Attr_Match(orig, mod):
         return attr_hash_dict[orig] == attr_hash_dict[mod]
@@ -498,8 +751,15 @@ def Match_Children(
         weak_match   = False
         
         # Check if the text diff thinks there is a later match, either direction.
-        mod_child_in_orig = any( Is_Text_Diff_Match(x, mod_child) for x in orig_children[1:])
-        orig_child_in_mod = any( Is_Text_Diff_Match(orig_child, x) for x in mod_children[1:])
+        # -Removed; slow on long child lists.
+        #mod_child_in_orig = any( Is_Text_Diff_Match(x, mod_child) for x in orig_children[1:])
+        #orig_child_in_mod = any( Is_Text_Diff_Match(orig_child, x) for x in mod_children[1:])
+        mod_match  = mod_orig_matches.get(mod_child)
+        orig_match = text_based_node_matches.get(orig_child)
+        mod_child_in_orig = (mod_match is not None and mod_match is not orig_child
+                             and mod_match in orig_remaining)
+        orig_child_in_mod = (orig_match is not None and orig_match is not mod_child
+                             and orig_match in mod_remaining)
 
         # Check if there is a perfect match later, either direction.
         #mod_child_in_orig = any( Is_Attr_Match(x, mod_child) for x in orig_children[1:])
@@ -565,7 +825,7 @@ def Match_Children(
                 
             upcoming_mods = []
             for node in mod_children:
-                if node is mod_child or node not in text_based_node_matches.values():
+                if node is mod_child or node not in mod_orig_matches:
                     upcoming_mods.append(node)
                 else:
                     break
@@ -597,15 +857,15 @@ def Match_Children(
             for orig_subnode, mod_subnode in zip_longest(orig_child.iter(),
                                                         mod_child.iter()):
                 assert mod_subnode.tag == orig_subnode.tag
-                mod_subnode.tail = orig_subnode.tail
+                Copy_Node_ID(orig_subnode, mod_subnode, original_ids, modified_ids)
                 
             # Pop off both lists.
-            orig_children.remove(orig_child)
-            mod_children .remove(mod_child)
+            Pop_Child(orig_children, orig_remaining)
+            Pop_Child(mod_children, mod_remaining)
 
         elif weak_match:
             # Copy this top level node id.
-            mod_child.tail = orig_child.tail
+            Copy_Node_ID(orig_child, mod_child, original_ids, modified_ids)
 
             # Process the children of the nodes.
             Match_Children(
@@ -613,11 +873,14 @@ def Match_Children(
                 mod_child, 
                 attr_hash_dict, 
                 no_attr_hash_dict,
-                text_based_node_matches)
+                text_based_node_matches,
+                original_ids,
+                modified_ids,
+                mod_orig_matches)
 
             # Pop off both lists.
-            orig_children.remove(orig_child)
-            mod_children .remove(mod_child)
+            Pop_Child(orig_children, orig_remaining)
+            Pop_Child(mod_children, mod_remaining)
 
         else:
             # Want to determine if this is an insertion or deletion.
@@ -627,18 +890,18 @@ def Match_Children(
 
             if mod_child_in_orig == True and orig_child_in_mod == False:
                 # This case suggests a node was removed.
-                orig_children.remove(orig_child)
+                Pop_Child(orig_children, orig_remaining)
             
             elif mod_child_in_orig == False and orig_child_in_mod == True:
                 # This case suggests a node was added.
-                mod_children .remove(mod_child)
+                Pop_Child(mod_children, mod_remaining)
 
             elif mod_child_in_orig == False and orig_child_in_mod == False:
                 # Neither node is in the other; remove both.
                 # TODO: check for a no-attribute match later, and if found,
                 # just remove one of these.
-                orig_children.remove(orig_child)
-                mod_children .remove(mod_child)
+                Pop_Child(orig_children, orig_remaining)
+                Pop_Child(mod_children, mod_remaining)
 
             # TODO: add more annotation from earlier match checks, which
             # can pick up cases where the text_diff didn't match the nodes,
@@ -647,8 +910,8 @@ def Match_Children(
             else:
                 # This indicates a reordering.
                 # Just pick a node to throw out; go with modified node,
-                # so the original tail is available for matching still
+                # so the original node id is available for matching still
                 # (maybe slightly better?).
-                mod_children .remove(mod_child)
+                Pop_Child(mod_children, mod_remaining)
 
     return
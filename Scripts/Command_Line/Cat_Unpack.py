@@ -84,6 +84,13 @@ def Run():
         help  = 'Allows unpacking of files that fail an md5 hash check.'
                 ' This may occur in badly formed catalog files.')
 
+    argparser.add_argument(
+        '-workers',
+        type = int,
+        default = None,
+        help  = 'Number of threads used to hash and write files.'
+                ' Defaults to the number of cpu cores.')
+
     args = argparser.parse_args(sys.argv[1:])
 
     # Make the source a Path, and convert to absolute to fill in the parents.
@@ -114,7 +121,8 @@ def Run():
         dest_dir_path    = args.dest,
         include_pattern  = args.include,
         exclude_pattern  = args.exclude,
-        allow_md5_errors = args.allow_md5_errors
+        allow_md5_errors = args.allow_md5_errors,
+        num_workers      = args.workers,
         )
 
 Run()
\ No newline at end of file
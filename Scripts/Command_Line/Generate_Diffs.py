@@ -72,6 +72,13 @@ def Run():
         action='store_true',
         help =  'Print extra messages on each diff file generation.' )
 
+    argparser.add_argument(
+        '-w', '--workers',
+        default = 0,
+        type = int,
+        help =  'Number of processes to diff directories with; default 0'
+                ' uses one per cpu core.' )
+
     # TODO: pattern matching rules for the files to include or exclude.
 
 
@@ -143,6 +150,7 @@ def Run():
             output_dir_path   = out,
             skip_unchanged    = args.skip_unchanged,
             verbose           = args.verbose,
+            num_workers       = args.workers,
             )
 
 
@@ -370,6 +370,16 @@ if 0 or test_all:
         )
     
 
+# Check the patch selector against normal xpath lookups.
+if 0 or test_all:
+    wares_game_file = Framework.Load_File('libraries/wares.xml')
+    Framework.File_Manager.XML_Diff.Selector_Unit_Test(
+        test_node      = wares_game_file.Get_Root(), 
+        num_tests      = 1000 if not test_all else 100, 
+        rand_seed      = 1,
+        )
+    
+
 # Manual testing of cat reading.
 if 0 or test_all:
     Framework.File_Manager.File_System.Delayed_Init()